@@ -0,0 +1,235 @@
+"""
+Per bug manifest of what an oracle computed, to only redo the changed steps when
+the oracle is run again.
+
+Every oracle run used to start from scratch, even on a trace it had already
+checked or one where only a few screenshots changed. While an oracle runs (see
+capture), the per step results it computes from the screenshots and XML dumps
+(OCR text, LAB colour, keyboard label, SSIM...) go through cached():
+
+    lab = analysisManifest.cached("lab", [screen_path, xml_path], compute)
+
+The manifest records, for every step result, the content hash of its input files
+and the parameters it was computed with. On the next run a result is reused if
+its inputs hash the same, else it is computed again. At the end of the run the
+manifest is rewritten with the results of this run only, so a step removed from
+the trace is dropped from it.
+
+The content of a file is only hashed again when its size or mtime changed.
+Manifests are written as <oracle>_manifest.json in the bug folder, or in
+<manifest dir>/<bugId>/ when a folder is given with args["manifest_dir"] or
+MAGNETO_MANIFEST_DIR (the backend deletes the bug folders after a run).
+MAGNETO_MANIFEST_DIR=off turns the manifests off.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+
+MANIFEST_VERSION = 1
+
+_current = None
+_current_lock = threading.Lock()
+
+
+def _to_json(value):
+    # numpy results (LAB colour, SSIM...)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def _canonical(value):
+    """value as it reads back from the manifest (tuples become lists...)"""
+    return json.loads(json.dumps(value, default=_to_json))
+
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    def __init__(self, path, oracle, bug_dir):
+        self.path = path
+        self.oracle = oracle
+        self.bug_dir = os.path.abspath(bug_dir)
+        self.reused = 0
+        self.computed = 0
+        self._old_files = {}
+        self._old_steps = {}
+        self._files = {}
+        self._steps = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != MANIFEST_VERSION or data.get("oracle") != self.oracle:
+            return
+        self._old_files = data.get("files", {})
+        self._old_steps = data.get("steps", {})
+
+    def _relative(self, path):
+        path = os.path.abspath(path)
+        if path.startswith(os.path.join(self.bug_dir, "")):
+            return os.path.relpath(path, self.bug_dir)
+        return path
+
+    def file_hash(self, path):
+        """Content hash of path, None if it can't be read"""
+        name = self._relative(path)
+        with self._lock:
+            if name in self._files:
+                return self._files[name]["hash"]
+        try:
+            stat = os.stat(path)
+            old = self._old_files.get(name)
+            if old and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns:
+                digest = old["hash"]
+            else:
+                digest = file_digest(path)
+        except OSError:
+            return None
+        with self._lock:
+            self._files[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest}
+        return digest
+
+    def _key(self, kind, files):
+        """(step, entry) of a result: the step is its first input file"""
+        names = [self._relative(f) for f in files]
+        return names[0], "|".join([kind] + names[1:])
+
+    def _inputs(self, files):
+        inputs = {}
+        for f in files:
+            digest = self.file_hash(f)
+            if digest is None:
+                return None
+            inputs[self._relative(f)] = digest
+        return inputs
+
+    def lookup(self, kind, files, params=None):
+        """(True, result) if the result is in the manifest with the same inputs, else (False, None)"""
+        inputs = self._inputs(files)
+        if inputs is None:
+            return False, None
+        step, entry = self._key(kind, files)
+        params = _canonical(params)
+        with self._lock:
+            for steps in (self._steps, self._old_steps):
+                record = steps.get(step, {}).get(entry)
+                if record and record["inputs"] == inputs and record["params"] == params:
+                    self._steps.setdefault(step, {})[entry] = record
+                    if steps is self._old_steps:
+                        self.reused += 1
+                    return True, record["value"]
+        return False, None
+
+    def store(self, kind, files, value, params=None):
+        inputs = self._inputs(files)
+        if inputs is None:
+            # an input is missing, nothing to compare with next time
+            return
+        step, entry = self._key(kind, files)
+        record = {"inputs": inputs, "params": _canonical(params), "value": _canonical(value)}
+        with self._lock:
+            self._steps.setdefault(step, {})[entry] = record
+            self.computed += 1
+
+    def cached(self, kind, files, compute, params=None):
+        found, value = self.lookup(kind, files, params)
+        if found:
+            return value
+        value = compute()
+        self.store(kind, files, value, params)
+        return value
+
+    def save(self):
+        """Write the manifest, a reader never sees a half written file"""
+        data = {
+            "version": MANIFEST_VERSION,
+            "oracle": self.oracle,
+            "files": self._files,
+            "steps": self._steps,
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # concurrent runs of the same bug each write their own temporary file
+        tmp_path = "{}.{}.{}.tmp".format(self.path, os.getpid(), uuid.uuid4().hex[:8])
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, default=_to_json)
+        os.replace(tmp_path, self.path)
+
+
+def manifest_path(oracle, args):
+    """Where the manifest of the oracle on this bug is kept, None if turned off"""
+    manifest_dir = args.get("manifest_dir") or os.environ.get("MAGNETO_MANIFEST_DIR", "")
+    if manifest_dir.lower() in ("off", "0", "none"):
+        return None
+    if manifest_dir:
+        return os.path.join(manifest_dir, args["bugId"], oracle + "_manifest.json")
+    return os.path.join(args["unzip_dir"], args["bugId"], oracle + "_manifest.json")
+
+
+@contextlib.contextmanager
+def capture(oracle, args):
+    """Run the body with the manifest of the oracle on this bug, saved at the end"""
+    global _current
+    path = manifest_path(oracle, args)
+    manifest = None
+    if path is not None:
+        manifest = Manifest(path, oracle, os.path.join(args["unzip_dir"], args["bugId"]))
+    with _current_lock:
+        previous, _current = _current, manifest
+    try:
+        yield manifest
+        if manifest is not None:
+            try:
+                manifest.save()
+            except OSError as e:
+                print("[WARNING] manifest not written:", e)
+            else:
+                print(
+                    "[INFO] {} of {} step results reused from {}".format(
+                        manifest.reused, manifest.reused + manifest.computed, path
+                    )
+                )
+    finally:
+        with _current_lock:
+            _current = previous
+
+
+def lookup(kind, files, params=None):
+    """Manifest.lookup of the running oracle, (False, None) if there is none"""
+    manifest = _current
+    if manifest is None:
+        return False, None
+    return manifest.lookup(kind, files, params)
+
+
+def store(kind, files, value, params=None):
+    manifest = _current
+    if manifest is not None:
+        manifest.store(kind, files, value, params)
+
+
+def cached(kind, files, compute, params=None):
+    """compute(), or its result from the last run if its input files didn't change"""
+    manifest = _current
+    if manifest is None:
+        return compute()
+    return manifest.cached(kind, files, compute, params)
@@ -1,12 +1,12 @@
 from posixpath import splitext
 from pydoc import splitdoc
-from skimage.metrics import structural_similarity as compare_ssim
 import argparse
 import imutils
 import cv2
 import json
 import os, sys
 from pathlib import Path
+import time
 import warnings
 warnings.filterwarnings("ignore", message="Failed to load image Python extension")
 
@@ -17,40 +17,23 @@ sys.path.insert(1, dirName)
 
 import imageUtilities as imgUtil
 import labelPredictor
+import ssimEngine
+import oracleResult
+import reportUtilities
+import eventLog
+import analysisManifest
+import traceLoader
+import screenDedup
 
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.platypus import Table, TableStyle
 from reportlab.lib import colors
 
-import io
 
-# ------------------ DUO LOGGING SETUP ------------------
-class MultiLogger:
-    """
-    Sends all 'print' output to both the real console and an in-memory buffer (for PDF).
-    """
-    def __init__(self, *outputs):
-        self.outputs = outputs
-
-    def write(self, message):
-        for output in self.outputs:
-            output.write(message)
-            output.flush()
-
-    def flush(self):
-        for output in self.outputs:
-            output.flush()
-
-# Capture console output in a buffer
-console_output_buffer = io.StringIO()
-original_stdout = sys.stdout
-# Redirect prints to both console & buffer
-sys.stdout = MultiLogger(original_stdout, console_output_buffer)
-# -------------------------------------------------------
+# The console output of a run is kept in an eventLog.EventLog, see run()
 
 detailed_result = True
-tracePlayerGenerated = True
 
 def read_json(jsonName):
     with open(jsonName) as f:
@@ -63,46 +46,93 @@ def load_arguments():
     ap.add_argument("-a", "--appName", required=True, help="App name")
     ap.add_argument("-b", "--bugId", required=True, help="Bug ID")
     ap.add_argument("--unzip-dir", required=True, help="Path to the unzipped folder (contains bugId subfolder)")
+    ap.add_argument("--ssim-mode", choices=ssimEngine.MODES, default=None,
+                    help="how the SSIM is computed, see ssimEngine (default: score)")
+    ap.add_argument("--report", choices=oracleResult.REPORT_CHOICES, default=oracleResult.DEFAULT_REPORT,
+                    help="write a PDF and/or a JSON result in the bug folder")
     args = vars(ap.parse_args())
     return args
 
+# keyboard classification of the screens already looked at in this run, by path;
+# cleared by check_back_button, the next run may find other pixels at the same path
+keyboard_visible = {}
+
+def screen_has_keyboard(imageName):
+    if imageName in keyboard_visible:
+        return keyboard_visible[imageName]
+    cropped = imgUtil.crop_keyboard(imgUtil.open_screen(imageName))
+    return labelPredictor.has_keyboard(cropped)
+
+def compared_screens(args, triggerScreens):
+    """The screens before and after every back press"""
+    screens = []
+    for i, trigger in triggerScreens.items():
+        image_args = dict(args)
+        get_image_names(image_args, trigger, i)
+        screens += [image_args["first"], image_args["second"]]
+    return screens
+
+def classify_keyboards(args, triggerScreens, groups=None):
+    """
+    Classify the screens before and after every back press in batched forward passes.
+    Screens that can't be read are left to screen_has_keyboard, screens classified
+    by the last run on the same files are not classified again.
+    With groups (see screenDedup) only one screen of a group is classified.
+    """
+    names = []
+    crops = []
+    # labels of another model or heuristic threshold are not reused
+    params = labelPredictor.cache_params()
+    imageNames = compared_screens(args, triggerScreens)
+    for imageName in imageNames:
+        if imageName in keyboard_visible or imageName in names:
+            continue
+        found, label = analysisManifest.lookup("keyboard", [imageName], params)
+        if found:
+            keyboard_visible[imageName] = label
+            continue
+        if groups is not None and groups.representative(imageName) in names:
+            continue
+        try:
+            crops.append(imgUtil.crop_keyboard(imgUtil.open_screen(imageName)))
+        except Exception:
+            continue
+        names.append(imageName)
+    for imageName, label in zip(names, labelPredictor.has_keyboard_batch(crops)):
+        keyboard_visible[imageName] = label
+        analysisManifest.store("keyboard", [imageName], bool(label), params)
+    if groups is not None:
+        for imageName in imageNames:
+            representative = groups.representative(imageName)
+            if imageName not in keyboard_visible and representative in names:
+                keyboard_visible[imageName] = keyboard_visible[representative]
+                analysisManifest.store("keyboard", [imageName], bool(keyboard_visible[imageName]), params)
+
+def compared_screen(args, key):
+    """The screen compared for args[key], the one before it if the keyboard is shown"""
+    if screen_has_keyboard(args[key]):
+        return get_image_before(args, key)
+    return args[key]
+
 def crop_image(args, trigger, i):
     """Load/crop the two input images and remove status or bottom navigation bars."""
     try:
-        imageA = cv2.imread(args["first"])
-        croppedA = imgUtil.crop_keyboard(imageA)
-        hasKeyboard = labelPredictor.has_keyboard(croppedA)
-        if hasKeyboard:
-            imageName = get_image_before(args, "first")
-            imageA = cv2.imread(imageName)
-
-        imageA = imgUtil.crop_bottom_notification(imageA)
+        imageA = imgUtil.open_screen(compared_screen(args, "first")).without_status_bar
     except Exception:
         print(args["first"] + " Image file not found")
         return None, None
 
     try:
-        imageB = cv2.imread(args["second"])
-        croppedB = imgUtil.crop_keyboard(imageB)
-        hasKeyboard = labelPredictor.has_keyboard(croppedB)
-        if hasKeyboard:
-            imageName = get_image_before(args, "second")
-            imageB = cv2.imread(imageName)
-
-        imageB = imgUtil.crop_bottom_notification(imageB)
+        imageB = imgUtil.open_screen(compared_screen(args, "second")).without_status_bar
     except Exception:
         print(args["second"] + " Image file not found")
         return None, None
 
     return imageA, imageB
 
-def get_ssim(imageA, imageB):
-    """Convert the images to grayscale and compute SSIM."""
-    grayA = cv2.cvtColor(imageA, cv2.COLOR_BGR2GRAY)
-    grayB = cv2.cvtColor(imageB, cv2.COLOR_BGR2GRAY)
-
-    (score, diff) = compare_ssim(grayA, grayB, full=True)
-    return score
+def get_ssim(imageA, imageB, mode=None):
+    """Convert the images to grayscale and compute SSIM, returns (score, score is an estimate)."""
+    return ssimEngine.ssim_estimate(imageA, imageB, mode)
 
 def print_result(val, text_mismatch):
     """Print the result to terminal, based on SSIM and text mismatch."""
@@ -119,40 +149,27 @@ def print_result(val, text_mismatch):
         if text_mismatch != "":
             print("Text mismatch of {:.2%} ".format(text_mismatch))
 
-def findTrigger(app_name, listOfSteps, dim):
+def findTrigger(app_name, listOfSteps, dimensions):
     """Return dictionary of {sequenceStep -> screenshot} where back was triggered."""
     triggerList = {}
-    width = int(dim.split("x")[0])
-    height = int(dim.split("x")[1])
+    width, height = dimensions
 
     for step in listOfSteps:
-        if "dynGuiComponent" in step:
-            dynGuiComponentData = step["dynGuiComponent"]
-            command = step["textEntry"]
-            try:
-                x = int(command.split(" ")[-2])
-                y = int(command.split(" ")[-1])
-            except Exception:
+        if step.component is not None:
+            dynGuiComponentData = step.component
+            command = step.command
+            if step.tap is None:
                 continue
+            x, y = step.tap
 
             # Checking if the back button or an area near bottom-left was tapped.
             if (
                 dynGuiComponentData["idXml"] == "BACK_MODAL"
                 or (x < (width // 3) and (height - 200) <= y and "tap" in command)
             ):
-                triggerList[str(step["sequenceStep"])] = step["screenshot"]
+                triggerList[str(step.number)] = step.screenshot
     return triggerList
 
-def find_xml_from_screenshot(imagename, stepNum, args):
-    xmlName = ""
-    if tracePlayerGenerated:
-        xmlName = imagename.split(".User-Trace")[0]
-        xmlName += "-" + args["bugId"] + "-12-User-Trace-" + str(stepNum) + ".xml"
-    else:
-        xmlName = imagename.split("screen")[0]
-        xmlName += "ui-dump.xml"
-    return os.path.join(args["unzip_dir"], args["bugId"], "xmls", xmlName)
-
 def get_image_names(args, imageName, image_num):
     """
     Example:
@@ -185,47 +202,133 @@ def get_image_before(args, key):
     return before_image_path
 
 def main():
-    # ----------------------- MAIN LOGIC -----------------------
     args = load_arguments()
+    run(args)
+
+def run(args, data=None):
+    """
+    Back button oracle on one bug report, writes back_button_report.pdf in the bug folder.
+    args: appName, bugId, unzip_dir, report (see oracleResult, default pdf)
+    data: the trace (see traceLoader) or the content of Execution-<bugId>.json,
+          loaded from the bug folder if not given
+    Returns the verdict and metrics of the run, see summarize.
+    """
+    report = oracleResult.report_mode(args)
+    # what is printed goes to the console and to the event log, the log goes in the PDF
+    start = time.perf_counter()
+    with eventLog.capture("back") as log, analysisManifest.capture("back", args):
+        back_click_results = check_back_button(dict(args), data)
+        summary = summarize(back_click_results or [])
+        log.emit("verdict", scope="run", **summary)
+    if back_click_results is None:
+        return summary
+    timings = {"check": time.perf_counter() - start}
+
+    result = oracleResult.build_result(
+        "back", args, summary, back_click_results, log.events, timings
+    )
+    if oracleResult.wants_pdf(report):
+        start = time.perf_counter()
+        render_pdf(result)
+        timings["pdf"] = time.perf_counter() - start
+    if oracleResult.wants_json(report):
+        json_path = os.path.join(args["unzip_dir"], args["bugId"], "back_button_result.json")
+        oracleResult.write_result(json_path, result)
+        print(f"[INFO] JSON result written at: {json_path}")
+    return result["summary"]
+
+def render_pdf(result):
+    """Draw the PDF report of a run from its result (see oracleResult)"""
+    pdf_path = os.path.join(result["unzip_dir"], result["bugId"], "back_button_report.pdf")
+    generate_pdf_report(result["details"], pdf_path, result["events"])
+    print(f"[INFO] PDF report generated at: {pdf_path}")
+
+def summarize(back_click_results):
+    """Verdict (pass, fail or not_detected) and metrics of a run, for the batch results"""
+    # the estimated scores (see screenSimilarity.ssim_estimate) are not exact SSIM
+    ssim_vals = [r["ssim_val"] for r in back_click_results if not r.get("ssim_estimated")]
+    estimated = [r["ssim_val"] for r in back_click_results if r.get("ssim_estimated")]
+    missing = [r["missing_frac"] for r in back_click_results if r["missing_frac"] is not None]
+    failed = sum(1 for r in back_click_results if not r["passed"])
+
+    if not back_click_results:
+        verdict = "not_detected"
+    elif failed:
+        verdict = "fail"
+    else:
+        verdict = "pass"
+    return {
+        "verdict": verdict,
+        "back_presses": len(back_click_results),
+        "failed_presses": failed,
+        "min_ssim": float(min(ssim_vals)) if ssim_vals else None,
+        "min_ssim_estimated": float(min(estimated)) if estimated else None,
+        "estimated_ssim": len(estimated),
+        "max_missing_frac": max(missing) if missing else None,
+    }
+
+def check_back_button(args, data):
+    """Returns the result of every back press, None if the trace has no steps"""
+    # ----------------------- MAIN LOGIC -----------------------
     bugId = args["bugId"]
     unzip_dir = args["unzip_dir"]
 
-    # Read JSON
-    json_path = os.path.join(unzip_dir, bugId, f"Execution-{bugId}.json")
-    data = read_json(json_path)
+    # Read the trace
+    trace = traceLoader.as_trace(data, unzip_dir, bugId)
+    # labels of the last run, analysisManifest knows which files are still the same
+    keyboard_visible.clear()
 
     # We'll store results in a list to write them to a PDF afterward
     back_click_results = []
 
-    dim = None
-    listOfSteps = None
-    for line in data:
-        if "deviceDimensions" in line:
-            dim = data["deviceDimensions"]
-        if "steps" in line:
-            listOfSteps = data["steps"]
-            print("ORACLE FOR BACK BUTTON")
-            triggerScreens = findTrigger(args["appName"], listOfSteps, dim)
-            print("Back was clicked {} time(s)".format(len(triggerScreens)))
+    listOfSteps = trace.steps
+    if listOfSteps:
+        print("ORACLE FOR BACK BUTTON")
+        triggerScreens = findTrigger(args["appName"], listOfSteps, trace.dimensions)
+        print("Back was clicked {} time(s)".format(len(triggerScreens)))
 
     if not listOfSteps:
         print("No steps found in JSON.")
-        sys.exit(0)
+        return None
 
     print("-------------------------------------------------------------------------------------------")
 
+    # the same screen shown several times is classified, compared and read once (see screenDedup)
+    groups = screenDedup.group_screens(compared_screens(args, triggerScreens))
+    classify_keyboards(args, triggerScreens, groups)
+    ssim_values = {}
+
     for i, trigger in triggerScreens.items():
+        eventLog.emit("trigger", step=i, screen=trigger)
         get_image_names(args, trigger, i)
+        # the SSIM of screens that didn't change since the last run is in the manifest
+        ssim_params = {"mode": args.get("ssim_mode") or ssimEngine.SSIM_MODE, "precheck": ssimEngine.PRECHECK}
         try:
-            before_back, after_back = crop_image(args, trigger, i)
+            compared = [compared_screen(args, "first"), compared_screen(args, "second")]
+            found, ssim = analysisManifest.lookup("ssim_estimate", compared, ssim_params)
         except Exception:
-            before_back, after_back = None, None
+            compared, found = None, False
 
-        if before_back is None or after_back is None:
-            continue
+        pair = None if compared is None else tuple(groups.representative(c) for c in compared)
+        if not found and pair in ssim_values:
+            ssim = ssim_values[pair]
+            analysisManifest.store("ssim_estimate", compared, list(ssim), ssim_params)
+        elif not found:
+            try:
+                before_back, after_back = crop_image(args, trigger, i)
+            except Exception:
+                before_back, after_back = None, None
+
+            if before_back is None or after_back is None:
+                continue
 
-        # Compute SSIM
-        ssim_val = get_ssim(before_back, after_back)
+            # Compute SSIM
+            ssim = get_ssim(before_back, after_back, args.get("ssim_mode"))
+            if compared is not None:
+                ssim_values[pair] = ssim
+                analysisManifest.store("ssim_estimate", compared, list(ssim), ssim_params)
+        # estimated: thumbnail score of obviously different screens, see ssimEngine
+        ssim_val, ssim_estimated = ssim
         missing_frac = ""
 
         # Check text mismatch if SSIM > 0.8
@@ -234,8 +337,11 @@ def main():
             #before_text = imgUtil.read_text_on_screen(args["bugId"], os.path.basename(args["first"]))
             #after_text = imgUtil.read_text_on_screen(args["bugId"], os.path.basename(args["second"]))
 
-            before_text = imgUtil.read_text_on_screen(img_path, os.path.basename(args["first"]))
-            after_text = imgUtil.read_text_on_screen(img_path, os.path.basename(args["second"]))
+            # both screens go to the OCR engine in one batch, once if they are the same screen
+            before_text, after_text = groups.fan_out(
+                [args["first"], args["second"]],
+                lambda screens: imgUtil.read_text_on_screens(img_path, [os.path.basename(s) for s in screens]),
+            )
             #print("Reading before:", os.path.join(img_path, os.path.basename(args["first"])))
             #print("Reading after:", os.path.join(img_path, os.path.basename(args["second"])))
 
@@ -252,10 +358,15 @@ def main():
 
         # Determine pass/fail (for PDF)
         passed = (ssim_val > 0.8 and (missing_frac == "" or missing_frac <= 0.5))
+        eventLog.emit("metric", name="ssim", step=i, value=float(ssim_val))
+        if missing_frac != "":
+            eventLog.emit("metric", name="missing_frac", step=i, value=missing_frac)
+        eventLog.emit("verdict", scope="back_press", step=i, passed=passed)
 
         back_click_results.append({
             "trigger_step": i,
             "ssim_val": round(ssim_val, 3),
+            "ssim_estimated": bool(ssim_estimated),
             "missing_frac": (
                 round(missing_frac, 2)
                 if isinstance(missing_frac, float)
@@ -269,45 +380,12 @@ def main():
 
         print("-------------------------------------------------------------------------------------------")
 
-    # Now restore stdout and create PDF with console logs + images
-    sys.stdout = original_stdout
-    console_output = console_output_buffer.getvalue()
-
-    pdf_path = os.path.join(unzip_dir, bugId, "back_button_report.pdf")
-    generate_pdf_report(back_click_results, pdf_path, console_output)
-    print(f"[INFO] PDF report generated at: {pdf_path}")
+    return back_click_results
 
 # --------------------------------------------------------------------------------
 # PDF Generation
 # --------------------------------------------------------------------------------
-def draw_wrapped_text(canvas, text, x, y, max_width, font='Helvetica', font_size=10, line_height=12):
-    """
-    Utility to wrap text so it doesn't go off the page.
-    Returns the updated y-coordinate.
-    """
-    from reportlab.pdfbase.pdfmetrics import stringWidth
-
-    canvas.setFont(font, font_size)
-    words = text.split()
-    current_line = ""
-
-    for w in words:
-        candidate = (current_line + " " + w).strip() if current_line else w
-        width_of_candidate = stringWidth(candidate, font, font_size)
-        if width_of_candidate <= max_width:
-            current_line = candidate
-        else:
-            canvas.drawString(x, y, current_line)
-            y -= line_height
-            current_line = w
-
-    if current_line:
-        canvas.drawString(x, y, current_line)
-        y -= line_height
-
-    return y
-
-def generate_pdf_report(back_click_results, pdf_path, console_output):
+def generate_pdf_report(back_click_results, pdf_path, events):
     """
     1) First page: Entire console output (wrapped).
     2) Second page: summary table of back-click tests.
@@ -329,17 +407,12 @@ def generate_pdf_report(back_click_results, pdf_path, console_output):
 
     max_text_width = page_width - 2 * x_margin
 
-    for line in console_output.split("\n"):
-        y_position = draw_wrapped_text(
-            c, line, x_margin, y_position,
-            max_width=max_text_width,
-            font='Helvetica', font_size=10,
-            line_height=line_height
-        )
-        if y_position < 60:
-            c.showPage()
-            c.setFont("Helvetica", 10)
-            y_position = page_height - y_margin
+    y_position = reportUtilities.draw_console(
+        c, eventLog.console_lines(events), x_margin, y_position,
+        max_width=max_text_width, top=page_height - y_margin,
+        font='Helvetica', font_size=10,
+        line_height=line_height
+    )
 
     # --------------- Page 2: Summary Table ---------------
     c.showPage()
@@ -370,7 +443,7 @@ def generate_pdf_report(back_click_results, pdf_path, console_output):
         mismatch_str = f"{r['missing_frac']*100}%" if r["missing_frac"] is not None else "N/A"
         row = [
             r["trigger_step"],
-            str(r["ssim_val"]),
+            str(r["ssim_val"]) + (" (est.)" if r.get("ssim_estimated") else ""),
             mismatch_str,
             "PASSED" if r["passed"] else "FAILED"
         ]
@@ -390,6 +463,11 @@ def generate_pdf_report(back_click_results, pdf_path, console_output):
     tw, th = summary_table.wrap(0, 0)
     summary_table.drawOn(c, x_margin, y_position - th)
     y_position -= (th + 30)
+    if any(r.get("ssim_estimated") for r in back_click_results):
+        c.setFont("Helvetica", 9)
+        c.drawString(x_margin, y_position + 12,
+                     "(est.): SSIM of thumbnails of obviously different screens, lower than the full size SSIM")
+        y_position -= 10
 
     # --------------- Pages 3+ : Before/After Images ---------------
     for r in back_click_results:
@@ -411,7 +489,7 @@ def generate_pdf_report(back_click_results, pdf_path, console_output):
             c.setFont("Helvetica", 10)
             c.drawString(x_margin, y_position, "Before:")
             y_position -= 15
-            c.drawImage(before_path, x_margin, y_position - 200, width=200, height=200, preserveAspectRatio=True)
+            reportUtilities.draw_image(c, before_path, x_margin, y_position - 200, width=200, height=200, preserveAspectRatio=True)
         else:
             c.setFont("Helvetica", 10)
             c.drawString(x_margin, y_position, "(Before image not found)")
@@ -422,7 +500,7 @@ def generate_pdf_report(back_click_results, pdf_path, console_output):
             c.setFont("Helvetica", 10)
             c.drawString(x_margin, y_position, "After:")
             y_position -= 15
-            c.drawImage(after_path, x_margin, y_position - 200, width=200, height=200, preserveAspectRatio=True)
+            reportUtilities.draw_image(c, after_path, x_margin, y_position - 200, width=200, height=200, preserveAspectRatio=True)
             y_position -= 220
         else:
             c.setFont("Helvetica", 10)
@@ -12,13 +12,19 @@
 import numpy as np
 import torch
 import os
+import sys
+import threading
+import time
 from torch import nn
 from torch import optim
 import torch.nn.functional as F
 from torchvision import datasets, transforms, models
 from PIL import Image
-from torch.autograd import Variable
-from binaryClassifier import Net
+from binaryClassifier import Net, LiteNet, LITE_INPUT_SIZE, lite_transform
+
+# imageUtilities is in the parent directory, like for the oracles
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import imageUtilities as imgUtil
 
 
 class ImageFolderWithPaths(datasets.ImageFolder):
@@ -39,23 +45,252 @@ class ImageFolderWithPaths(datasets.ImageFolder):
 
 classes = ["typing", "noTyping"]
 
-model = Net()
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-scriptLocation = os.getcwd()
-model_location = os.path.join(scriptLocation,'model_cifar.pt')
-checkpoint = torch.load(model_location)
-
-# checkpoint.eval()
-model.load_state_dict(checkpoint)
-model.eval()
 test_transforms = transforms.Compose(
     [transforms.Resize((224, 224)), transforms.ToTensor()]
 )
 
+# keyboard detectors: network, weights, TorchScript export of the weights (see
+# export_torchscript, used instead of the weights when found), input size, gray scale input.
+# lite is experimental: no trained weights are shipped, train them with
+# "python binaryClassifier.py lite" and check them with "python labelPredictor.py compare"
+ARCHITECTURES = {
+    "cifar": (Net, "model_cifar.pt", "model_cifar.ts", 224, False),
+    "lite": (LiteNet, "model_keyboard_lite.pt", "model_keyboard_lite.ts", LITE_INPUT_SIZE, True),
+}
+KEYBOARD_ARCH = os.environ.get("MAGNETO_KEYBOARD_ARCH", "cifar")
+# int8 dynamic quantization of the nn.Linear layers only, the convolutions stay float.
+# That is the fully connected layers of "cifar" (fc1 alone holds ~23M of its weights);
+# the lite model has a single 64x2 one, it changes nothing there. CPU only, not
+# applied to the TorchScript exports.
+KEYBOARD_QUANTIZE = os.environ.get("MAGNETO_KEYBOARD_QUANTIZE", "0").lower() in ("1", "true", "yes")
+# crops classified per forward pass by has_keyboard_batch, bounds the memory used
+KEYBOARD_BATCH_SIZE = int(os.environ.get("MAGNETO_KEYBOARD_BATCH", 16))
 
-def main():
+# with MAGNETO_KEYBOARD_HEURISTIC=<confidence>, imageUtilities.detect_keyboard answers
+# alone when it is at least this confident and the other crops go to the model.
+# Off by default: check its agreement with the model first ("python labelPredictor.py
+# heuristic <bug dirs>").
+_heuristic = os.environ.get("MAGNETO_KEYBOARD_HEURISTIC", "off")
+KEYBOARD_HEURISTIC_CONFIDENCE = (
+    float("inf") if _heuristic.lower() in ("off", "none", "") else float(_heuristic)
+)
+
+
+def _heuristic_label(img):
+    """Label of imageUtilities.detect_keyboard if it decides alone, None otherwise"""
+    if KEYBOARD_HEURISTIC_CONFIDENCE == float("inf"):
+        # off, not worth running it
+        return None
+    label, confidence = imgUtil.detect_keyboard(img)
+    return label if confidence >= KEYBOARD_HEURISTIC_CONFIDENCE else None
+
+# torch.inference_mode is not in older torch versions
+_inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+_predictor = None
+_predictor_lock = threading.Lock()
+
+# how many crops were decided by the heuristic and by the model
+decision_counts = {"heuristic": 0, "model": 0}
+_decision_lock = threading.Lock()
+
+
+def find_model(name=ARCHITECTURES["cifar"][1]):
+    """
+    Path of the model file: MAGNETO_KEYBOARD_MODEL if set, else name next to this
+    script, else name in the current directory
+    """
+    env_path = os.environ.get("MAGNETO_KEYBOARD_MODEL")
+    if env_path:
+        return env_path
+    candidates = [
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), name),
+        os.path.join(os.getcwd(), name),
+    ]
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return candidates[0]
+
+
+def model_file(arch=None):
+    """Model file loaded for arch: MAGNETO_KEYBOARD_MODEL, else the TorchScript export if found, else the weights"""
+    if arch is None:
+        arch = KEYBOARD_ARCH
+    net, weights, scripted, size, grayscale = ARCHITECTURES[arch]
+    scripted = find_model(scripted)
+    return scripted if os.path.exists(scripted) else find_model(weights)
+
+
+class KeyboardPredictor:
+    """
+    Keyboard classifier loaded once, with timings.
+    arch is a key of ARCHITECTURES (binaryClassifier.Net or LiteNet).
+    model_path can be the state dict saved by binaryClassifier or a TorchScript export.
+    """
+
+    def __init__(self, model_path=None, threads=None, arch=None, quantize=None):
+        if threads is None:
+            threads = os.environ.get("MAGNETO_TORCH_THREADS")
+        if threads:
+            torch.set_num_threads(int(threads))
+        if arch is None:
+            arch = KEYBOARD_ARCH
+        if arch not in ARCHITECTURES:
+            raise ValueError("unknown keyboard model " + arch)
+        if quantize is None:
+            quantize = KEYBOARD_QUANTIZE
+        self.arch = arch
+        self.net, weights, scripted, self.input_size, self.grayscale = ARCHITECTURES[arch]
+        if self.grayscale:
+            self.transform = lite_transform
+        else:
+            self.transform = test_transforms
+        if model_path is None:
+            model_path = model_file(arch)
+
+        start = time.perf_counter()
+        self.model_path = model_path
+        self.model = self._load(model_path)
+        self.model.eval()
+        self.quantized = False
+        if quantize and not self.torchscript and device.type == "cpu":
+            self.model = torch.quantization.quantize_dynamic(
+                self.model, {nn.Linear}, dtype=torch.qint8
+            )
+            self.quantized = True
+        self.load_seconds = time.perf_counter() - start
+        self.calls = 0
+        self.predict_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self, model_path):
+        # both formats are zip archives, try TorchScript first
+        try:
+            self.torchscript = True
+            return torch.jit.load(model_path, map_location=device)
+        except RuntimeError:
+            self.torchscript = False
+        model = self.net()
+        checkpoint = torch.load(model_path, map_location=device)
+        model.load_state_dict(checkpoint)
+        return model.to(device)
+
+    def predict(self, image_tensor):
+        """index of the predicted class for every image of the (N, C, input_size, input_size) batch"""
+        start = time.perf_counter()
+        with _inference_mode():
+            output = self.model(image_tensor.to(device))
+        index = output.cpu().numpy().argmax(axis=1)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.calls += 1
+            self.predict_seconds += elapsed
+        return index
+
+    def stats(self):
+        return {
+            "arch": self.arch,
+            "model": self.model_path,
+            "torchscript": self.torchscript,
+            "quantized": self.quantized,
+            "parameters": sum(p.numel() for p in self.model.parameters()),
+            "threads": torch.get_num_threads(),
+            "load_seconds": self.load_seconds,
+            "calls": self.calls,
+            "mean_call_ms": 1000 * self.predict_seconds / self.calls if self.calls else 0.0,
+        }
+
+
+def get_predictor():
+    """The process wide predictor, the model is loaded on first use."""
+    global _predictor
+    if _predictor is None:
+        with _predictor_lock:
+            if _predictor is None:
+                _predictor = KeyboardPredictor()
+    return _predictor
+
+
+def set_predictor(predictor):
+    global _predictor
+    with _predictor_lock:
+        _predictor = predictor
+
+
+def predictor_stats():
+    """load time and latency of the keyboard classifier, None if it was never used"""
+    if _predictor is None:
+        return None
+    return _predictor.stats()
+
+
+def cache_params():
+    """
+    Settings the keyboard labels depend on (model, its file, quantization, heuristic),
+    the params of the labels kept in analysisManifest. The model isn't loaded.
+    """
+    path = model_file()
+    try:
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+    except OSError:
+        stamp = None
+    heuristic = KEYBOARD_HEURISTIC_CONFIDENCE
+    return {
+        "arch": KEYBOARD_ARCH,
+        "model": os.path.abspath(path),
+        "model_stamp": stamp,
+        "quantize": KEYBOARD_QUANTIZE,
+        "heuristic": None if heuristic == float("inf") else heuristic,
+    }
+
+
+def _count(path, n=1):
+    with _decision_lock:
+        decision_counts[path] += n
+
+
+def decision_stats():
+    """how often the heuristic and the model decided, since the start or the last reset"""
+    with _decision_lock:
+        total = decision_counts["heuristic"] + decision_counts["model"]
+        stats = dict(decision_counts)
+    stats["heuristic_rate"] = stats["heuristic"] / total if total else 0.0
+    return stats
+
+
+def reset_decision_stats():
+    with _decision_lock:
+        for path in decision_counts:
+            decision_counts[path] = 0
 
 
+def export_torchscript(model_path=None, output_path=None, arch="cifar"):
+    """
+    Save a frozen TorchScript version of the model, loaded faster and run without
+    the python network class. Written next to the weights by default, under the
+    name ARCHITECTURES gives for arch.
+    """
+    net, weights, scripted_name, size, grayscale = ARCHITECTURES[arch]
+    if model_path is None:
+        model_path = find_model(weights)
+    if output_path is None:
+        output_path = os.path.join(os.path.dirname(os.path.abspath(model_path)), scripted_name)
+    model = net()
+    model.load_state_dict(torch.load(model_path, map_location="cpu"))
+    model.eval()
+    with torch.no_grad():
+        channels = 1 if grayscale else 3
+        scripted = torch.jit.trace(model, torch.zeros(1, channels, size, size))
+        scripted = torch.jit.freeze(scripted)
+    scripted.save(output_path)
+    return output_path
+
+
+def main():
+
     # instantiate the dataset and dataloader
     data_dir = "/Users/enter_name/Documents/proj_folder/oracleFromBehavior/backButton/bug_id/result"
     dataset = ImageFolderWithPaths(data_dir, transform=test_transforms)
@@ -73,19 +308,201 @@ def main():
             print(paths, ":", "predicted :", str(classes[index]), index)
 
 
+def to_pil(img, grayscale=False):
+    """
+    PIL image of a cv2 (BGR) crop for the transforms. In gray scale with the BGR
+    weights: transforms.Grayscale would take the channels as RGB, the lite model
+    is trained on RGB images.
+    """
+    if grayscale:
+        return Image.fromarray(imgUtil.get_grayscale(img))
+    return transforms.ToPILImage()(img)
+
+
 def predict_image(image):
-    image_tensor = test_transforms(image).float()
+    predictor = get_predictor()
+    image_tensor = predictor.transform(image).float()
     image_tensor = image_tensor.unsqueeze_(0)
-    input = Variable(image_tensor)
-    input = input.to(device)
-    output = model(input)
-    index = output.data.cpu().numpy().argmax()
-    return index
+    return predictor.predict(image_tensor)[0]
 
 
 def has_keyboard(img):
-    to_pil = transforms.ToPILImage()
-    image = to_pil(img)
+    label = _heuristic_label(img)
+    if label is not None:
+        _count("heuristic")
+        return label
+    _count("model")
+    image = to_pil(img, get_predictor().grayscale)
     index = predict_image(image)
     # print(index, "============")
     return not index  # because 0 == typing and 1 is non typing
+
+
+def crops_to_tensor(crops, transform, grayscale=False):
+    """
+    (N, C, size, size) input of the model for a list of HxWx3 uint8 crops, each
+    through the same PIL transform as has_keyboard so both give the same labels.
+    """
+    if not crops:
+        return torch.empty(0)
+    return torch.stack([transform(to_pil(crop, grayscale)).float() for crop in crops])
+
+
+def has_keyboard_batch(imgs, chunk_size=None):
+    """
+    has_keyboard for a list of crops (e.g. every screen of a trace). The crops the
+    heuristic can't decide are classified chunk_size at a time in one forward pass each.
+    Returns one bool per crop.
+    """
+    if chunk_size is None:
+        chunk_size = KEYBOARD_BATCH_SIZE
+    result = [None] * len(imgs)
+    ambiguous = []
+    for i, img in enumerate(imgs):
+        result[i] = _heuristic_label(img)
+        if result[i] is None:
+            ambiguous.append(i)
+    _count("heuristic", len(imgs) - len(ambiguous))
+    if not ambiguous:
+        return result
+
+    _count("model", len(ambiguous))
+    predictor = get_predictor()
+    for start in range(0, len(ambiguous), chunk_size):
+        chunk = ambiguous[start : start + chunk_size]
+        batch = crops_to_tensor([imgs[i] for i in chunk], predictor.transform, predictor.grayscale)
+        for i, index in zip(chunk, predictor.predict(batch)):
+            result[i] = not index  # 0 == typing
+    return result
+
+
+def keyboard_crops(bug_dirs):
+    """(paths, keyboard crops) of the screenshots of bug_dirs"""
+    paths = []
+    crops = []
+    for bug_dir in bug_dirs:
+        for name in sorted(os.listdir(bug_dir)):
+            # the _gui images are crops of one component, not screenshots
+            if not name.endswith(".png") or "_gui" in name:
+                continue
+            path = os.path.join(bug_dir, name)
+            try:
+                crops.append(imgUtil.open_screen(path).keyboard)
+            except Exception:
+                continue
+            paths.append(path)
+    return paths, crops
+
+
+def compare_heuristic(bug_dirs, predictor=None):
+    """
+    Agreement of imageUtilities.detect_keyboard with the model on the screenshots
+    of bug_dirs, by confidence. Prints the disagreements and the lowest confidence
+    MAGNETO_KEYBOARD_HEURISTIC can be set to without changing a label of the model.
+    """
+    if predictor is None:
+        predictor = get_predictor()
+    paths, crops = keyboard_crops(bug_dirs)
+    heuristic = [imgUtil.detect_keyboard(crop) for crop in crops]
+    model = []
+    for start in range(0, len(crops), KEYBOARD_BATCH_SIZE):
+        batch = crops_to_tensor(crops[start : start + KEYBOARD_BATCH_SIZE], predictor.transform, predictor.grayscale)
+        model += [not index for index in predictor.predict(batch)]
+
+    by_confidence = {}
+    for path, (label, confidence), expected in zip(paths, heuristic, model):
+        counts = by_confidence.setdefault(confidence, [0, 0])
+        counts[0] += 1
+        if label == expected:
+            counts[1] += 1
+        else:
+            print("    {}: heuristic {} ({:.2f}), model {}".format(path, label, confidence, expected))
+    print("{} screenshots".format(len(crops)))
+    print("{:>10} {:>8} {:>8}".format("confidence", "crops", "agree"))
+    for confidence, (total, agree) in sorted(by_confidence.items()):
+        print("{:>10.2f} {:>8} {:>8.1%}".format(confidence, total, agree / total))
+    disagree = [c for c, (total, agree) in by_confidence.items() if agree < total]
+    safe = max(disagree) + 0.01 if disagree else min(by_confidence, default=0.0)
+    print("lowest MAGNETO_KEYBOARD_HEURISTIC agreeing with the model: {:.2f}".format(safe))
+    return safe
+
+
+def compare_models(bug_dirs, variants=None, labels=None):
+    """
+    Accuracy and latency of the keyboard detectors on the screenshots of bug_dirs.
+    variants: list of (arch, quantize), by default every architecture whose weights
+    are found, with and without quantization.
+    labels: {screenshot path: has keyboard}. Without it, accuracy is the agreement
+    with the first variant (model_cifar.pt).
+    """
+    if variants is None:
+        variants = [
+            (arch, quantize)
+            for arch, spec in ARCHITECTURES.items()
+            if os.path.exists(find_model(spec[1])) or os.path.exists(find_model(spec[2]))
+            for quantize in (False, True)
+        ]
+
+    paths, crops = keyboard_crops(bug_dirs)
+    print("{} screenshots".format(len(crops)))
+
+    results = []
+    reference = labels
+    for arch, quantize in variants:
+        predictor = KeyboardPredictor(arch=arch, quantize=quantize)
+        batch = crops_to_tensor(crops, predictor.transform, predictor.grayscale)
+
+        start = time.perf_counter()
+        single = [predictor.predict(batch[i : i + 1])[0] for i in range(len(crops))]
+        single_ms = 1000 * (time.perf_counter() - start) / max(len(crops), 1)
+
+        start = time.perf_counter()
+        for i in range(0, len(crops), KEYBOARD_BATCH_SIZE):
+            predictor.predict(batch[i : i + KEYBOARD_BATCH_SIZE])
+        batch_ms = 1000 * (time.perf_counter() - start) / max(len(crops), 1)
+
+        predicted = {path: not index for path, index in zip(paths, single)}
+        if reference is None:
+            reference = predicted
+        agree = sum(predicted[p] == reference[p] for p in paths if p in reference)
+        scored = sum(1 for p in paths if p in reference)
+        stats = predictor.stats()
+        results.append({
+            "arch": arch,
+            "quantized": predictor.quantized,
+            "parameters": stats["parameters"],
+            "load_seconds": stats["load_seconds"],
+            "ms_per_image": single_ms,
+            "ms_per_image_batched": batch_ms,
+            "accuracy": agree / scored if scored else None,
+        })
+
+    print("{:8} {:9} {:>10} {:>8} {:>10} {:>12} {:>9}".format(
+        "arch", "quantized", "params", "load s", "ms/image", "ms/image b{}".format(KEYBOARD_BATCH_SIZE), "accuracy"))
+    for r in results:
+        print("{:8} {:9} {:>10} {:>8.2f} {:>10.2f} {:>12.2f} {:>9}".format(
+            r["arch"], str(r["quantized"]), r["parameters"], r["load_seconds"],
+            r["ms_per_image"], r["ms_per_image_batched"],
+            "-" if r["accuracy"] is None else "{:.1%}".format(r["accuracy"])))
+    return results
+
+
+if __name__ == "__main__":
+    # python labelPredictor.py compare ../themeChange/18 ../backButton/23 ...
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="command", required=True)
+    compare = sub.add_parser("compare", help="accuracy/latency of the keyboard models")
+    compare.add_argument("bug_dirs", nargs="+")
+    check = sub.add_parser("heuristic", help="agreement of the keyboard heuristic with the model")
+    check.add_argument("bug_dirs", nargs="+")
+    export = sub.add_parser("export", help="save the TorchScript version of a model")
+    export.add_argument("--arch", default="cifar", choices=sorted(ARCHITECTURES))
+    cli_args = ap.parse_args()
+    if cli_args.command == "compare":
+        compare_models(cli_args.bug_dirs)
+    elif cli_args.command == "heuristic":
+        compare_heuristic(cli_args.bug_dirs)
+    else:
+        print(export_torchscript(arch=cli_args.arch))
@@ -0,0 +1,298 @@
+"""
+SSIM of the screens before and after a back press.
+
+get_ssim used to call compare_ssim(grayA, grayB, full=True) on the full size
+screens (1080 x ~1700) and only kept the score. The modes here give the same
+verdict (score > SSIM_THRESHOLD) for less work:
+
+  exact   : compare_ssim, same as before
+  score   : same formula (7x7 uniform window, sample covariance, data range 255)
+            computed with cv2.boxFilter and no diff image, the score matches
+            compare_ssim up to float rounding (default)
+  pyramid : the score is first computed at 1/PYRAMID_SCALE of the size, the full
+            size score is only computed when the small one falls in PYRAMID_BAND
+            around the threshold. Outside of that band the reported value is the
+            small scale score.
+
+Shrinking the screens blurs the text and icons, so the small scale score is
+lower than the full size one (by up to 0.27 at 1/4 on the checked-in traces)
+and almost never higher, hence the band reaching much further below the
+threshold than above it.
+
+Before score and pyramid, a pre-check compares thumbnails (1/PRECHECK_SCALE) of the two
+screens: when their mean absolute difference is above PRECHECK_MAD and their SSIM
+is more than PRECHECK_MARGIN below the threshold, the screens are obviously
+different and the thumbnail SSIM is returned without looking at the full size
+screens. The pre-check is turned off with MAGNETO_SSIM_PRECHECK=0.
+
+The thumbnail and small scale scores give the right verdict but not the full size
+value (up to ~0.4 lower): ssim_estimate tells which scores are estimates, the
+oracle marks them as such in its report.
+
+    python ssimEngine.py benchmark [bug folders...]
+
+compares the verdicts and the time of every mode on the checked-in traces.
+Settings can be given with MAGNETO_SSIM_MODE, MAGNETO_SSIM_PRECHECK and
+MAGNETO_SSIM_PRECHECK_MAD.
+"""
+
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+import threading
+
+import cv2
+import numpy as np
+from skimage.metrics import structural_similarity as compare_ssim
+
+SSIM_THRESHOLD = 0.8
+WIN_SIZE = 7
+DATA_RANGE = 255.0
+K1 = 0.01
+K2 = 0.03
+
+PYRAMID_SCALE = 4
+# refine when threshold - 0.35 <= small scale score <= threshold + 0.02
+PYRAMID_BAND = (0.35, 0.02)
+PRECHECK_SCALE = 8
+PRECHECK_MARGIN = 0.4
+PRECHECK_MAD = float(os.environ.get("MAGNETO_SSIM_PRECHECK_MAD", 40))
+
+MODES = ("exact", "score", "pyramid")
+SSIM_MODE = os.environ.get("MAGNETO_SSIM_MODE", "score")
+PRECHECK = os.environ.get("MAGNETO_SSIM_PRECHECK", "1").lower() not in ("0", "off", "false", "no")
+
+# which path gave the score, to see how often the shortcuts are taken
+decision_counts = {"precheck": 0, "pyramid": 0, "refined": 0, "score": 0, "exact": 0}
+_counts_lock = threading.Lock()
+
+
+def _count(decision):
+    with _counts_lock:
+        decision_counts[decision] += 1
+
+
+def decision_stats():
+    with _counts_lock:
+        return dict(decision_counts)
+
+
+def reset_decision_stats():
+    with _counts_lock:
+        for decision in decision_counts:
+            decision_counts[decision] = 0
+
+
+def to_gray(image):
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def downscale(gray, factor):
+    h, w = gray.shape[:2]
+    size = (max(WIN_SIZE, w // factor), max(WIN_SIZE, h // factor))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+
+def ssim_score(grayA, grayB):
+    """
+    Mean SSIM of two gray images, same value as compare_ssim(grayA, grayB) for
+    uint8 images but without building (and returning) the diff image.
+    """
+    if grayA.shape != grayB.shape:
+        raise ValueError("Input images must have the same dimensions.")
+    if min(grayA.shape) < WIN_SIZE:
+        raise ValueError("images smaller than the {0}x{0} window".format(WIN_SIZE))
+
+    a = grayA.astype(np.float64)
+    b = grayB.astype(np.float64)
+    window = (WIN_SIZE, WIN_SIZE)
+
+    def mean(x):
+        # the border is cropped below, so the border mode doesn't change the score
+        return cv2.boxFilter(x, -1, window, normalize=True, borderType=cv2.BORDER_REFLECT)
+
+    ux = mean(a)
+    uy = mean(b)
+    uxx = mean(a * a)
+    uyy = mean(b * b)
+    uxy = mean(a * b)
+
+    np_ = WIN_SIZE * WIN_SIZE
+    cov_norm = np_ / (np_ - 1)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    C1 = (K1 * DATA_RANGE) ** 2
+    C2 = (K2 * DATA_RANGE) ** 2
+    S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux * ux + uy * uy + C1) * (vx + vy + C2))
+
+    pad = (WIN_SIZE - 1) // 2
+    return float(S[pad:-pad, pad:-pad].mean(dtype=np.float64))
+
+
+def precheck(grayA, grayB):
+    """
+    Cheap test on thumbnails. Returns the thumbnail SSIM when the screens are
+    obviously different, None when the full computation is needed.
+    """
+    smallA = downscale(grayA, PRECHECK_SCALE)
+    smallB = downscale(grayB, PRECHECK_SCALE)
+    mad = cv2.absdiff(smallA, smallB).mean()
+    if mad <= PRECHECK_MAD:
+        return None
+    score = ssim_score(smallA, smallB)
+    # the thumbnail score is lower than the full size one, keep a wide margin
+    if score >= SSIM_THRESHOLD - PRECHECK_MARGIN:
+        return None
+    return score
+
+
+def get_ssim(imageA, imageB, mode=None, use_precheck=None):
+    """SSIM of two screens (BGR or gray) computed with the given mode"""
+    return ssim_estimate(imageA, imageB, mode, use_precheck)[0]
+
+
+def ssim_estimate(imageA, imageB, mode=None, use_precheck=None):
+    """
+    (score, estimated) of two screens: estimated is True when the score is the
+    one of the thumbnails (pre-check) or of the small scale screens (pyramid),
+    only good for the verdict.
+    """
+    if mode is None:
+        mode = SSIM_MODE
+    if use_precheck is None:
+        use_precheck = PRECHECK and mode != "exact"
+    if mode not in MODES:
+        raise ValueError("unknown SSIM mode " + mode)
+
+    grayA = to_gray(imageA)
+    grayB = to_gray(imageB)
+    if grayA.shape != grayB.shape:
+        raise ValueError("Input images must have the same dimensions.")
+
+    if use_precheck:
+        score = precheck(grayA, grayB)
+        if score is not None:
+            _count("precheck")
+            return score, True
+
+    if mode == "exact":
+        _count("exact")
+        (score, diff) = compare_ssim(grayA, grayB, full=True)
+        return score, False
+
+    if mode == "pyramid":
+        score = ssim_score(downscale(grayA, PYRAMID_SCALE), downscale(grayB, PYRAMID_SCALE))
+        below, above = PYRAMID_BAND
+        if not SSIM_THRESHOLD - below <= score <= SSIM_THRESHOLD + above:
+            _count("pyramid")
+            return score, True
+        _count("refined")
+        return ssim_score(grayA, grayB), False
+
+    _count("score")
+    return ssim_score(grayA, grayB), False
+
+
+# --------------------------------------------------------------------------------
+# Benchmark
+# --------------------------------------------------------------------------------
+def _step_number(path):
+    match = re.search(r"(\d+)\.png$", path)
+    return int(match.group(1)) if match else None
+
+
+def screen_pairs(bug_dir):
+    """
+    Pairs of screens of a trace compared the way the oracle does (screens two
+    steps apart), plus the neighbouring screens, to have more than the few back
+    presses of the checked-in traces.
+    """
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import imageUtilities as imgUtil
+
+    screens = {}
+    for path in glob.glob(os.path.join(bug_dir, "*.png")):
+        step = _step_number(path)
+        if step is not None and "_augmented" not in path and "_gui" not in path:
+            screens[step] = path
+    pairs = []
+    for step, path in sorted(screens.items()):
+        for distance in (1, 2):
+            other = screens.get(step + distance)
+            if other is None:
+                continue
+            imageA = imgUtil.open_screen(path).gray_without_status_bar
+            imageB = imgUtil.open_screen(other).gray_without_status_bar
+            if imageA.shape == imageB.shape and imageA.size:
+                pairs.append((path, other, imageA, imageB))
+    return pairs
+
+
+def benchmark(bug_dirs, repeat=3):
+    pairs = []
+    seen = set()
+    for bug_dir in bug_dirs:
+        # some traces are checked in for several oracles
+        for pair in screen_pairs(bug_dir):
+            names = (os.path.basename(pair[0]), os.path.basename(pair[1]))
+            if names not in seen:
+                seen.add(names)
+                pairs.append(pair)
+    print("{} screen pairs from {} folder(s)".format(len(pairs), len(bug_dirs)))
+    if not pairs:
+        return
+
+    variants = [("exact", False), ("score", False), ("score", True), ("pyramid", False), ("pyramid", True)]
+    reference = None
+    for mode, use_precheck in variants:
+        reset_decision_stats()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            scores = [get_ssim(a, b, mode, use_precheck) for _, _, a, b in pairs]
+        seconds = (time.perf_counter() - start) / repeat
+        verdicts = [score > SSIM_THRESHOLD for score in scores]
+        if reference is None:
+            reference = (scores, verdicts)
+        agree = sum(v == r for v, r in zip(verdicts, reference[1]))
+        error = max(abs(s - r) for s, r in zip(scores, reference[0]))
+        counts = {k: v // repeat for k, v in decision_stats().items() if v}
+        print(
+            "{:8} precheck={:5} {:7.1f} ms/pair  verdicts {}/{}  max |score - exact| {:.2e}  {}".format(
+                mode, str(use_precheck), 1000 * seconds / len(pairs), agree, len(pairs), error, counts
+            )
+        )
+        for (nameA, nameB, _, _), v, r in zip(pairs, verdicts, reference[1]):
+            if v != r:
+                print("    differs on", os.path.basename(nameA), os.path.basename(nameB))
+
+
+def load_arguments(argv=None):
+    ap = argparse.ArgumentParser(description="SSIM modes of the back button oracle")
+    sub = ap.add_subparsers(dest="command", required=True)
+    bench = sub.add_parser("benchmark", help="compare the modes on checked-in traces")
+    bench.add_argument("bug_dirs", nargs="*", help="bug folders (default: every checked-in trace)")
+    bench.add_argument("--repeat", type=int, default=3)
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = load_arguments(argv)
+    if args.command == "benchmark":
+        bug_dirs = args.bug_dirs
+        if not bug_dirs:
+            oracle_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            bug_dirs = sorted(
+                d for d in glob.glob(os.path.join(oracle_dir, "*", "*")) if glob.glob(os.path.join(d, "Execution-*.json"))
+            )
+        benchmark(bug_dirs, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
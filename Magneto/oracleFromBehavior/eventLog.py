@@ -0,0 +1,139 @@
+"""
+Log of an oracle run, replaces the MultiLogger tee of the oracles.
+
+While an oracle runs, sys.stdout is an EventLog: what the oracle prints still
+goes to the console (through its normal buffering, MultiLogger flushed after
+every fragment of every print) and is kept as "line" events. Besides the
+console lines the oracles record typed events with emit():
+
+    trigger : something to check was found in the trace (theme change, back press...)
+    metric  : a value computed for a screen (delta_E, SSIM, missing text...)
+    verdict : pass / fail of a check, and of the whole run at the end
+
+Every event is a dict {"t": seconds since the start of the run, "oracle": ...,
+"type": ..., <fields>}. The console part of the PDF reports is drawn from the
+"line" events (console_lines) and all the events go in the JSON result.
+
+For live progress the typed events can also be streamed as NDJSON, one line per
+event as soon as it happens: MAGNETO_EVENTS=stderr, or the path of a file (or
+named pipe) to append to.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+_current = None
+_current_lock = threading.Lock()
+
+
+def _to_json(value):
+    # numpy numbers (delta_E, SSIM...)
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class EventLog:
+    def __init__(self, oracle, console=None, stream=None):
+        self.oracle = oracle
+        self.events = []
+        self.console = console
+        self.stream = stream
+        self._start = time.perf_counter()
+        self._partial = []
+        self._lock = threading.Lock()
+
+    def _add(self, type, fields):
+        event = {"t": round(time.perf_counter() - self._start, 4), "oracle": self.oracle, "type": type}
+        event.update(fields)
+        self.events.append(event)
+        return event
+
+    # ---- file interface, the log stands in for sys.stdout ----
+    def write(self, text):
+        if self.console is not None:
+            self.console.write(text)
+        with self._lock:
+            *complete, rest = text.split("\n")
+            if complete:
+                complete[0] = "".join(self._partial) + complete[0]
+                self._partial = []
+                for line in complete:
+                    self._add("line", {"text": line})
+            if rest:
+                self._partial.append(rest)
+        return len(text)
+
+    def flush(self):
+        if self.console is not None:
+            self.console.flush()
+
+    def isatty(self):
+        return False
+
+    # ---- typed events ----
+    def emit(self, type, **fields):
+        with self._lock:
+            event = self._add(type, fields)
+        if self.stream is not None:
+            self.stream.write(json.dumps(event, default=_to_json) + "\n")
+            self.stream.flush()
+        return event
+
+    def close(self):
+        with self._lock:
+            if self._partial:
+                self._add("line", {"text": "".join(self._partial)})
+                self._partial = []
+        self.flush()
+
+    def text(self):
+        return "\n".join(console_lines(self.events))
+
+
+def console_lines(events):
+    """What was printed during the run, line by line"""
+    return [event["text"] for event in events if event["type"] == "line"]
+
+
+def open_stream():
+    """The NDJSON stream set with MAGNETO_EVENTS, None if not set"""
+    target = os.environ.get("MAGNETO_EVENTS", "")
+    if not target:
+        return None
+    if target == "stderr":
+        return sys.stderr
+    return open(target, "a", buffering=1)
+
+
+@contextlib.contextmanager
+def capture(oracle):
+    """Run the body with sys.stdout going to a new EventLog (and to the console)"""
+    global _current
+    stream = open_stream()
+    log = EventLog(oracle, console=sys.stdout, stream=stream)
+    original_stdout = sys.stdout
+    with _current_lock:
+        previous, _current = _current, log
+    sys.stdout = log
+    try:
+        yield log
+    finally:
+        log.close()
+        sys.stdout = original_stdout
+        with _current_lock:
+            _current = previous
+        if stream is not None and stream is not sys.stderr:
+            stream.close()
+
+
+def emit(type, **fields):
+    """Record an event in the log of the running oracle, nothing if there is none"""
+    log = _current
+    if log is not None:
+        return log.emit(type, **fields)
+    return None
@@ -1,9 +1,9 @@
 import os, sys, json
+import time
 import argparse
 import cv2
 import numpy as np
 import pytesseract
-from polyglot.detect import Detector
 from pprint import pprint
 
 from reportlab.lib.pagesizes import A4
@@ -11,40 +11,28 @@ from reportlab.platypus import Table, TableStyle
 from reportlab.lib import colors
 from reportlab.pdfgen import canvas
 
-import io
 
 scriptLocation = os.getcwd()
 dirName = os.path.dirname(scriptLocation)
 sys.path.insert(1, dirName)
 import imageUtilities as imgUtil
+import oracleResult
+import reportUtilities
+import eventLog
+import analysisManifest
+import languageId
+import traceLoader
+import screenDedup
+import triggerMatcher
 
 """This code checks the language for all the screens following language selection."""
 
 detailed_result = True
 
-# ------------------ DUO LOGGING SETUP ------------------
-class MultiLogger:
-    """
-    Sends all 'print' output to both the real console and an in-memory buffer (for PDF).
-    """
-    def __init__(self, *outputs):
-        self.outputs = outputs
-
-    def write(self, message):
-        for output in self.outputs:
-            output.write(message)
-            output.flush()
+# words in the title of the language selection window
+LANGUAGE_WINDOW_WORDS = ["language"]
 
-    def flush(self):
-        for output in self.outputs:
-            output.flush()
-
-# Capture console output in a buffer
-console_output_buffer = io.StringIO()
-original_stdout = sys.stdout
-# Redirect prints to both console & buffer
-sys.stdout = MultiLogger(original_stdout, console_output_buffer)
-# -------------------------------------------------------
+# The console output of a run is kept in an eventLog.EventLog, see run()
 
 def load_arguments():
     """Construct the argument parser and parse the arguments."""
@@ -52,6 +40,8 @@ def load_arguments():
     ap.add_argument("-a", "--appName", required=True, help="App name")
     ap.add_argument("-b", "--bugId", required=True, help="Bug ID")
     ap.add_argument("--unzip-dir", required=True, help="Path to the unzipped folder (contains bugId subfolder)")
+    ap.add_argument("--report", choices=oracleResult.REPORT_CHOICES, default=oracleResult.DEFAULT_REPORT,
+                    help="write a PDF and/or a JSON result in the bug folder")
     args = vars(ap.parse_args())
     return args
 
@@ -61,9 +51,10 @@ def read_json(json_path):
 
 def was_language_set(dynGuiComponentData):
     """Checks if the current window indicates language selection."""
+    matcher = triggerMatcher.get_matcher(LANGUAGE_WINDOW_WORDS)
     if (
-        "language" in dynGuiComponentData["currentWindow"].lower()
-        and "language" in dynGuiComponentData["titleWindow"].lower()
+        matcher.contains(dynGuiComponentData["currentWindow"])
+        and matcher.contains(dynGuiComponentData["titleWindow"])
     ):
         return True
     else:
@@ -78,10 +69,10 @@ def find_trigger(app_name, listOfSteps):
     language_selected = None
     language_set = False
     for index, step in enumerate(listOfSteps):
-        if "dynGuiComponent" in step:
-            dynGuiComponentData = step["dynGuiComponent"]
+        if step.component is not None and step.screen is not None:
+            dynGuiComponentData = step.component
             try:
-                result_screen = step["screenshot"].replace("_augmented", "")
+                result_screen = step.screen
                 if not language_set:
                     language_set = was_language_set(dynGuiComponentData)
                 if language_set and language_selected:
@@ -91,7 +82,7 @@ def find_trigger(app_name, listOfSteps):
                     language_selected = dynGuiComponentData["text"]
                     nextStep = listOfSteps[index + 1] if index + 1 < len(listOfSteps) else None
                     if nextStep:
-                        nextComp = nextStep.get("dynGuiComponent", {})
+                        nextComp = nextStep.component or {}
                         nextActivity = nextComp.get("activity", "")
                         temp_selection = nextComp.get("text", "")
                         if nextActivity and "launcher" in nextActivity.lower() and temp_selection != '':
@@ -138,68 +129,90 @@ def display_result(val, result_map, selected_lang, total, trigger):
             "'Detector is not able to detect the language reliably.' message is shown if the text to be translated was too small for reliable translation."
         )
 
-def detect_language(txt, selected_lang, lang_data):
+def detect_language(txt, selected_lang, table=None):
     """
     Attempt to detect the language for each text line.
     If it doesn't match the user-selected language, record it.
     Returns: (result_map, total_count)
       result_map: {line: detected_language} for lines not matching
       total_count: how many lines we attempted to detect
+    The detections are cached, see languageId.
     """
-    from polyglot.detect import Detector
-    result_map = {}
-    total_count = len(txt)
-    for line in txt:
-        try:
-            # Use Polyglot to detect possible languages
-            detector = Detector(line, quiet=True)
-            for language in detector.languages:
-                name = language.name
-                code = language.code
-                confidence = language.confidence
-                language_info = lang_data.get(code, {})
-
-                # Combine name and nativeName
-                all_names = []
-                if "name" in language_info:
-                    all_names += language_info["name"].split(",")
-                if "nativeName" in language_info:
-                    all_names += language_info["nativeName"].split(",")
-
-                # Cleanup trailing spaces
-                all_names = [n.strip() for n in all_names if n.strip()]
-
-                # If the selected language isn't in the possible names,
-                # and confidence is >= 70, treat it as a mismatch
-                if selected_lang not in all_names and float(confidence) >= 70:
-                    result_map[line] = name
-        except Exception:
-            # If detection fails, skip
-            continue
-
-    return (result_map, total_count)
+    return languageId.mismatches_on_screens([txt], selected_lang, table)[0]
 
 def main():
     args = load_arguments()
+    run(args)
+
+def run(args, data=None):
+    """
+    Language oracle on one bug report, writes language_detection_report.pdf in the bug folder.
+    args: appName, bugId, unzip_dir, report (see oracleResult, default pdf)
+    data: the trace (see traceLoader) or the content of Execution-<bugId>.json,
+          loaded from the bug folder if not given
+    Returns the verdict and metrics of the run, see summarize.
+    """
+    report = oracleResult.report_mode(args)
+    # what is printed goes to the console and to the event log, the log goes in the PDF
+    start = time.perf_counter()
+    with eventLog.capture("lang") as log, analysisManifest.capture("lang", args):
+        pdf_summary = check_language(args, data)
+        summary = summarize(pdf_summary)
+        log.emit("verdict", scope="run", **summary)
+    timings = {"check": time.perf_counter() - start}
+
+    result = oracleResult.build_result(
+        "lang", args, summary, pdf_summary, log.events, timings
+    )
+    if oracleResult.wants_pdf(report):
+        start = time.perf_counter()
+        render_pdf(result)
+        timings["pdf"] = time.perf_counter() - start
+    if oracleResult.wants_json(report):
+        json_path = os.path.join(args["unzip_dir"], args["bugId"], "language_detection_result.json")
+        oracleResult.write_result(json_path, result)
+        print(f"[INFO] JSON result written at: {json_path}")
+    return result["summary"]
+
+def render_pdf(result):
+    """Draw the PDF report of a run from its result (see oracleResult)"""
+    pdf_path = os.path.join(result["unzip_dir"], result["bugId"], "language_detection_report.pdf")
+    generate_pdf_report(result["details"], pdf_path, result["events"])
+    print(f"[INFO] PDF generated at: {pdf_path}")
+
+def summarize(pdf_summary):
+    """Verdict (pass, fail or not_detected) and metrics of a run, for the batch results"""
+    screens = [r for change in pdf_summary["lang_changes"] for r in change["results"]]
+    bad = [r["bad_percentage"] for r in screens]
+    # display_result: more than 5% of the text not in the selected language
+    failed = sum(1 for b in bad if b > 0.05)
+
+    if not pdf_summary["lang_changes"]:
+        verdict = "not_detected"
+    elif failed:
+        verdict = "fail"
+    else:
+        verdict = "pass"
+    return {
+        "verdict": verdict,
+        "language_changes": len(pdf_summary["lang_changes"]),
+        "screens": len(screens),
+        "failed_screens": failed,
+        "max_bad_percentage": max(bad) if bad else None,
+    }
+
+def check_language(args, data):
     bugId = args["bugId"]
     unzip_dir = args["unzip_dir"]
 
-    # Read the main JSON that has the steps
-    json_path = os.path.join(unzip_dir, bugId, f"Execution-{bugId}.json")
-    data = read_json(json_path)
+    # Read the trace that has the steps
+    trace = traceLoader.as_trace(data, unzip_dir, bugId)
 
-    # Read the language code JSON (assumes it is in the same folder or use an absolute path)
-    lang_data = read_json("language_code.json")
+    # Names of every language code of language_code.json, read once per process
+    table = languageId.load_table()
 
     print("ORACLE FOR LANGUAGE CHANGE")
-    triggerScreens = {}
-    listOfSteps = None
-
-    # Parse 'deviceDimensions' or 'steps' from the JSON
-    for line in data:
-        if "steps" in line:
-            listOfSteps = data["steps"]
-            triggerScreens = find_trigger(args["appName"], listOfSteps)
+    triggerScreens = find_trigger(args["appName"], trace.steps)
     if len(triggerScreens) > 0:
         print("Language was set {} time(s)".format(len(triggerScreens)))
     else:
@@ -210,8 +223,15 @@ def main():
         "lang_changes": []
     }
 
+    # the same screen shown several times is read once (see screenDedup)
+    screenshot_path = os.path.join(unzip_dir, bugId)
+    groups = screenDedup.group_screens(
+        [os.path.join(screenshot_path, trigger) for triggers in triggerScreens.values() for trigger in triggers]
+    )
+
     # For each language found, gather the screens and check them
     for selection, triggers in triggerScreens.items():
+        eventLog.emit("trigger", language=selection, screens=len(triggers))
         lang_result = {
             "selected_lang": selection,
             "results": []  # each item: { 'screen': str, 'bad_percentage': float, 'num_lines': int, 'num_mismatched': int }
@@ -220,12 +240,21 @@ def main():
         print("===========================================================================================")
         print("Result for", selection, "language selection")
 
-        for trigger in triggers:
+        # OCR all the screens of this selection in one batch
+        texts_on_screens = groups.fan_out(
+            [os.path.join(screenshot_path, trigger) for trigger in triggers],
+            lambda screens: imgUtil.read_text_on_screens(screenshot_path, [os.path.basename(s) for s in screens]),
+        )
+        # and detect the language of their lines together, each distinct line once
+        screen_mismatches = languageId.mismatches_on_screens(texts_on_screens, selection, table)
+
+        for trigger, text_on_screen, (result_map, total_lines_detected) in zip(
+            triggers, texts_on_screens, screen_mismatches
+        ):
             # We'll store the actual screenshot path to embed in the PDF
             screenshot_file = f"{trigger}"  # or some known naming pattern
             full_path = os.path.join(unzip_dir, bugId, screenshot_file)
-            screenshot_path = os.path.join(unzip_dir, bugId)
-            text_on_screen = imgUtil.read_text_on_screen(screenshot_path, trigger)
+            bad_percentage = len(result_map) / total_lines_detected if total_lines_detected > 0 else 0.0
             if not text_on_screen:
                 print("Test passed : No text found in image", trigger)
                 lang_result["results"].append({
@@ -237,11 +266,11 @@ def main():
                 })
                 continue
 
-            result_map, total_lines_detected = detect_language(text_on_screen, selection, lang_data)
-            bad_percentage = len(result_map) / total_lines_detected if total_lines_detected > 0 else 0.0
-
             print("---------------------- Was the displayed text in selected language? -----------------------")
             display_result(bad_percentage, result_map, selection, total_lines_detected, trigger)
+            eventLog.emit("metric", name="bad_percentage", screen=trigger, value=bad_percentage)
+            # display_result: more than 5% of the text not in the selected language fails
+            eventLog.emit("verdict", scope="screen", screen=trigger, passed=bad_percentage <= 0.05)
             print("-------------------------------------------------------------------------------------------")
 
             lang_result["results"].append({
@@ -254,13 +283,7 @@ def main():
 
         pdf_summary["lang_changes"].append(lang_result)
 
-    # Restore stdout and build the PDF with logs + images
-    sys.stdout = original_stdout
-    console_output = console_output_buffer.getvalue()
-
-    pdf_path = os.path.join(unzip_dir, bugId, "language_detection_report.pdf")
-    generate_pdf_report(pdf_summary, pdf_path, console_output)
-    print(f"[INFO] PDF generated at: {pdf_path}")
+    return pdf_summary
 
 
 # ----------------------------------------------------------------
@@ -297,7 +320,7 @@ def draw_wrapped_text(canvas, text, x, y, max_width, font='Helvetica', font_size
 # ----------------------------------------------------------------
 # PDF GENERATION (CONSOLE LOGS first, then summary table, then images)
 # ----------------------------------------------------------------
-def generate_pdf_report(summary, pdf_path, console_output):
+def generate_pdf_report(summary, pdf_path, events):
     """
     1) Page 1: Entire console logs (wrapped).
     2) Page 2: Summary table for language checks.
@@ -323,17 +346,12 @@ def generate_pdf_report(summary, pdf_path, console_output):
 
     max_text_width = page_width - 2 * x_margin
 
-    for line in console_output.split("\n"):
-        y_position = draw_wrapped_text(
-            c, line, x_margin, y_position,
-            max_width=max_text_width,
-            font='Helvetica', font_size=10,
-            line_height=line_height
-        )
-        if y_position < 60:  # If near bottom, new page
-            c.showPage()
-            c.setFont("Helvetica", 10)
-            y_position = page_height - y_margin
+    y_position = reportUtilities.draw_console(
+        c, eventLog.console_lines(events), x_margin, y_position,
+        max_width=max_text_width, top=page_height - y_margin,
+        font='Helvetica', font_size=10,
+        line_height=line_height
+    )
 
     # -------------------- Page 2: Summary Table(s) --------------------
     c.showPage()
@@ -425,7 +443,8 @@ def generate_pdf_report(summary, pdf_path, console_output):
             # Draw the image if it exists
             if os.path.exists(screenshot_path):
                 print(f"✅ Found Screenshot: {screenshot_path}")
-                c.drawImage(
+                reportUtilities.draw_image(
+                    c,
                     screenshot_path,
                     x_margin,
                     y_position - 200,
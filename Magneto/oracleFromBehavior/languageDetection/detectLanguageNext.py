@@ -15,12 +15,16 @@ scriptLocation = os.getcwd()
 dirName = os.path.dirname(scriptLocation)
 sys.path.insert(1, dirName)
 import imageUtilities as imgUtil
+import triggerMatcher
 
 """This code checks the language for only the next screen following language selection"""
 
 
 detailed_result = True
 
+# words in the title of the language selection window
+LANGUAGE_WINDOW_WORDS = ["language"]
+
 
 def load_arguments():
     """construct the argument parse and parse the arguments"""
@@ -40,9 +44,10 @@ def read_json(jsonName):
 
 
 def was_language_set(dynGuiComponentData):
+    matcher = triggerMatcher.get_matcher(LANGUAGE_WINDOW_WORDS)
     if (
-        "language" in dynGuiComponentData["currentWindow"].lower()
-        and "language" in dynGuiComponentData["titleWindow"].lower()
+        matcher.contains(dynGuiComponentData["currentWindow"])
+        and matcher.contains(dynGuiComponentData["titleWindow"])
     ):
         return True
     else:
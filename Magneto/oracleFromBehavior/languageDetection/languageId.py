@@ -0,0 +1,295 @@
+"""
+Language identification of the text read on the screens.
+
+detect_language used to run polyglot's Detector on every line of every screen
+and, for every language found, split the name and nativeName of language_code.json
+again to check if it was the selected language. Here:
+
+  - language_code.json is read once per process into a LanguageTable, a set of
+    names (name and nativeName, split on ",") per language code,
+  - what the Detector finds for a line is kept in a bounded LRU (LINE_CACHE_SIZE
+    lines), the same line shown on several screens, or in several traces run by
+    the same process, is only detected once,
+  - mismatches_on_screens scores the lines of a batch of screens together, each
+    distinct line of the batch going once through the cache.
+
+The result is the same as before: a line is a mismatch when one of the languages
+the Detector found with a confidence of at least MIN_CONFIDENCE isn't the
+selected one, lines the Detector fails on are skipped.
+
+    python languageId.py benchmark [bug folders...]
+
+compares the time of the old line by line detection and of the cached one on
+the checked-in traces (languageDetection/21 and 22 by default).
+The size of the cache can be set with MAGNETO_LANGID_CACHE (0 turns it off).
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from polyglot.detect import Detector
+
+MIN_CONFIDENCE = 70
+LINE_CACHE_SIZE = int(os.environ.get("MAGNETO_LANGID_CACHE", 4096))
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def default_table_path():
+    """language_code.json next to this script, else in the current directory"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "language_code.json")
+    if os.path.exists(path):
+        return path
+    return "language_code.json"
+
+
+class LanguageTable:
+    """Names of every language code of language_code.json"""
+
+    def __init__(self, lang_data):
+        self.names = {}
+        for code, info in lang_data.items():
+            names = info.get("name", "").split(",") + info.get("nativeName", "").split(",")
+            self.names[code] = frozenset(n.strip() for n in names if n.strip())
+
+    def is_language(self, code, selected_lang):
+        """True if selected_lang is one of the names of the language code"""
+        return selected_lang in self.names.get(code, ())
+
+
+def load_table(path=None):
+    """The LanguageTable of path (default language_code.json), read once"""
+    if path is None:
+        path = default_table_path()
+    path = os.path.abspath(path)
+    with _tables_lock:
+        if path not in _tables:
+            with open(path) as f:
+                _tables[path] = LanguageTable(json.load(f))
+        return _tables[path]
+
+
+class DetectionCache:
+    """LRU of the languages found in a line: line -> ((name, code, confidence), ...) or None"""
+
+    def __init__(self, max_size=LINE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, lines):
+        """Cached detections of lines, {line: detection} of the ones found"""
+        found = {}
+        with self._lock:
+            for line in lines:
+                if line in self._lines:
+                    self._lines.move_to_end(line)
+                    found[line] = self._lines[line]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def put_many(self, detections):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            for line, detection in detections.items():
+                self._lines[line] = detection
+                self._lines.move_to_end(line)
+            while len(self._lines) > self.max_size:
+                self._lines.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "lines": len(self._lines),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._lines.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_cache = DetectionCache()
+
+
+def get_cache():
+    return _cache
+
+
+def detect(line):
+    """Languages polyglot finds in line, None when it can't tell"""
+    try:
+        languages = Detector(line, quiet=True).languages
+        return tuple((language.name, language.code, float(language.confidence)) for language in languages)
+    except Exception:
+        return None
+
+
+def detect_lines(lines, cache=None):
+    """{line: detection} of every distinct line, detecting only the ones not cached"""
+    if cache is None:
+        cache = _cache
+    distinct = list(dict.fromkeys(lines))
+    detections = cache.get_many(distinct)
+    new = {line: detect(line) for line in distinct if line not in detections}
+    cache.put_many(new)
+    detections.update(new)
+    return detections
+
+
+def mismatches(lines, selected_lang, detections, table):
+    """
+    Lines not in selected_lang, same as detect_language.
+    Returns (result_map, total_count): {line: detected language} of the mismatches
+    and the number of lines checked.
+    """
+    result_map = {}
+    for line in lines:
+        detection = detections.get(line)
+        if detection is None:
+            continue
+        for name, code, confidence in detection:
+            if confidence >= MIN_CONFIDENCE and not table.is_language(code, selected_lang):
+                result_map[line] = name
+    return result_map, len(lines)
+
+
+def mismatches_on_screens(texts_on_screens, selected_lang, table=None, cache=None):
+    """mismatches of several screens (lists of lines), their lines detected together"""
+    if table is None:
+        table = load_table()
+    detections = detect_lines([line for text in texts_on_screens if text for line in text], cache)
+    return [mismatches(text or [], selected_lang, detections, table) for text in texts_on_screens]
+
+
+# --------------------------------------------------------------------------------
+# Benchmark
+# --------------------------------------------------------------------------------
+def line_by_line(txt, selected_lang, lang_data):
+    """detect_language as it was, for the benchmark"""
+    result_map = {}
+    for line in txt:
+        try:
+            for language in Detector(line, quiet=True).languages:
+                language_info = lang_data.get(language.code, {})
+                all_names = []
+                if "name" in language_info:
+                    all_names += language_info["name"].split(",")
+                if "nativeName" in language_info:
+                    all_names += language_info["nativeName"].split(",")
+                all_names = [n.strip() for n in all_names if n.strip()]
+                if selected_lang not in all_names and float(language.confidence) >= MIN_CONFIDENCE:
+                    result_map[line] = language.name
+        except Exception:
+            continue
+    return (result_map, len(txt))
+
+
+def trace_texts(bug_dir):
+    """[(selected language, [lines of each screen])] of the language changes of a trace"""
+    oracle_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(1, oracle_dir)
+    import imageUtilities as imgUtil
+    import traceLoader
+    import detectLanguageAll
+
+    bug_dir = os.path.abspath(bug_dir)
+    unzip_dir, bugId = os.path.split(bug_dir)
+    trace = traceLoader.load_trace(unzip_dir, bugId)
+    texts = []
+    for selection, screens in detectLanguageAll.find_trigger("", trace.steps).items():
+        texts.append((selection, imgUtil.read_text_on_screens(bug_dir, screens)))
+    return texts
+
+
+def benchmark(bug_dirs, repeat=3):
+    changes = []
+    for bug_dir in bug_dirs:
+        changes += trace_texts(bug_dir)
+    screens = [(selection, text or []) for selection, texts in changes for text in texts]
+    lines = [line for _, text in screens for line in text]
+    print(
+        "{} language change(s), {} screens, {} lines ({} distinct) from {} folder(s)".format(
+            len(changes), len(screens), len(lines), len(set(lines)), len(bug_dirs)
+        )
+    )
+    if not screens:
+        return
+
+    with open(default_table_path()) as f:
+        lang_data = json.load(f)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        expected = [line_by_line(text, selection, lang_data) for selection, text in screens]
+    line_seconds = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    table = load_table()
+    cache = DetectionCache()
+    cold = []
+    for selection, texts in changes:
+        cold += mismatches_on_screens([text or [] for text in texts], selection, table, cache)
+    cold_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        warm = []
+        for selection, texts in changes:
+            warm += mismatches_on_screens([text or [] for text in texts], selection, table, cache)
+    warm_seconds = (time.perf_counter() - start) / repeat
+
+    for label, seconds, results in (
+        ("line by line", line_seconds, expected),
+        ("cold cache", cold_seconds, cold),
+        ("warm cache", warm_seconds, warm),
+    ):
+        same = sum(r == e for r, e in zip(results, expected))
+        print(
+            "{:12} {:8.1f} ms  {:6.2f} ms/screen  results {}/{}".format(
+                label, 1000 * seconds, 1000 * seconds / len(screens), same, len(screens)
+            )
+        )
+    print("cache", cache.stats())
+
+
+def load_arguments(argv=None):
+    ap = argparse.ArgumentParser(description="Language identification of the language oracle")
+    sub = ap.add_subparsers(dest="command", required=True)
+    bench = sub.add_parser("benchmark", help="compare with the line by line detection on checked-in traces")
+    bench.add_argument("bug_dirs", nargs="*", help="bug folders (default: languageDetection/21 and 22)")
+    bench.add_argument("--repeat", type=int, default=3)
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = load_arguments(argv)
+    if args.command == "benchmark":
+        bug_dirs = args.bug_dirs
+        if not bug_dirs:
+            here = os.path.dirname(os.path.abspath(__file__))
+            bug_dirs = sorted(
+                d for d in glob.glob(os.path.join(here, "*")) if glob.glob(os.path.join(d, "Execution-*.json"))
+            )
+        benchmark(bug_dirs, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+"""
+Runs several oracles on one bug report in a single process.
+
+    python magneto.py run --oracles theme,back,input,lang -a <appName> -b <bugId> --unzip-dir <dir>
+
+Each oracle script used to be started on its own, so every run imported torch,
+cv2 and reportlab again, reloaded the keyboard model and re-read the trace, the
+XML dumps and the screenshots. Here the trace (Execution-<bugId>.json, see
+traceLoader) is read once and given to every oracle, and the process wide caches
+(parsed XML dumps in xmlUtilities, decoded screenshots in imageUtilities, the OCR
+engine and cache, the keyboard classifier) are shared by all of them.
+Every oracle still writes its own PDF in the bug folder, same as when run alone.
+
+    python magneto.py batch --bugs <root dir or glob>... [--oracles ...] [--workers N]
+                            [--timeout S] [--output results.jsonl] [--csv results.csv]
+                            [--report {none,json,pdf,both}]
+
+runs the oracles on every bug folder found (a folder <bugId> holding
+Execution-<bugId>.json), one process per bug and --workers bugs at a time. A bug
+that crashes its process or runs for more than --timeout seconds only fails its
+own rows. Every oracle run gives one row (bugId, oracle, verdict, seconds, error
+and the metrics returned by the oracle's run()), written to the JSONL file as
+soon as it is known and to the CSV file at the end. The verdict is pass, fail,
+not_detected (nothing for the oracle to check in the trace), error or timeout.
+No report is written in the bug folders unless asked with --report, the console
+output of each bug goes to --log-dir if given.
+
+    python magneto.py render <bug folder or *_result.json>... [--unzip-dir <dir>]
+
+draws the PDF reports from the JSON results written with --report json (see
+oracleResult), e.g. only for the failed bugs of a batch. --unzip-dir is where the
+bug folders are now, if they were moved since the run.
+"""
+
+import argparse
+import contextlib
+import csv
+import glob
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import Counter, deque
+from multiprocessing.connection import wait
+
+import oracleResult
+import screenStore
+import traceLoader
+
+ORACLE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# oracle name -> folder, script and PDF report (written in the bug folder) of the oracle
+ORACLES = {
+    "theme": ("themeChange", "themeCheck.py", "theme_detection_report.pdf"),
+    "back": ("backButton", "SSIM-withoutReport.py", "back_button_report.pdf"),
+    "input": ("userEnteredData", "findTriggerCheckInput.py", "user_input_report.pdf"),
+    "lang": ("languageDetection", "detectLanguageAll.py", "language_detection_report.pdf"),
+}
+
+_modules = {}
+
+
+def load_oracle(name):
+    """The module of an oracle script, imported once"""
+    if name not in _modules:
+        folder, script, report = ORACLES[name]
+        folder = os.path.join(ORACLE_DIR, folder)
+        # the shared modules are in this folder, labelPredictor and binaryClassifier
+        # in the oracle's folder
+        for path in (ORACLE_DIR, folder):
+            if path not in sys.path:
+                sys.path.append(path)
+        # the script names are not all valid module names (SSIM-withoutReport)
+        spec = importlib.util.spec_from_file_location(
+            "oracle_" + name, os.path.join(folder, script)
+        )
+        module = importlib.util.module_from_spec(spec)
+        # registered so the functions the oracles send to worker processes can be pickled
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+        _modules[name] = module
+    return _modules[name]
+
+
+def report_path(name, unzip_dir, bugId):
+    """Where the oracle writes its PDF"""
+    return os.path.join(unzip_dir, bugId, ORACLES[name][2])
+
+
+def result_path(name, unzip_dir, bugId):
+    """Where the oracle writes its JSON result"""
+    return report_path(name, unzip_dir, bugId).replace("_report.pdf", "_result.json")
+
+
+def load_trace(unzip_dir, bugId):
+    """The trace of the bug, see traceLoader"""
+    return traceLoader.load_trace(unzip_dir, bugId)
+
+
+def parse_oracles(value):
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    for name in names:
+        if name not in ORACLES:
+            raise argparse.ArgumentTypeError(
+                "unknown oracle {} (choose from {})".format(name, ",".join(ORACLES))
+            )
+    return names
+
+
+def run_oracle(name, args, data):
+    """Run one oracle, returns its row of results (never raises)"""
+    start = time.perf_counter()
+    record = {"bugId": args["bugId"], "oracle": name}
+    try:
+        module = load_oracle(name)
+        # the oracles may add their own keys to args
+        summary = module.run(dict(args), data)
+        record.update(summary or {})
+        record["error"] = None
+    except Exception as e:
+        traceback.print_exc()
+        record["verdict"] = "error"
+        record["error"] = "{}: {}".format(type(e).__name__, e)
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    print(
+        "[INFO] {} oracle {} in {:.1f}s".format(
+            name, "failed" if record["error"] else "done", record["seconds"]
+        )
+    )
+    return record
+
+
+def ingest_screens(bug_dir):
+    """Pack the screenshots of the bug into its screen store (screenStore), not needed to run"""
+    try:
+        screenStore.ingest(bug_dir)
+    except Exception as e:
+        print("[WARNING] screenshots not ingested:", e)
+
+
+def run(oracles, appName, bugId, unzip_dir, jobs=None, report=None, ingest=False):
+    """
+    Run the oracles on one bug report, one after the other.
+    jobs: worker processes an oracle may use for its screens (default number of cores)
+    report: none, json, pdf or both (default pdf), see oracleResult
+    ingest: pack the screenshots into the screen store first
+    Returns {oracle: row of results}, the row's error is None if the oracle ran.
+    """
+    args = {"appName": appName, "bugId": bugId, "unzip_dir": unzip_dir, "jobs": jobs, "report": report}
+    if ingest:
+        ingest_screens(os.path.join(unzip_dir, bugId))
+    data = load_trace(unzip_dir, bugId)
+    return {name: run_oracle(name, args, data) for name in oracles}
+
+
+# --------------------------------------------------------------------------------
+# Batch
+# --------------------------------------------------------------------------------
+def is_bug_folder(path):
+    bugId = os.path.basename(os.path.normpath(path))
+    return os.path.isfile(os.path.join(path, f"Execution-{bugId}.json"))
+
+
+def find_bugs(patterns):
+    """Bug folders matching the globs, or found under the given directories"""
+    found = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if not os.path.isdir(path):
+                continue
+            if is_bug_folder(path):
+                found.append(os.path.abspath(path))
+                continue
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                if is_bug_folder(root):
+                    found.append(os.path.abspath(root))
+                    # the screenshots and xmls of a bug, no other bug below
+                    dirs[:] = []
+    # a folder given twice is run once
+    return list(dict.fromkeys(found))
+
+
+def _batch_worker(conn, oracles, bug_dir, appName, jobs, report, log_path, ingest=False):
+    """Runs in the process of one bug, sends a row per oracle as soon as it is done"""
+    unzip_dir, bugId = os.path.split(bug_dir)
+    output = open(log_path, "w") if log_path else io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                data = load_trace(unzip_dir, bugId)
+            except Exception as e:
+                traceback.print_exc()
+                for name in oracles:
+                    conn.send({"bugId": bugId, "oracle": name, "verdict": "error",
+                               "error": "{}: {}".format(type(e).__name__, e), "seconds": 0.0})
+                return
+            if appName is None:
+                appName = data.app_name
+            if ingest:
+                ingest_screens(bug_dir)
+            args = {"appName": appName, "bugId": bugId, "unzip_dir": unzip_dir, "jobs": jobs, "report": report}
+            for name in oracles:
+                conn.send(run_oracle(name, args, data))
+    finally:
+        output.close()
+        conn.close()
+
+
+def batch(bug_dirs, oracles, workers=None, timeout=None, appName=None, jobs=1,
+          report="none", log_dir=None, on_record=None, ingest=False):
+    """
+    Run the oracles on every bug folder, each bug in its own process.
+    appName: taken from the trace when None
+    timeout: seconds a bug may run, its process is killed after that
+    on_record: called with every row as soon as it is known
+    ingest: pack the screenshots of every bug into its screen store first
+    Returns the rows, one per bug and oracle.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    for name in oracles:
+        # imported once here, the bug processes are forked with the modules loaded
+        load_oracle(name)
+
+    records = []
+
+    def emit(record, bug_dir):
+        record["bug_dir"] = bug_dir
+        records.append(record)
+        if on_record is not None:
+            on_record(record)
+
+    pending = deque(bug_dirs)
+    running = {}  # connection -> [process, bug folder, deadline, oracles still to report]
+    while pending or running:
+        while pending and len(running) < workers:
+            bug_dir = pending.popleft()
+            log_path = None
+            if log_dir:
+                log_path = os.path.join(log_dir, bug_dir.strip(os.sep).replace(os.sep, "_") + ".log")
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=_batch_worker, args=(sender, oracles, bug_dir, appName, jobs, report, log_path, ingest)
+            )
+            process.start()
+            # only the child writes, so the pipe reports EOF when the child is gone
+            sender.close()
+            deadline = time.monotonic() + timeout if timeout else None
+            running[receiver] = [process, bug_dir, deadline, list(oracles)]
+
+        deadlines = [job[2] for job in running.values() if job[2] is not None]
+        wait_for = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+        for conn in wait(list(running), wait_for):
+            process, bug_dir, deadline, remaining = running[conn]
+            try:
+                record = conn.recv()
+                remaining.remove(record["oracle"])
+                emit(record, bug_dir)
+                continue
+            except EOFError:
+                pass
+            del running[conn]
+            conn.close()
+            process.join()
+            for name in remaining:
+                emit({"bugId": os.path.basename(bug_dir), "oracle": name, "verdict": "error",
+                      "error": "bug process exited with code {}".format(process.exitcode)}, bug_dir)
+
+        now = time.monotonic()
+        for conn, (process, bug_dir, deadline, remaining) in list(running.items()):
+            if deadline is not None and now >= deadline:
+                process.kill()
+                process.join()
+                del running[conn]
+                conn.close()
+                for name in remaining:
+                    emit({"bugId": os.path.basename(bug_dir), "oracle": name, "verdict": "timeout",
+                          "error": "timed out after {}s".format(timeout), "seconds": timeout}, bug_dir)
+    return records
+
+
+# --------------------------------------------------------------------------------
+# Render
+# --------------------------------------------------------------------------------
+def find_results(paths):
+    """The *_result.json files given, or found in the given bug folders"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(glob.glob(os.path.join(path, "*_result.json"))))
+        else:
+            found.append(path)
+    return found
+
+
+def render(paths, unzip_dir=None):
+    """Draw the PDF report of every JSON result, returns {result file: error or None}"""
+    errors = {}
+    for path in find_results(paths):
+        try:
+            result = oracleResult.read_result(path)
+            if unzip_dir is not None:
+                result = oracleResult.relocate(result, unzip_dir)
+            load_oracle(result["oracle"]).render_pdf(result)
+            errors[path] = None
+        except Exception as e:
+            traceback.print_exc()
+            errors[path] = "{}: {}".format(type(e).__name__, e)
+    return errors
+
+
+CSV_COLUMNS = ["bugId", "oracle", "verdict", "seconds", "error", "bug_dir"]
+
+
+def write_csv(records, path):
+    """One row per bug and oracle, the metrics of all oracles as columns"""
+    extra = sorted({key for record in records for key in record} - set(CSV_COLUMNS))
+    order = {name: i for i, name in enumerate(ORACLES)}
+    rows = sorted(records, key=lambda r: (r.get("bug_dir", ""), order.get(r["oracle"], 0)))
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS + extra)
+        writer.writeheader()
+        for record in rows:
+            writer.writerow(record)
+
+
+def run_batch(args):
+    bug_dirs = find_bugs(args.bugs)
+    print("[INFO] {} bug folder(s), oracles {}".format(len(bug_dirs), ",".join(args.oracles)))
+    total = len(bug_dirs) * len(args.oracles)
+    jsonl = open(args.output, "w") if args.output else None
+
+    def on_record(record):
+        if jsonl:
+            jsonl.write(json.dumps(record, default=str) + "\n")
+            jsonl.flush()
+        print(
+            "[INFO] {}/{} {} {}: {}{}".format(
+                on_record.count + 1, total, record["bugId"], record["oracle"], record["verdict"],
+                " ({})".format(record["error"]) if record.get("error") else "",
+            )
+        )
+        on_record.count += 1
+
+    on_record.count = 0
+    try:
+        records = batch(
+            bug_dirs, args.oracles, args.workers, args.timeout, args.appName,
+            args.jobs, args.report, args.log_dir, on_record, args.ingest,
+        )
+    finally:
+        if jsonl:
+            jsonl.close()
+    if args.csv:
+        write_csv(records, args.csv)
+
+    verdicts = Counter((r["oracle"], r["verdict"]) for r in records)
+    for name in args.oracles:
+        counts = ", ".join(
+            "{} {}".format(n, verdict) for (oracle, verdict), n in sorted(verdicts.items()) if oracle == name
+        )
+        print("[INFO] {}: {}".format(name, counts or "no bugs"))
+    return records
+
+
+def load_arguments(argv=None):
+    ap = argparse.ArgumentParser(description="Magneto oracles")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    run_parser = sub.add_parser("run", help="run oracles on one bug report")
+    run_parser.add_argument(
+        "--oracles",
+        type=parse_oracles,
+        default=list(ORACLES),
+        help="comma separated list of oracles: " + ",".join(ORACLES) + " (default all)",
+    )
+    run_parser.add_argument("-a", "--appName", required=True, help="App name")
+    run_parser.add_argument("-b", "--bugId", required=True, help="Bug ID")
+    run_parser.add_argument(
+        "--unzip-dir", required=True, help="Path to the unzipped folder (contains bugId subfolder)"
+    )
+    run_parser.add_argument(
+        "--jobs", type=int, default=None, help="processes per oracle for the screens (default number of cores)"
+    )
+    run_parser.add_argument(
+        "--report", choices=oracleResult.REPORT_CHOICES, default=oracleResult.DEFAULT_REPORT,
+        help="reports written in the bug folder (default pdf)",
+    )
+    run_parser.add_argument(
+        "--ingest", action="store_true", help="pack the screenshots into a memory mapped store first"
+    )
+
+    batch_parser = sub.add_parser("batch", help="run oracles on many bug reports")
+    batch_parser.add_argument(
+        "--bugs", nargs="+", required=True, help="bug folders, globs of bug folders or directories holding them"
+    )
+    batch_parser.add_argument(
+        "--oracles",
+        type=parse_oracles,
+        default=list(ORACLES),
+        help="comma separated list of oracles: " + ",".join(ORACLES) + " (default all)",
+    )
+    batch_parser.add_argument("-a", "--appName", default=None, help="App name (default: from each trace)")
+    batch_parser.add_argument("--workers", type=int, default=None, help="bugs run at a time (default number of cores)")
+    batch_parser.add_argument("--timeout", type=float, default=900, help="seconds per bug, 0 for no limit")
+    batch_parser.add_argument("--jobs", type=int, default=1, help="processes per oracle for the screens")
+    batch_parser.add_argument("--output", default="magneto_results.jsonl", help="JSONL file of the results")
+    batch_parser.add_argument("--csv", default=None, help="also write the results as CSV")
+    batch_parser.add_argument(
+        "--report", choices=oracleResult.REPORT_CHOICES, default="none",
+        help="reports written in the bug folders (default none)",
+    )
+    batch_parser.add_argument("--log-dir", default=None, help="folder for the console output of every bug")
+    batch_parser.add_argument(
+        "--ingest", action="store_true", help="pack the screenshots of every bug into a memory mapped store first"
+    )
+
+    render_parser = sub.add_parser("render", help="draw the PDF reports from JSON results")
+    render_parser.add_argument("results", nargs="+", help="bug folders or *_result.json files")
+    render_parser.add_argument(
+        "--unzip-dir", default=None, help="where the bug folders are now, if moved since the run"
+    )
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = load_arguments(argv)
+    if args.command == "run":
+        records = run(args.oracles, args.appName, args.bugId, args.unzip_dir, args.jobs, args.report, args.ingest)
+        return 1 if any(record["error"] for record in records.values()) else 0
+    if args.command == "batch":
+        records = run_batch(args)
+        return 1 if any(record["error"] for record in records) else 0
+    if args.command == "render":
+        errors = render(args.results, args.unzip_dir)
+        if not errors:
+            print("[INFO] no JSON result found")
+        return 1 if not errors or any(errors.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
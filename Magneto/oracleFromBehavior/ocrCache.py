@@ -0,0 +1,186 @@
+"""
+Persistent cache of OCR results.
+
+The same screenshot is OCR'd by several oracles (and again every time an oracle
+is re-run on a bug report), so the text read from an image is stored in a small
+SQLite file. The key is a hash of the decoded pixels plus every setting that
+changes what tesseract sees (crop, threshold, kernel, engine), so a hit is only
+possible for exactly the same input.
+
+The file is capped in size (MAGNETO_OCR_CACHE_MB, default 256); when it grows
+past the cap the least recently used entries are dropped. A hit only writes its
+use time when the stored one is older than TOUCH_INTERVAL seconds, so parallel
+readers don't wait on the write lock for every hit. Each process keeps a running
+total of the size and reads the real one again every SIZE_CHECK_PUTS writes, so
+the entries written by the other processes are counted too.
+Location is MAGNETO_OCR_CACHE (default ~/.cache/magneto/ocr_cache.sqlite),
+set it to "off" to disable the cache.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "magneto", "ocr_cache.sqlite")
+DEFAULT_SIZE_MB = 256
+# the LRU order is only kept to this many seconds
+TOUCH_INTERVAL = 3600
+# writes between two reads of the total size of the cache
+SIZE_CHECK_PUTS = 64
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def image_key(image, **params):
+    """Hash of the pixel data of image (numpy array) and of the preprocessing params."""
+    image = np.ascontiguousarray(image)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str(image.shape).encode())
+    h.update(str(image.dtype).encode())
+    h.update(image.data)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class OcrCache:
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_SIZE_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._size = None
+        self._puts = 0
+
+    def _connect(self):
+        # a connection can't be shared with a forked child, open a new one there
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ocr ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ocr_last_used ON ocr(last_used)")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+            self._size = None
+        return self._conn
+
+    def get(self, key):
+        """Returns the cached value for key or None."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, last_used FROM ocr WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            if now - row[1] > TOUCH_INTERVAL:
+                conn.execute("UPDATE ocr SET last_used = ? WHERE key = ?", (now, key))
+                conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        data = json.dumps(value)
+        size = len(key) + len(data)
+        with self._lock:
+            conn = self._connect()
+            # the size of the entry it replaces, if any
+            old = conn.execute("SELECT size FROM ocr WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time()),
+            )
+            self._puts += 1
+            if self._size is None or self._puts % SIZE_CHECK_PUTS == 0:
+                # inside the write transaction, the other writers are done
+                self._size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr").fetchone()[0]
+            else:
+                self._size += size - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        """Drop least recently used entries until the cache is at 90% of its cap."""
+        target = int(self.max_bytes * 0.9)
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr").fetchone()[0]
+        for key, size in conn.execute("SELECT key, size FROM ocr ORDER BY last_used").fetchall():
+            if total <= target:
+                break
+            conn.execute("DELETE FROM ocr WHERE key = ?", (key,))
+            total -= size
+        self._size = total
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM ocr")
+            conn.commit()
+            self._size = 0
+
+
+class NoCache:
+    """Used when the cache is turned off, never hits."""
+
+    hits = 0
+
+    def __init__(self):
+        self.misses = 0
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        pass
+
+    def stats(self):
+        return {"hits": 0, "misses": self.misses, "hit_rate": 0.0}
+
+    def clear(self):
+        pass
+
+
+def get_cache():
+    """The process wide cache, configured from the environment on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                path = os.environ.get("MAGNETO_OCR_CACHE", DEFAULT_PATH)
+                if path.lower() in ("off", "0", "none", ""):
+                    _cache = NoCache()
+                else:
+                    size_mb = float(os.environ.get("MAGNETO_OCR_CACHE_MB", DEFAULT_SIZE_MB))
+                    _cache = OcrCache(path, int(size_mb * 1024 * 1024))
+    return _cache
+
+
+def set_cache(cache):
+    global _cache
+    with _cache_lock:
+        _cache = cache
@@ -0,0 +1,191 @@
+"""
+OCR engine for the text blocks cut out by imageUtilities.text_crops.
+
+readTextAfterCrop used to call pytesseract once per contour, one after the other.
+The engine sends all the crops of a screen (or of several screens) to a pool of
+long-lived workers instead, so the tesseract runs overlap.
+
+backends:
+  pytesseract : same call as before on every crop, output is identical (default)
+  tesserocr   : each worker keeps its own tesseract engine loaded, no process spawn per crop
+modes:
+  contour     : one OCR call per crop (default)
+  tiled       : all the crops of a screen are pasted into one page and read with a
+                single image_to_data call, the words are mapped back to their crop.
+                Much fewer tesseract runs, but the layout analysis sees the page so the
+                text can differ slightly from the contour mode.
+
+Settings can be given with MAGNETO_OCR_WORKERS, MAGNETO_OCR_BACKEND and MAGNETO_OCR_MODE.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytesseract
+
+try:
+    # optional, keeps one tesseract engine loaded per worker instead of
+    # spawning the tesseract binary for every crop
+    import tesserocr
+    from PIL import Image
+except ImportError:
+    tesserocr = None
+
+TILE_GAP = 32  # vertical space between two crops in tiled mode
+
+_engine = None
+_tesseract_version = None
+_engine_lock = threading.Lock()
+
+
+class OcrEngine:
+    def __init__(self, workers=None, backend=None, mode=None):
+        if workers is None:
+            workers = int(os.environ.get("MAGNETO_OCR_WORKERS", os.cpu_count() or 1))
+        if backend is None:
+            backend = os.environ.get("MAGNETO_OCR_BACKEND", "pytesseract")
+        if mode is None:
+            mode = os.environ.get("MAGNETO_OCR_MODE", "contour")
+        if backend == "tesserocr" and tesserocr is None:
+            print("tesserocr is not installed, falling back to pytesseract")
+            backend = "pytesseract"
+        if backend not in ("pytesseract", "tesserocr"):
+            raise ValueError("unknown OCR backend " + backend)
+        if mode not in ("contour", "tiled"):
+            raise ValueError("unknown OCR mode " + mode)
+
+        self.workers = max(1, workers)
+        self.backend = backend
+        self.mode = mode
+        self._local = threading.local()
+        self._pool = None
+        self._pool_pid = None
+        if self.workers > 1:
+            # tesseract is already run in parallel here, don't let every run
+            # start its own OpenMP threads on top of that
+            os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+    def cache_params(self):
+        """What, besides the image, decides the text this engine returns"""
+        global _tesseract_version
+        if _tesseract_version is None:
+            try:
+                _tesseract_version = str(pytesseract.get_tesseract_version())
+            except Exception:
+                _tesseract_version = "unknown"
+        return {"backend": self.backend, "mode": self.mode, "tesseract": _tesseract_version}
+
+    def _map(self, fn, items):
+        if self.workers == 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+        if self._pool is None or self._pool_pid != os.getpid():
+            # the threads of a pool don't survive a fork, a forked child needs its own
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="ocr"
+            )
+            self._pool_pid = os.getpid()
+        return list(self._pool.map(fn, items))
+
+    def _api(self):
+        api = getattr(self._local, "api", None)
+        if api is None:
+            api = tesserocr.PyTessBaseAPI()
+            self._local.api = api
+        return api
+
+    def _read_one(self, crop):
+        if self.backend == "tesserocr":
+            api = self._api()
+            api.SetImage(Image.fromarray(crop))
+            return api.GetUTF8Text().strip()
+        return pytesseract.image_to_string(crop).strip()
+
+    def read_crops(self, crops):
+        """Returns the stripped text of every crop, in the same order."""
+        return self.read_batches([crops])[0]
+
+    def read_batches(self, batches):
+        """
+        batches: one list of crops per screen
+        returns: one list of texts per screen, crops of all screens are read together
+        """
+        if self.mode == "tiled":
+            return self._map(self._read_tiled, batches)
+
+        flat = [crop for crops in batches for crop in crops]
+        texts = self._map(self._read_one, flat)
+        result = []
+        start = 0
+        for crops in batches:
+            result.append(texts[start : start + len(crops)])
+            start += len(crops)
+        return result
+
+    def _read_tiled(self, crops):
+        if not crops:
+            return []
+        width = max(c.shape[1] for c in crops)
+        height = sum(c.shape[0] for c in crops) + TILE_GAP * (len(crops) + 1)
+        page = np.empty((height, width), dtype=np.uint8)
+
+        spans = []
+        y = TILE_GAP
+        fill_top = 255
+        for crop in crops:
+            h, w = crop.shape[:2]
+            # pad with the crop's own border colour so the seams don't look like text
+            fill = int(np.median(np.concatenate((crop[0], crop[-1]))))
+            page[y - TILE_GAP : y, :] = (fill_top + fill) // 2
+            page[y : y + h, :] = fill
+            page[y : y + h, :w] = crop
+            spans.append((y, y + h))
+            fill_top = fill
+            y += h + TILE_GAP
+        page[y - TILE_GAP :, :] = fill_top
+
+        data = pytesseract.image_to_data(page, output_type=pytesseract.Output.DICT)
+
+        lines = [dict() for _ in crops]
+        for i, word in enumerate(data["text"]):
+            if not word.strip():
+                continue
+            centre = data["top"][i] + data["height"][i] / 2
+            for n, (top, bottom) in enumerate(spans):
+                if top <= centre < bottom:
+                    key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+                    lines[n].setdefault(key, []).append(word)
+                    break
+        return ["\n".join(" ".join(words) for words in l.values()).strip() for l in lines]
+
+    def close(self):
+        # a pool inherited through fork has no threads to wait for
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.shutdown()
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_engine():
+    """The process wide engine, created on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = OcrEngine()
+    return _engine
+
+
+def set_engine(engine):
+    """Replace the process wide engine, e.g. to change the number of workers."""
+    global _engine
+    with _engine_lock:
+        if _engine is not None and _engine is not engine:
+            _engine.close()
+        _engine = engine
@@ -0,0 +1,108 @@
+"""
+Machine readable result of an oracle run.
+
+Every oracle can write, next to (or instead of) its PDF, a JSON file in the bug
+folder with the verdict and metrics of the run (what summarize() returns), the
+data its PDF is drawn from (details), the events of the run (console lines,
+triggers, metrics and verdicts, see eventLog) and the timings:
+
+    {"oracle": "theme", "bugId": "23", "appName": ..., "unzip_dir": ...,
+     "created": ..., "summary": {"verdict": ..., ...}, "details": ...,
+     "events": [{"t": 0.01, "type": "line", "text": ...}, ...],
+     "timings": {"check": 1.2, "pdf": 3.4}}
+
+What is written is chosen with --report:
+  none : nothing, only the console output
+  json : <name>_result.json
+  pdf  : <name>_report.pdf (default, as before)
+  both : the two of them
+
+The PDF can be drawn later from the JSON, see `magneto.py render`.
+"""
+
+import datetime
+import json
+import os
+import uuid
+
+import numpy as np
+
+REPORT_CHOICES = ("none", "json", "pdf", "both")
+DEFAULT_REPORT = "pdf"
+
+
+def report_mode(args):
+    report = args.get("report") or DEFAULT_REPORT
+    if report not in REPORT_CHOICES:
+        raise ValueError("unknown report {} (choose from {})".format(report, ", ".join(REPORT_CHOICES)))
+    return report
+
+
+def wants_json(report):
+    return report in ("json", "both")
+
+
+def wants_pdf(report):
+    return report in ("pdf", "both")
+
+
+def _to_json(value):
+    """numpy values (delta_E, SSIM...) and sets aren't known to json"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+
+def build_result(oracle, args, summary, details, events, timings):
+    return {
+        "oracle": oracle,
+        "bugId": args["bugId"],
+        "appName": args.get("appName"),
+        "unzip_dir": args["unzip_dir"],
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "summary": summary,
+        "details": details,
+        "events": events,
+        "timings": timings,
+    }
+
+
+def write_result(path, result):
+    """Write the result, a reader never sees a half written file"""
+    # a temporary file of its own, two runs of the same bug can write at once
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), uuid.uuid4().hex[:8])
+    with open(tmp_path, "w") as f:
+        json.dump(result, f, indent=1, default=_to_json)
+    os.replace(tmp_path, path)
+
+
+def read_result(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def relocate(result, unzip_dir):
+    """
+    The result with its bug folder moved to unzip_dir, e.g. to draw the PDF on
+    another machine. The screenshot paths stored in details are moved too.
+    """
+    old = os.path.join(result["unzip_dir"], "")
+    new = os.path.join(unzip_dir, "")
+
+    def move(value):
+        if isinstance(value, str) and value.startswith(old):
+            return new + value[len(old):]
+        if isinstance(value, list):
+            return [move(v) for v in value]
+        if isinstance(value, dict):
+            return {k: move(v) for k, v in value.items()}
+        return value
+
+    moved = dict(result)
+    moved["details"] = move(result["details"])
+    moved["unzip_dir"] = unzip_dir
+    return moved
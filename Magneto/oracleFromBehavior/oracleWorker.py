@@ -0,0 +1,257 @@
+"""
+Long lived oracle service, used by the backend instead of starting
+`poetry run python <oracle>.py` for every request.
+
+    python oracleWorker.py [--host 127.0.0.1] [--port 8765] [--workers N] [--queue N]
+
+The oracles run in a pool of worker processes that import the oracle modules
+(torch, cv2, reportlab...) and load the keyboard model when they start, so a
+request only pays for the analysis.
+
+    POST /run     {"oracle": "theme", "bugId": "23", "appName": "...", "unzipDir": "...",
+                   "report": "pdf" (default) | "json" | "both" | "none",
+                   "manifestDir": <folder for the manifests, see analysisManifest> (optional)}
+                  -> 200 {"success": true, "output": <console output>, "seconds": ...,
+                          "pdf": <path> (pdf, both), "result": <JSON result> (json, both)}
+                  -> 500 {"success": false, "output": ..., "error": <traceback>}
+                  -> 503 when the pool and its queue are full (retry later)
+    GET  /health  -> 200 {"status": "ok", "workers": ..., "running": ..., "capacity": ...}
+
+At most workers + queue jobs are accepted at the same time, the next ones get a 503.
+Settings can also be given with MAGNETO_WORKER_HOST, MAGNETO_WORKER_PORT,
+MAGNETO_WORKER_PROCESSES and MAGNETO_WORKER_QUEUE.
+
+docker-compose.yml runs it as the oracle-worker service (sharing /app/temp with the
+backend) and the Dockerfile starts it next to the backend; the backend finds it with
+MAGNETO_WORKER_URL.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import magneto
+import oracleResult
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+def preload():
+    """Initializer of the worker processes, imports everything a job will need"""
+    for name in magneto.ORACLES:
+        try:
+            magneto.load_oracle(name)
+        except Exception:
+            # reported again (to the client) by the first job of that oracle
+            traceback.print_exc()
+    try:
+        import labelPredictor
+
+        labelPredictor.get_predictor()
+    except Exception:
+        traceback.print_exc()
+
+
+def run_job(oracle, appName, bugId, unzip_dir, report, manifest_dir=None):
+    """Runs in a worker process. Returns (console output, error or None)"""
+    output = io.StringIO()
+    error = None
+    with contextlib.redirect_stdout(output):
+        try:
+            # the pool processes are daemonic and can't start their own workers,
+            # the service already runs several jobs at once
+            args = {
+                "appName": appName, "bugId": bugId, "unzip_dir": unzip_dir, "jobs": 1, "report": report,
+                "manifest_dir": manifest_dir,
+            }
+            magneto.load_oracle(oracle).run(args, magneto.load_trace(unzip_dir, bugId))
+        except Exception:
+            error = traceback.format_exc()
+    return output.getvalue(), error
+
+
+class OracleService:
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._pool = self._new_pool()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=preload)
+
+    def submit(self, oracle, appName, bugId, unzip_dir, report, manifest_dir=None):
+        """
+        Runs the job and waits for it. Returns None when the service is full,
+        else (console output, error or None).
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return None
+        with self._lock:
+            self.running += 1
+        try:
+            pool = self._pool
+            try:
+                output, error = pool.submit(
+                    run_job, oracle, appName, bugId, unzip_dir, report, manifest_dir
+                ).result()
+            except BrokenProcessPool:
+                # a worker died (e.g. killed for memory), start a new pool for the next jobs
+                with self._lock:
+                    if self._pool is pool:
+                        self._pool = self._new_pool()
+                output, error = "", "worker process died while running the oracle"
+            with self._lock:
+                if error:
+                    self.failed += 1
+                else:
+                    self.done += 1
+            return output, error
+        finally:
+            with self._lock:
+                self.running -= 1
+            self._slots.release()
+
+    def health(self):
+        with self._lock:
+            return {
+                "status": "ok",
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "running": self.running,
+                "done": self.done,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+    def close(self):
+        self._pool.shutdown()
+
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 503:
+            self.send_header("Retry-After", "5")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, self.service.health())
+        else:
+            self._reply(404, {"success": False, "error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/run":
+            self._reply(404, {"success": False, "error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length) or b"{}")
+            oracle = job["oracle"]
+            bugId = str(job["bugId"])
+            unzip_dir = job["unzipDir"]
+            appName = job.get("appName", "")
+            report = job.get("report", oracleResult.DEFAULT_REPORT)
+            manifest_dir = job.get("manifestDir")
+        except (ValueError, KeyError) as e:
+            self._reply(400, {"success": False, "error": "bad request: {}".format(e)})
+            return
+        if oracle not in magneto.ORACLES:
+            self._reply(400, {"success": False, "error": "unknown oracle " + oracle})
+            return
+        if report not in oracleResult.REPORT_CHOICES:
+            self._reply(400, {"success": False, "error": "unknown report " + str(report)})
+            return
+
+        start = time.perf_counter()
+        result = self.service.submit(oracle, appName, bugId, unzip_dir, report, manifest_dir)
+        if result is None:
+            self._reply(503, {"success": False, "error": "busy, too many jobs queued"})
+            return
+        output, error = result
+        body = {"success": error is None, "output": output, "seconds": time.perf_counter() - start}
+        if error is None:
+            if oracleResult.wants_pdf(report):
+                body["pdf"] = magneto.report_path(oracle, unzip_dir, bugId)
+            if oracleResult.wants_json(report):
+                try:
+                    body["result"] = oracleResult.read_result(magneto.result_path(oracle, unzip_dir, bugId))
+                except (OSError, ValueError):
+                    # e.g. the back button oracle found no steps in the trace
+                    body["result"] = None
+            self._reply(200, body)
+        else:
+            body["error"] = error
+            self._reply(500, body)
+
+    def log_message(self, format, *args):
+        sys.stderr.write("[WORKER] %s - %s\n" % (self.address_string(), format % args))
+
+
+def load_arguments(argv=None):
+    ap = argparse.ArgumentParser(description="Magneto oracle worker service")
+    ap.add_argument("--host", default=os.environ.get("MAGNETO_WORKER_HOST", DEFAULT_HOST))
+    ap.add_argument(
+        "--port", type=int, default=int(os.environ.get("MAGNETO_WORKER_PORT", DEFAULT_PORT))
+    )
+    ap.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("MAGNETO_WORKER_PROCESSES", min(4, os.cpu_count() or 1))),
+        help="number of worker processes",
+    )
+    ap.add_argument(
+        "--queue",
+        type=int,
+        default=os.environ.get("MAGNETO_WORKER_QUEUE"),
+        help="jobs waiting for a worker before new ones are refused (default 2 * workers)",
+    )
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = load_arguments(argv)
+    queue_size = int(args.queue) if args.queue is not None else 2 * args.workers
+    service = OracleService(max(1, args.workers), max(0, queue_size))
+    Handler.service = service
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(
+        "[WORKER] listening on http://{}:{} with {} worker(s), capacity {}".format(
+            args.host, args.port, service.workers, service.capacity
+        )
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Screenshots in the PDF reports.
+
+The reports used to call c.drawImage(<screenshot.png>, ..., width=200, height=200),
+so reportlab embedded every 1080x1920 PNG at full resolution and a report with a
+few screens was many MB. draw_image shrinks the screenshot once to the size it is
+shown at (REPORT_DPI) and embeds it as a JPEG (JPEG_QUALITY), which reportlab
+copies into the PDF as is.
+
+The thumbnails are named after the content of the screenshot, so a screenshot
+drawn twice, or the same screen saved under two names, is one image object in
+the PDF: reportlab registers an image file once per document and draws it again
+by reference. They are kept in a temporary folder for the life of the process,
+so the reports of several oracles on the same bug share them.
+
+draw_console draws the console output of a run (see eventLog) wrapped to the
+page width, measuring every distinct word once.
+
+Settings can be given with MAGNETO_REPORT_DPI and MAGNETO_REPORT_JPEG_QUALITY.
+"""
+
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import cv2
+
+REPORT_DPI = int(os.environ.get("MAGNETO_REPORT_DPI", 150))
+JPEG_QUALITY = int(os.environ.get("MAGNETO_REPORT_JPEG_QUALITY", 75))
+
+_thumbnail_dir = None
+_thumbnails = {}  # (content hash, width px, height px, quality) -> thumbnail path
+_digests = {}  # (path, mtime, size) -> content hash
+_lock = threading.Lock()
+
+
+def _get_thumbnail_dir():
+    global _thumbnail_dir
+    if _thumbnail_dir is None or not os.path.isdir(_thumbnail_dir):
+        _thumbnail_dir = tempfile.mkdtemp(prefix="magneto_thumbnails_")
+        atexit.register(shutil.rmtree, _thumbnail_dir, True)
+    return _thumbnail_dir
+
+
+def _digest(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in _digests:
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def thumbnail(path, width, height, dpi=None, quality=None):
+    """
+    JPEG of the image at path, no larger than needed to show it in a width x
+    height box (points) at dpi. Returns None if the image can't be read.
+    """
+    if dpi is None:
+        dpi = REPORT_DPI
+    if quality is None:
+        quality = JPEG_QUALITY
+    box_w = max(1, int(round(width * dpi / 72.0)))
+    box_h = max(1, int(round(height * dpi / 72.0)))
+
+    with _lock:
+        try:
+            digest = _digest(path)
+        except OSError:
+            return None
+        key = (digest, box_w, box_h, quality)
+        if key in _thumbnails and os.path.exists(_thumbnails[key]):
+            return _thumbnails[key]
+
+        img = cv2.imread(path)
+        if img is None:
+            return None
+        h, w = img.shape[:2]
+        scale = min(1.0, box_w / w, box_h / h)
+        if scale < 1.0:
+            size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+        thumb_path = os.path.join(_get_thumbnail_dir(), "{}_{}x{}_q{}.jpg".format(*key))
+        if not cv2.imwrite(thumb_path, img, [cv2.IMWRITE_JPEG_QUALITY, quality]):
+            return None
+        _thumbnails[key] = thumb_path
+        return thumb_path
+
+
+def draw_image(c, path, x, y, width, height, preserveAspectRatio=True, **kwargs):
+    """c.drawImage(path, ...) with a thumbnail of the screenshot"""
+    thumb_path = thumbnail(path, width, height)
+    # reportlab may still read what cv2 can't, draw the original then
+    c.drawImage(
+        thumb_path or path, x, y, width=width, height=height,
+        preserveAspectRatio=preserveAspectRatio, **kwargs
+    )
+
+
+def draw_console(c, lines, x, y, max_width, top, font="Helvetica", font_size=10, line_height=12, bottom=60):
+    """
+    Draw the console lines wrapped to max_width, starting a new page (at top)
+    when y goes below bottom. Returns the new y.
+    """
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+
+    widths = {}
+    space = stringWidth(" ", font, font_size)
+
+    def width(word):
+        if word not in widths:
+            widths[word] = stringWidth(word, font, font_size)
+        return widths[word]
+
+    c.setFont(font, font_size)
+    for line in lines:
+        current = []
+        current_width = 0
+        for word in line.split():
+            word_width = width(word)
+            if current and current_width + space + word_width > max_width:
+                c.drawString(x, y, " ".join(current))
+                y -= line_height
+                current = []
+            current_width = current_width + space + word_width if current else word_width
+            current.append(word)
+        if current:
+            c.drawString(x, y, " ".join(current))
+            y -= line_height
+        if y < bottom:
+            c.showPage()
+            c.setFont(font, font_size)
+            y = top
+    return y
@@ -0,0 +1,199 @@
+"""
+Groups the screenshots of a trace that show the same screen.
+
+Recorded traces often come back to a screen (back and forth navigation, idle
+steps) and the oracles ran the keyboard classifier, KMeans and the OCR again on
+every occurrence. Before the per screen analysis the screens an oracle looks at
+are grouped here:
+
+    groups = screenDedup.group_screens(paths)
+    labels = groups.fan_out(paths, classify)  # classify(representatives)
+
+Every screenshot gets a difference hash (dHash, HASH_SIZE x HASH_SIZE bits of a
+downscaled gray image), screens with the same hash are candidates for a group.
+With MAGNETO_DEDUP_DISTANCE=0 (default) a candidate only joins a group when its
+pixels are the same as the ones of the group's first screen, so the results are
+exactly the ones computed screen by screen. With a distance > 0 the screens whose
+hashes differ by at most that many bits are grouped too (near identical screens:
+a blinking cursor, the clock of the status bar), their results are the ones of
+the first screen of the group.
+
+group_screens prints and records (eventLog metric "dedup_ratio") how many screens
+were analysed for how many distinct ones.
+
+    python screenDedup.py [bug folders...]
+
+prints the groups of the screenshots of the checked-in traces.
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import eventLog
+import imageUtilities as imgUtil
+
+HASH_SIZE = 8
+DEDUP_DISTANCE = int(os.environ.get("MAGNETO_DEDUP_DISTANCE", 0))
+
+
+def _dhash(gray, hash_size):
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def dhash(screen, hash_size=HASH_SIZE):
+    """dHash (int of hash_size**2 bits) of a screenshot path or ScreenImage, None if it can't be read"""
+    screen = imgUtil.as_screen(screen)
+    return screen.view(
+        "dhash_{}".format(hash_size), lambda s: None if s.bgr is None else _dhash(s.gray, hash_size)
+    )
+
+
+def pixel_digest(screen):
+    """Hash of the decoded pixels of a screenshot path or ScreenImage, None if it can't be read"""
+    screen = imgUtil.as_screen(screen)
+
+    def digest(s):
+        if s.bgr is None:
+            return None
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str(s.bgr.shape).encode())
+        h.update(np.ascontiguousarray(s.bgr).data)
+        return h.hexdigest()
+
+    return screen.view("pixel_digest", digest)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ScreenGroups:
+    def __init__(self, paths, distance=None):
+        self.distance = DEDUP_DISTANCE if distance is None else distance
+        self.groups = OrderedDict()  # first screen of the group -> screens of the group
+        self._representative = {}
+        self._hashes = {}  # first screen of a group -> its dHash
+        for path in paths:
+            self.add(path)
+
+    def _same_screen(self, path, representative):
+        if self.distance > 0:
+            return hamming(self._hashes[representative], dhash(path)) <= self.distance
+        return pixel_digest(path) == pixel_digest(representative)
+
+    def add(self, path):
+        """Put path in the group of a screen it shows the same as, or in a new group"""
+        if path in self._representative:
+            return self._representative[path]
+        try:
+            h = dhash(path)
+        except Exception:
+            h = None
+        representative = path
+        if h is not None:
+            for other, other_hash in self._hashes.items():
+                if self.distance == 0 and other_hash != h:
+                    continue
+                if self._same_screen(path, other):
+                    representative = other
+                    break
+            else:
+                self._hashes[path] = h
+        self._representative[path] = representative
+        self.groups.setdefault(representative, []).append(path)
+        return representative
+
+    def representative(self, path):
+        """The screen the results of path are computed on"""
+        return self._representative.get(path, path)
+
+    def fan_out(self, paths, compute_many):
+        """
+        Results of paths, compute_many(representatives) being called once with the
+        distinct representatives of paths and returning their results in order.
+        """
+        representatives = [self.representative(p) for p in paths]
+        distinct = list(dict.fromkeys(representatives))
+        results = dict(zip(distinct, compute_many(distinct) if distinct else []))
+        return [results[r] for r in representatives]
+
+    @property
+    def screens(self):
+        return len(self._representative)
+
+    @property
+    def ratio(self):
+        """screens / distinct screens, 1.0 when nothing was grouped"""
+        return self.screens / len(self.groups) if self.groups else 1.0
+
+    def stats(self):
+        return {
+            "screens": self.screens,
+            "distinct": len(self.groups),
+            "ratio": self.ratio,
+            "distance": self.distance,
+        }
+
+    def report(self):
+        stats = self.stats()
+        print(
+            "[INFO] screen dedup: {screens} screens, {distinct} distinct (ratio {ratio:.2f})".format(**stats)
+        )
+        eventLog.emit("metric", name="dedup_ratio", value=stats["ratio"], **{k: stats[k] for k in ("screens", "distinct")})
+
+
+def group_screens(paths, distance=None):
+    """ScreenGroups of the screenshots at paths, its dedup ratio reported"""
+    groups = ScreenGroups(paths, distance)
+    groups.report()
+    return groups
+
+
+def bug_screenshots(bug_dir):
+    """The screenshots of a bug folder, without the ones marked by the recorder"""
+    return sorted(
+        path for path in glob.glob(os.path.join(bug_dir, "*.png"))
+        if not path.endswith(("_augmented.png", "_gui.png"))
+    )
+
+
+def load_arguments(argv=None):
+    ap = argparse.ArgumentParser(description="Groups of the same screens in the screenshots of traces")
+    ap.add_argument("bug_dirs", nargs="*", help="bug folders (default: the checked-in ones)")
+    ap.add_argument("--distance", type=int, default=None, help="dHash bits that may differ (default 0, same pixels)")
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = load_arguments(argv)
+    bug_dirs = args.bug_dirs
+    if not bug_dirs:
+        here = os.path.dirname(os.path.abspath(__file__))
+        bug_dirs = sorted(
+            os.path.dirname(p) for p in glob.glob(os.path.join(here, "*", "*", "Execution-*.json"))
+        )
+    for bug_dir in bug_dirs:
+        start = time.perf_counter()
+        groups = ScreenGroups(bug_screenshots(bug_dir), args.distance)
+        seconds = time.perf_counter() - start
+        print(
+            "{}: {screens} screens, {distinct} distinct, ratio {ratio:.2f} ({:.0f} ms)".format(
+                bug_dir, 1000 * seconds, **groups.stats()
+            )
+        )
+        for members in groups.groups.values():
+            if len(members) > 1:
+                print("   ", ", ".join(os.path.basename(m) for m in members))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Similarity of the text of two screens (the texts of their XML dump, or OCR lines).
+
+The theme oracle looked for the screen shown after a theme change by sorting the
+XML text of every later screen and running difflib.SequenceMatcher against the
+sorted text of the trigger screen, one step at a time, until the ratio reached
+0.90. On sorted lists that ratio is the multiset Dice coefficient of the two
+texts, 2 |A & B| / (|A| + |B|) (1.0 for two screens without text), which is what
+is computed here from counts, without sorting or matching sequences:
+
+    a, b = ScreenText(texts_a), ScreenText(texts_b)
+    dice(a, b), jaccard(a, b), containment(a, b)
+
+Every text (one string of the screen) is a token, hashed once (token_hash) and
+counted, so a screen is a multiset of 64 bit ints.
+
+SimilarityIndex is built once per trace from the ScreenText of its screens, by
+position, with an inverted index token -> screens. first_similar(query, start,
+threshold) returns the first screen from start whose similarity with the query is
+at least threshold, only looking at the screens that share a token with it.
+
+With num_perm, every screen also gets a MinHash signature of num_perm values
+(estimated_jaccard) and the index groups the screens by bands of it (locality
+sensitive hashing, MINHASH_BANDS bands). first_similar(..., approximate=True)
+then only scores the screens that share a band with the query, which can miss
+some but doesn't depend on how common the tokens are.
+"""
+
+import hashlib
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+import numpy as np
+
+MINHASH_SEED = 0
+MINHASH_BANDS = 16
+_MERSENNE = (1 << 61) - 1
+_MASK32 = (1 << 32) - 1
+
+
+def token_hash(text):
+    """64 bit hash of a text, the same in every process"""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "big")
+
+
+def _permutations(num_perm):
+    rng = np.random.default_rng(MINHASH_SEED)
+    # a * x + b stays below 2**64 for x < 2**32
+    a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash(counts, num_perm):
+    """MinHash signature (num_perm,) of a multiset of token hashes, every occurrence is an element"""
+    a, b = _permutations(num_perm)
+    if not counts:
+        return np.full(num_perm, _MERSENNE, dtype=np.uint64)
+    elements = []
+    for token, count in counts.items():
+        for k in range(count):
+            x = (token + k * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            elements.append((x ^ (x >> 32)) & _MASK32)
+    x = np.array(elements, dtype=np.uint64)[:, None]
+    return ((a * x + b) % np.uint64(_MERSENNE)).min(0)
+
+
+class ScreenText:
+    __slots__ = ("counts", "size", "signature")
+
+    def __init__(self, texts, num_perm=None):
+        """texts: the strings of the screen, None for a screen without text"""
+        self.counts = Counter(token_hash(t) for t in texts or ())
+        self.size = sum(self.counts.values())
+        self.signature = minhash(self.counts, num_perm) if num_perm else None
+
+
+def overlap(a, b):
+    """|A & B| of the two multisets"""
+    if len(a.counts) > len(b.counts):
+        a, b = b, a
+    return sum(min(count, b.counts.get(token, 0)) for token, count in a.counts.items())
+
+
+def _dice(common, size_a, size_b):
+    total = size_a + size_b
+    return 2.0 * common / total if total else 1.0
+
+
+def _jaccard(common, size_a, size_b):
+    union = size_a + size_b - common
+    return common / union if union else 1.0
+
+
+def _containment(common, size_a, size_b):
+    return common / size_a if size_a else 1.0
+
+
+MEASURES = {"dice": _dice, "jaccard": _jaccard, "containment": _containment}
+
+
+def dice(a, b):
+    """2 |A & B| / (|A| + |B|), difflib's ratio of the sorted texts"""
+    return _dice(overlap(a, b), a.size, b.size)
+
+
+def jaccard(a, b):
+    """|A & B| / |A | B|"""
+    return _jaccard(overlap(a, b), a.size, b.size)
+
+
+def containment(a, b):
+    """|A & B| / |A|, how much of the text of a is in b"""
+    return _containment(overlap(a, b), a.size, b.size)
+
+
+def estimated_jaccard(a, b):
+    """jaccard(a, b) estimated from the MinHash signatures"""
+    return float(np.mean(a.signature == b.signature))
+
+
+class SimilarityIndex:
+    def __init__(self, screens, num_perm=None):
+        """screens: {position: texts or ScreenText} of the screens of a trace"""
+        self.screens = {}
+        self.positions = []
+        self._postings = defaultdict(list)  # token -> [(position, count)], by position
+        self._empty = []
+        self._bands = defaultdict(list)  # (band, values) -> [position]
+        self.num_perm = num_perm
+        for position in sorted(screens):
+            screen = screens[position]
+            if not isinstance(screen, ScreenText):
+                screen = ScreenText(screen, num_perm)
+            self.screens[position] = screen
+            self.positions.append(position)
+            if not screen.size:
+                self._empty.append(position)
+            for token, count in screen.counts.items():
+                self._postings[token].append((position, count))
+            if num_perm:
+                for band in self._band_keys(screen):
+                    self._bands[band].append(position)
+
+    def _band_keys(self, screen):
+        rows = max(1, len(screen.signature) // MINHASH_BANDS)
+        return [
+            (start, screen.signature[start : start + rows].tobytes())
+            for start in range(0, len(screen.signature), rows)
+        ]
+
+    def _common(self, query, start):
+        """{position: |query & screen|} of the screens from start sharing a token with the query"""
+        common = defaultdict(int)
+        for token, count in query.counts.items():
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            for position, screen_count in postings[bisect_left(postings, (start,)) :]:
+                common[position] += min(count, screen_count)
+        return common
+
+    def _candidates(self, query, start):
+        """like _common for the screens from start sharing a MinHash band with the query"""
+        if query.signature is None:
+            query.signature = minhash(query.counts, self.num_perm)
+        found = set()
+        for band in self._band_keys(query):
+            found.update(p for p in self._bands.get(band, ()) if p >= start)
+        return {p: overlap(query, self.screens[p]) for p in found}
+
+    def first_similar(self, query, start=0, threshold=0.9, measure="dice", approximate=False):
+        """
+        Position of the first screen from start whose similarity with query
+        (texts or ScreenText) is at least threshold, None if there is none.
+        measure: dice, jaccard or containment (of the query in the screen).
+        """
+        if not isinstance(query, ScreenText):
+            query = ScreenText(query, self.num_perm if approximate else None)
+        score = MEASURES[measure]
+        if threshold <= 0:
+            i = bisect_left(self.positions, start)
+            return self.positions[i] if i < len(self.positions) else None
+
+        if not query.size:
+            # nothing in common with any screen: only the screens without text are
+            # like it, unless the measure is the containment of the query
+            positions = self.positions if score(0, 0, 1) >= threshold else self._empty
+            i = bisect_left(positions, start)
+            return positions[i] if i < len(positions) else None
+
+        if approximate and self.num_perm:
+            common = self._candidates(query, start)
+        else:
+            common = self._common(query, start)
+        for position in sorted(common):
+            if score(common[position], query.size, self.screens[position].size) >= threshold:
+                return position
+        return None
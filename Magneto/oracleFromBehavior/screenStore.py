@@ -0,0 +1,252 @@
+"""
+Packed, memory mapped store of the screenshots of a bug folder.
+
+Every oracle, and every run of it, decoded the PNG screenshots of the trace again
+with cv2.imread, and each worker process kept its own decoded copy. ingest packs
+the decoded screenshots of a bug folder once into a single uint8 file:
+
+    python screenStore.py ingest [bug folders...]
+
+  - screen_store.<token>.u8: for every *.png of the folder its pixels as read by
+    cv2.imread ("bgr") and the gray image the oracles use ("gray"), each array at
+    an offset aligned on ALIGNMENT bytes,
+  - screen_store.json: the index, per screenshot the size and the digest of the
+    PNG it was ingested from, {view: [offset, shape]} of its arrays and its dHash
+    (screenDedup).
+
+The pixels are kept at the size of the PNG so the oracles compute exactly what
+they did from the PNG; for the 1080x1920 screenshots the "normalized" view is the
+stored array itself, for the other sizes it is resized from it on demand.
+
+imageUtilities.open_screen fills the views of a ScreenImage from the store when
+the PNG didn't change since it was ingested (same digest, hashing the file is
+much cheaper than decoding it): they are read only, zero copy slices
+of np.memmap, not counted in MAGNETO_IMAGE_BUDGET_MB. The file is mapped once per
+process and every process (the oracle workers, parallel runs, the next run) reads
+the same pages of the page cache instead of decoding its own copy.
+
+The store is written in the bug folder, or when MAGNETO_SCREEN_STORE is set in
+a folder of it named after the bugId and a hash of the absolute path of the bug
+folder, two bug folders with the same bugId have their own stores ("off" turns
+the store off). The index is replaced last, so a reader sees the
+old store or the new one, never a partial one. Without a store, or for the files
+that changed, the screenshots are decoded from the PNG as before.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+import cv2
+import numpy as np
+
+from analysisManifest import file_digest
+
+STORE_VERSION = 2
+ALIGNMENT = 64
+INDEX_NAME = "screen_store.json"
+DATA_PATTERN = "screen_store.*.u8"
+
+_stores = {}  # index path -> (mtime of the index, ScreenStore or None)
+_stores_lock = threading.Lock()
+
+
+def store_dir(bug_dir):
+    """Folder of the store of a bug folder, None if the store is turned off"""
+    setting = os.environ.get("MAGNETO_SCREEN_STORE", "")
+    if setting.lower() in ("off", "0", "none"):
+        return None
+    if setting:
+        bug_dir = os.path.abspath(bug_dir)
+        digest = hashlib.blake2b(bug_dir.encode("utf-8", "surrogateescape"), digest_size=8).hexdigest()
+        return os.path.join(setting, "{}-{}".format(os.path.basename(bug_dir), digest))
+    return bug_dir
+
+
+class ScreenStore:
+    def __init__(self, directory, index):
+        self.directory = directory
+        self.data_path = os.path.join(directory, index["data"])
+        self.files = index["files"]
+        if os.path.getsize(self.data_path):
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+        else:
+            # np.memmap can't map an empty file
+            self._data = np.zeros(0, dtype=np.uint8)
+
+    def is_current(self, path):
+        """True if the screenshot at path is in the store and didn't change since"""
+        entry = self.files.get(os.path.basename(path))
+        if entry is None:
+            return False
+        try:
+            # the size first, it rules out most changed files without reading them
+            return entry["size"] == os.path.getsize(path) and entry["digest"] == file_digest(path)
+        except OSError:
+            return False
+
+    def views(self, path):
+        """{view name: read only array or value} of the screenshot at path, {} if not current"""
+        if not self.is_current(path):
+            return {}
+        entry = self.files[os.path.basename(path)]
+        views = {}
+        for name, (offset, shape) in entry["arrays"].items():
+            size = int(np.prod(shape))
+            if offset < 0 or offset + size > len(self._data):
+                # truncated data file
+                return {}
+            views[name] = self._data[offset : offset + size].reshape(shape)
+        views.update(entry.get("values", {}))
+        return views
+
+
+def open_store(bug_dir):
+    """The ScreenStore of a bug folder, opened once per process, None if it has none"""
+    directory = store_dir(bug_dir)
+    if directory is None:
+        return None
+    index_path = os.path.join(directory, INDEX_NAME)
+    try:
+        stamp = os.stat(index_path).st_mtime_ns
+    except OSError:
+        return None
+    with _stores_lock:
+        cached = _stores.get(index_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        store = None
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if index.get("version") == STORE_VERSION:
+                store = ScreenStore(directory, index)
+        except (OSError, ValueError, KeyError) as e:
+            print("[WARNING] screen store of {} not used: {}".format(bug_dir, e))
+        _stores[index_path] = (stamp, store)
+        return store
+
+
+def views(path):
+    """Stored views of the screenshot at path, {} if its bug folder has no current store"""
+    store = open_store(os.path.dirname(os.path.abspath(path)))
+    if store is None:
+        return {}
+    return store.views(path)
+
+
+def _write_array(f, offset, array):
+    """Writes array at the next aligned offset, returns (its offset, the offset after it)"""
+    padding = -offset % ALIGNMENT
+    f.write(b"\0" * padding)
+    offset += padding
+    f.write(np.ascontiguousarray(array).tobytes())
+    return offset, offset + array.nbytes
+
+
+def ingest(bug_dir, force=False):
+    """
+    Write the store of the screenshots (*.png) of a bug folder, unless it is
+    already up to date. Returns the ScreenStore, None if the store is turned off.
+    """
+    # imported here, imageUtilities imports this module
+    import imageUtilities as imgUtil
+    import screenDedup
+
+    directory = store_dir(bug_dir)
+    if directory is None:
+        return None
+    names = sorted(os.path.basename(p) for p in glob.glob(os.path.join(bug_dir, "*.png")))
+    store = open_store(bug_dir)
+    if (
+        store is not None
+        and not force
+        and set(store.files) == set(names)
+        and all(store.is_current(os.path.join(bug_dir, name)) for name in names)
+    ):
+        return store
+
+    os.makedirs(directory, exist_ok=True)
+    data_name = "screen_store.{}.u8".format(uuid.uuid4().hex[:12])
+    data_path = os.path.join(directory, data_name)
+    files = {}
+    offset = 0
+    try:
+        with open(data_path, "wb") as f:
+            for name in names:
+                path = os.path.join(bug_dir, name)
+                # hashed first, a file changed while it is read is read again next time
+                digest = file_digest(path)
+                entry = {"size": os.path.getsize(path), "digest": digest, "arrays": {}, "values": {}}
+                files[name] = entry
+                bgr = cv2.imread(path)
+                if bgr is None:
+                    # what cv2.imread returns, not read again
+                    entry["values"]["bgr"] = None
+                    continue
+                screen = imgUtil.ScreenImage(path, image=bgr)
+                for view in ("bgr", "gray"):
+                    array = screen.bgr if view == "bgr" else screen.gray
+                    start, offset = _write_array(f, offset, array)
+                    entry["arrays"][view] = [start, list(array.shape)]
+                entry["values"]["dhash_{}".format(screenDedup.HASH_SIZE)] = screenDedup.dhash(screen)
+
+        index_path = os.path.join(directory, INDEX_NAME)
+        tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"version": STORE_VERSION, "data": data_name, "files": files}, f)
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        if os.path.exists(data_path):
+            os.remove(data_path)
+        raise
+
+    # the data files of the previous stores, the processes that mapped them keep their pages
+    for old in glob.glob(os.path.join(directory, DATA_PATTERN)):
+        if os.path.basename(old) != data_name:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    return open_store(bug_dir)
+
+
+def load_arguments(argv=None):
+    ap = argparse.ArgumentParser(description="Memory mapped store of the screenshots of bug folders")
+    sub = ap.add_subparsers(dest="command", required=True)
+    ingest_parser = sub.add_parser("ingest", help="pack the screenshots of bug folders")
+    ingest_parser.add_argument("bug_dirs", nargs="*", help="bug folders (default: the checked-in ones)")
+    ingest_parser.add_argument("--force", action="store_true", help="write the store even if up to date")
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = load_arguments(argv)
+    if args.command == "ingest":
+        bug_dirs = args.bug_dirs
+        if not bug_dirs:
+            here = os.path.dirname(os.path.abspath(__file__))
+            bug_dirs = sorted(
+                os.path.dirname(p) for p in glob.glob(os.path.join(here, "*", "*", "Execution-*.json"))
+            )
+        for bug_dir in bug_dirs:
+            start = time.perf_counter()
+            store = ingest(bug_dir, args.force)
+            seconds = time.perf_counter() - start
+            if store is None:
+                print("{}: screen store turned off".format(bug_dir))
+                continue
+            print(
+                "{}: {} screenshots, {:.1f} MB ({:.0f} ms)".format(
+                    bug_dir, len(store.files), os.path.getsize(store.data_path) / 1e6, 1000 * seconds
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
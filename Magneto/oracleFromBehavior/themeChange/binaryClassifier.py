@@ -50,6 +50,131 @@ class Net(nn.Module):
         return x
 
 
+# input of LiteNet, the keyboard crop in gray scale
+LITE_INPUT_SIZE = 112
+
+lite_transform = transforms.Compose([
+        transforms.Grayscale(1),
+        transforms.Resize((LITE_INPUT_SIZE, LITE_INPUT_SIZE)),
+        transforms.ToTensor()
+    ])
+
+
+class LiteNet(nn.Module):
+    """
+    Small keyboard detector, ~25k parameters instead of ~23M for Net.
+    Strided convolutions then global average pooling, so there is no big dense layer.
+    Takes 1*112*112 gray scale crops, same outputs as Net (log probabilities of typing, noTyping).
+    Experimental, no trained weights are shipped (see main_lite).
+    """
+    def __init__(self):
+        super(LiteNet, self).__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(1, 8, 3, stride=2, padding=1),
+            nn.BatchNorm2d(8),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(8, 16, 3, stride=2, padding=1),
+            nn.BatchNorm2d(16),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(16, 32, 3, stride=2, padding=1),
+            nn.BatchNorm2d(32),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(32, 64, 3, stride=2, padding=1),
+            nn.BatchNorm2d(64),
+            nn.ReLU(inplace=True),
+        )
+        self.pool = nn.AdaptiveAvgPool2d(1)
+        self.dropout = nn.Dropout(0.2)
+        self.fc = nn.Linear(64, 2)
+        self.softmax = nn.LogSoftmax(dim=1)
+
+    def forward(self, x):
+        x = self.pool(self.features(x))
+        x = self.dropout(torch.flatten(x, 1))
+        x = self.softmax(self.fc(x))
+        return x
+
+
+def main_lite(n_epochs=15, batch_size=32, output="model_keyboard_lite.pt"):
+    """
+    Train LiteNet on the same data as main (data/typing, data/noTyping in the
+    current directory) and save the weights with the lowest validation loss.
+    """
+    test_size = 0.3
+    valid_size = 0.1
+
+    dataDir = os.path.join(os.getcwd(), "data")
+    data = datasets.ImageFolder(dataDir, transform=lite_transform)
+
+    indices_data = list(range(len(data)))
+    np.random.shuffle(indices_data)
+    split_tt = int(np.floor(test_size * len(data)))
+    train_idx, test_idx = indices_data[split_tt:], indices_data[:split_tt]
+    split_tv = int(np.floor(valid_size * len(train_idx)))
+    train_new_idx, valid_idx = train_idx[split_tv:], train_idx[:split_tv]
+
+    train_loader = torch.utils.data.DataLoader(data, batch_size=batch_size,
+        sampler=SubsetRandomSampler(train_new_idx), num_workers=1)
+    valid_loader = torch.utils.data.DataLoader(data, batch_size=batch_size,
+        sampler=SubsetRandomSampler(valid_idx), num_workers=1)
+    test_loader = torch.utils.data.DataLoader(data, batch_size=batch_size,
+        sampler=SubsetRandomSampler(test_idx), num_workers=1)
+
+    model = LiteNet()
+    if train_on_gpu:
+        model.cuda()
+    # the model outputs log probabilities
+    criterion = nn.NLLLoss()
+    optimizer = optim.Adam(model.parameters(), lr=0.001)
+
+    valid_loss_min = np.inf
+    for epoch in range(1, n_epochs+1):
+        train_loss = 0.0
+        valid_loss = 0.0
+
+        model.train()
+        for images, target in train_loader:
+            if train_on_gpu:
+                images, target = images.cuda(), target.cuda()
+            optimizer.zero_grad()
+            loss = criterion(model(images), target)
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item()*images.size(0)
+
+        model.eval()
+        with torch.no_grad():
+            for images, target in valid_loader:
+                if train_on_gpu:
+                    images, target = images.cuda(), target.cuda()
+                loss = criterion(model(images), target)
+                valid_loss += loss.item()*images.size(0)
+
+        train_loss = train_loss/len(train_new_idx)
+        valid_loss = valid_loss/max(len(valid_idx), 1)
+        print('Epoch: {} \tTraining Loss: {:.6f} \tValidation Loss: {:.6f}'.format(
+            epoch, train_loss, valid_loss))
+
+        if valid_loss <= valid_loss_min:
+            print('Validation loss decreased ({:.6f} --> {:.6f}).  Saving model ...'.format(
+            valid_loss_min, valid_loss))
+            torch.save(model.state_dict(), output)
+            valid_loss_min = valid_loss
+
+    # test the best model
+    model.load_state_dict(torch.load(output))
+    model.eval()
+    pred_list = []
+    true_list = []
+    with torch.no_grad():
+        for images, target in test_loader:
+            if train_on_gpu:
+                images = images.cuda()
+            pred_list.extend(model(images).argmax(dim=1).cpu().numpy())
+            true_list.extend(target.numpy())
+    print(classification_report(true_list, pred_list, target_names=data.classes))
+
+
 
 def main():
 
@@ -281,4 +406,8 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    # python binaryClassifier.py lite  trains LiteNet instead of Net
+    if len(sys.argv) > 1 and sys.argv[1] == "lite":
+        main_lite()
+    else:
+        main()
@@ -8,42 +8,18 @@ warnings.filterwarnings("ignore", message="Failed to load image Python extension
 import json
 import os
 import sys
-import difflib
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.platypus import Table, TableStyle
 from reportlab.lib import colors
-from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.platypus import Paragraph
 from reportlab.lib.styles import getSampleStyleSheet    
 
-import io
 
-# ------------------ DUO LOGGING SETUP ------------------
-class MultiLogger:
-    """
-    Sends all 'print' output to both the real console and an in-memory buffer (for PDF).
-    """
-    def __init__(self, *outputs):
-        self.outputs = outputs
-
-    def write(self, message):
-        for output in self.outputs:
-            output.write(message)
-            output.flush()
-
-    def flush(self):
-        for output in self.outputs:
-            output.flush()
-
-# Capture console output in a buffer
-console_output_buffer = io.StringIO()
-# Save original stdout
-original_stdout = sys.stdout
-# Redirect prints to both console & buffer
-sys.stdout = MultiLogger(original_stdout, console_output_buffer)
-# -------------------------------------------------------
+# The console output of a run is kept in an eventLog.EventLog, see run()
 
 # Get the directory where the script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -55,15 +31,26 @@ sys.path.append(parent_dir)
 import imageUtilities as imgUtil
 import xmlUtilities
 import labelPredictor
+import oracleResult
+import reportUtilities
+import eventLog
+import analysisManifest
+import traceLoader
+import screenDedup
+import triggerMatcher
+import screenSimilarity
 
 detailedResult = True
-tracePlayerGenerated = True
 
 def load_arguments():
     ap = argparse.ArgumentParser()
     ap.add_argument("-a", "--appName", required=True, help="appName")
     ap.add_argument("-b", "--bugId", required=True, help="bug id")
     ap.add_argument("--unzip-dir", required=True, help="Path to the unzipped folder (contains bugId subfolder)")
+    ap.add_argument("--jobs", type=int, default=None,
+                    help="processes evaluating the affected screens (default: number of cores)")
+    ap.add_argument("--report", choices=oracleResult.REPORT_CHOICES, default=oracleResult.DEFAULT_REPORT,
+                    help="write a PDF and/or a JSON result in the bug folder")
     args = vars(ap.parse_args())
     return args
 
@@ -79,10 +66,12 @@ def create_component_list():
     """List of components potentially used for theme change"""
     return ["switch", "radio", "checkbox", "toggle"]
 
-def check_if_theme_set(image_name, xmlPath, tapPos, tappedComponent, listOfTriggerWords):
+def check_if_theme_set(image_name, xmlPath, tapPos, tappedComponent, listOfTriggerWords, xml_words=None):
     """
     Checks if the clicked/tapped component was actually the theme or if it was near 'theme'
     (like a switch or toggle next to a 'theme' text).
+    xml_words: the trigger words in the XML text of the screen (see triggerMatcher),
+    the screenshot is only read with the OCR when it is None.
     """
     try:
         tapY = tapPos[-1] if tapPos else "-1"
@@ -90,9 +79,12 @@ def check_if_theme_set(image_name, xmlPath, tapPos, tappedComponent, listOfTrigg
         if tapX == "-1" or tapY == "-1":
             return False, False
 
-        text = imgUtil.readTextInImage(image_name)
+        if xml_words is None:
+            theme_on_screen = "theme" in imgUtil.readTextInImage(image_name).lower()
+        else:
+            theme_on_screen = "theme" in xml_words
         listOfComponents = create_component_list()
-        if "theme" in text.lower():
+        if theme_on_screen:
             return True, False
         else:
             # check if clicked component is at same bounding box as the word "theme"
@@ -108,31 +100,22 @@ def check_if_theme_set(image_name, xmlPath, tapPos, tappedComponent, listOfTrigg
 
 def find_xml_from_screenshot(unzip_dir, imagename, stepNum, args):
     """
-    Construct the XML filename from screenshot, based on whether tracePlayerGenerated is True.
-    If the file doesn't exist, we also try a CrashScope naming fallback.
+    XML dump of a screenshot: the TracePlayer one, else the CrashScope one,
+    see traceLoader.resolve_xml.
     """
     bugId = args["bugId"]
-    if tracePlayerGenerated:
-        base = imagename.split(".User-Trace")[0]
-        versionName = imagename.split("_")[1]
-        xmlName = f"{base}-{versionName}-{bugId}-User-Trace-{stepNum}.xml"
-    else:
-        base = imagename.split("screen")[0]
-        xmlName = f"{base}ui-dump.xml"
-
-    fullpath = os.path.join(unzip_dir, bugId, xmlName)
-    return fullpath
+    return traceLoader.resolve_xml(os.path.join(unzip_dir, bugId), imagename, stepNum, bugId)
 
 def get_step_details(step):
     """
     Returns:
       screen_index: numeric index of the step/screen
-      tapPosition: the x,y from step["textEntry"] (space-separated)
+      tapPosition: the words of textEntry, the x,y are the last two
       clicked_comp_name: name of the dynamic GUI component
     """
-    screen_index = step["sequenceStep"]
-    tapPosition = step["textEntry"].split(" ")
-    clicked_comp_name = step["dynGuiComponent"]["name"] if "dynGuiComponent" in step else ""
+    screen_index = step.number
+    tapPosition = step.words
+    clicked_comp_name = step.component["name"] if step.component is not None else ""
     return screen_index, tapPosition, clicked_comp_name
 
 def find_trigger_reading_image(listOfSteps, screen_count_map, listOfTriggerWords, args):
@@ -155,25 +138,34 @@ def find_trigger_reading_image(listOfSteps, screen_count_map, listOfTriggerWords
     correct_screen_found = False
     correct_screen = None
     correct_theme_index = None
-    text_in_trigger_screen = ""
+    text_in_trigger_screen = None
+    similar_step = None
     before_theme = ""
     oneStep = False
     lastScreen = ""
 
+    # the trigger words are looked for in the XML of all the steps at once, only
+    # the screens without XML text are read with the OCR
+    xml_words = triggerMatcher.xml_matches(listOfSteps, listOfTriggerWords)
+    # the XML text of every screen of the trace, to find the screen shown after the
+    # theme change without comparing the screens one by one (see screenSimilarity)
+    screen_texts = screenSimilarity.SimilarityIndex(
+        {step.index: triggerMatcher.step_texts(step) for step in listOfSteps if step.screenshot is not None}
+    )
+
     for step in listOfSteps:
         if theme_set:
             oneStep = True  # After theme has been triggered once
 
-        if "screenshot" not in step:
+        if step.screenshot is None:
             continue
 
-        start_screen = step["screenshot"]
-        clicked_screen = start_screen.replace("augmented", "gui")
-        result_screen = start_screen.replace("_augmented", "")
+        start_screen = step.screenshot
+        result_screen = step.screen
 
         screen_index, tapPos, clicked_comp_name = get_step_details(step)
-        clicked_Image = os.path.join(unzip_dir, bugId, clicked_screen)
-        xmlPath = find_xml_from_screenshot(unzip_dir, start_screen, screen_index, args)
+        clicked_Image = os.path.join(unzip_dir, bugId, step.gui_screenshot)
+        xmlPath = step.xml_path
         image_xml_map[result_screen] = xmlPath
 
         # If theme was set and we have found the correct screen, track subsequent screens
@@ -183,7 +175,7 @@ def find_trigger_reading_image(listOfSteps, screen_count_map, listOfTriggerWords
         # Attempt to detect the theme trigger
         if not theme_set:
             themeChanged, oneStep = check_if_theme_set(
-                clicked_Image, xmlPath, tapPos, clicked_comp_name, listOfTriggerWords
+                clicked_Image, xmlPath, tapPos, clicked_comp_name, listOfTriggerWords, xml_words[step.index]
             )
 
         # If theme was triggered right here...
@@ -193,7 +185,12 @@ def find_trigger_reading_image(listOfSteps, screen_count_map, listOfTriggerWords
                 xmlPath = find_xml_from_screenshot(unzip_dir, lastScreen, screen_index - 1, args)
 
             # read text from that trigger screen
-            text_in_trigger_screen = sorted(xmlUtilities.readTextInXml(xmlPath))
+            text_in_trigger_screen = xmlUtilities.readTextInXml(xmlPath)
+            # first screen from here (from the next one if the trigger screen is the
+            # one before) with 90%+ of the trigger screen's text (Dice coefficient)
+            similar_step = screen_texts.first_similar(
+                text_in_trigger_screen, step.index if oneStep else step.index + 1, 0.90
+            )
             theme_set = True
             correct_screen_found = False
             before_theme = imgUtil.is_image_light(os.path.join(unzip_dir, bugId, start_screen))
@@ -201,14 +198,8 @@ def find_trigger_reading_image(listOfSteps, screen_count_map, listOfTriggerWords
         lastScreen = start_screen
 
         if theme_set and not correct_screen_found and oneStep:
-            # Compare the new screen's text vs. the old trigger screen's text
-            text_in_screen = sorted(xmlUtilities.readTextInXml(xmlPath))
-            seq_mat = difflib.SequenceMatcher()
-            seq_mat.set_seqs(text_in_screen, text_in_trigger_screen)
-            match_ratio = seq_mat.ratio()
-
             # If the new screen is 90%+ matching, call it the "correct" next screen
-            if match_ratio >= 0.90:
+            if step.index == similar_step:
                 correct_screen_found = True
                 correct_screen = result_screen
                 correct_theme_index = screen_index
@@ -223,11 +214,51 @@ def find_trigger_reading_image(listOfSteps, screen_count_map, listOfTriggerWords
 
     return triggerList, correct_affected_image_map, image_xml_map, themeChangeSuccess
 
+# keyboard classification of the screens already looked at in this run, by path;
+# cleared by check_theme, the next run may find other pixels at the same path
+keyboard_visible = {}
+
 def check_if_keyboard_visible(imageName):
-    img = cv2.imread(imageName)
-    croppedA = imgUtil.crop_keyboard(img)
+    if imageName in keyboard_visible:
+        return keyboard_visible[imageName]
+    croppedA = imgUtil.open_screen(imageName).keyboard
     return labelPredictor.has_keyboard(croppedA)
 
+def classify_keyboards(imageNames, groups=None):
+    """
+    Classify all the screens the oracle will look at in batched forward passes.
+    Screens that can't be read are left to check_if_keyboard_visible, screens
+    classified by the last run on the same files are not classified again.
+    With groups (see screenDedup) only one screen of a group is classified.
+    """
+    names = []
+    crops = []
+    # labels of another model or heuristic threshold are not reused
+    params = labelPredictor.cache_params()
+    for imageName in imageNames:
+        if imageName in keyboard_visible or imageName in names:
+            continue
+        found, label = analysisManifest.lookup("keyboard", [imageName], params)
+        if found:
+            keyboard_visible[imageName] = label
+            continue
+        if groups is not None and groups.representative(imageName) in names:
+            continue
+        try:
+            crops.append(imgUtil.open_screen(imageName).keyboard)
+        except Exception:
+            continue
+        names.append(imageName)
+    for imageName, label in zip(names, labelPredictor.has_keyboard_batch(crops)):
+        keyboard_visible[imageName] = label
+        analysisManifest.store("keyboard", [imageName], bool(label), params)
+    if groups is not None:
+        for imageName in imageNames:
+            representative = groups.representative(imageName)
+            if imageName not in keyboard_visible and representative in names:
+                keyboard_visible[imageName] = keyboard_visible[representative]
+                analysisManifest.store("keyboard", [imageName], bool(keyboard_visible[imageName]), params)
+
 def preprocess_text(txt):
     """
     Lowercase, remove extra newlines/spaces.
@@ -243,19 +274,32 @@ def getFocusedElement(xmlPath):
     return xmlUtilities.readBoundOfFocusedElement(xmlPath)
 
 def check_text_visibility(unzip_dir, bugId, affected_image, xmlPath):
-    img_path = os.path.join(unzip_dir, bugId)
-    txt_from_img = sorted(imgUtil.read_text_on_screen(img_path, affected_image))
+    bad_frac = missing_text_fraction(unzip_dir, bugId, affected_image, xmlPath)
+    return report_text_visibility(bad_frac, affected_image)
+
+def read_screen_text(unzip_dir, bugId, affected_image):
+    return imgUtil.read_text_on_screen(os.path.join(unzip_dir, bugId), affected_image)
+
+def missing_text_fraction(unzip_dir, bugId, affected_image, xmlPath, txt_from_img=None):
+    """Fraction of the XML text not found on the screenshot, None if the XML has no text"""
+    if txt_from_img is None:
+        txt_from_img = read_screen_text(unzip_dir, bugId, affected_image)
+    txt_from_img = sorted(txt_from_img)
     txt_from_xml = sorted(xmlUtilities.readTextInXml(xmlPath))
 
     txt_from_img = preprocess_text(txt_from_img)
     txt_from_xml = preprocess_text(txt_from_xml)
 
     if len(txt_from_xml) == 0:
-        print("Most text shows in", affected_image, "(No text in XML to compare)")
-        return 100
+        return None
 
     diff = set(txt_from_xml) - set(txt_from_img)
-    bad_frac = len(diff) / len(txt_from_xml)
+    return len(diff) / len(txt_from_xml)
+
+def report_text_visibility(bad_frac, affected_image):
+    if bad_frac is None:
+        print("Most text shows in", affected_image, "(No text in XML to compare)")
+        return 100
 
     if bad_frac <= 0.5:
         print("Most text shows in", affected_image)
@@ -267,6 +311,9 @@ def check_text_visibility(unzip_dir, bugId, affected_image, xmlPath):
 
 def is_theme_matching(lab1, lab2, trigger, affected_image):
     delta_E = colour.delta_E(lab1, lab2)
+    return report_theme_matching(delta_E, trigger, affected_image)
+
+def report_theme_matching(delta_E, trigger, affected_image):
     is_consistent = True
     if delta_E > 2:
         print("Test failed : the theme change is inconsistent on image", affected_image)
@@ -282,15 +329,158 @@ def is_theme_matching(lab1, lab2, trigger, affected_image):
 
     return (delta_E, is_consistent)
 
+def theme_matching(lab1, labs, trigger, affected_screens):
+    """
+    delta_E of the colours of the affected screens (labs, (N, 3)) vs the trigger
+    screen colour lab1, in one call, each printed as by report_theme_matching.
+    affected_screens are (name, path) of the screens.
+    Returns one record per screen for the report: {"screen", "delta_e", "consistent"}.
+    """
+    if not len(affected_screens):
+        return []
+    delta_e = np.atleast_1d(colour.delta_E(np.asarray(lab1), np.asarray(labs).reshape(-1, 3)))
+    records = []
+    for (affected_image, affected_path), value in zip(affected_screens, delta_e):
+        delta_e_val, is_consistent = report_theme_matching(value, trigger, affected_path)
+        records.append({"screen": affected_image, "delta_e": delta_e_val, "consistent": is_consistent})
+    return records
+
+def affected_screen_delta_e(lab1, affected_path, xmlPath, hasKeyboard):
+    """delta_E between the trigger screen colour and the focused element of an affected screen"""
+    lab2 = affected_screens_lab([(affected_path, getFocusedElement(xmlPath), hasKeyboard)])[0]
+    return colour.delta_E(lab1, lab2)
+
+def affected_screens_lab(screens):
+    """
+    LAB colours, (N, 3), of the focused element of affected screens given as
+    (path, bounds of the focused element, keyboard shown or None if unknown).
+    """
+    keyboards = [
+        check_if_keyboard_visible(path) if hasKeyboard is None else hasKeyboard
+        for path, bounds, hasKeyboard in screens
+    ]
+    return imgUtil.get_lab_vals([path for path, _, _ in screens], keyboards, [bounds for _, bounds, _ in screens])
+
+def submit_lab_batches(executor, screens, jobs):
+    """
+    Submit affected_screens_lab of the screens in one batch per worker.
+    Returns {screen: (future, row)}, the colour of a screen is future.result()[row].
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    size = max(1, -(-len(screens) // max(1, jobs)))
+    rows = {}
+    for start in range(0, len(screens), size):
+        batch = screens[start : start + size]
+        future = executor.submit(affected_screens_lab, batch)
+        for row, screen in enumerate(batch):
+            rows[screen] = (future, row)
+    return rows
+
+def init_screen_worker():
+    """The worker processes run one OCR at a time, the parallelism is across screens"""
+    import ocrEngine
+    ocrEngine.set_engine(ocrEngine.OcrEngine(workers=1))
+    cv2.setNumThreads(1)
+
+class SerialExecutor:
+    """Same interface as ProcessPoolExecutor for --jobs 1, runs each call right away"""
+    class Done:
+        def __init__(self, fn, args):
+            self.fn = fn
+            self.args = args
+
+        def result(self):
+            return self.fn(*self.args)
+
+    def submit(self, fn, *args):
+        return self.Done(fn, args)
+
+    def shutdown(self):
+        pass
+
+def screen_executor(jobs):
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1:
+        return SerialExecutor()
+    return ProcessPoolExecutor(max_workers=jobs, initializer=init_screen_worker)
+
 def main():
-    # ----------------------- MAIN LOGIC -----------------------
     args = load_arguments()
+    run(args)
+
+def run(args, data=None):
+    """
+    Theme change oracle on one bug report, writes theme_detection_report.pdf in the bug folder.
+    args: appName, bugId, unzip_dir, report (see oracleResult, default pdf)
+    data: the trace (see traceLoader) or the content of Execution-<bugId>.json,
+          loaded from the bug folder if not given
+    Returns the verdict and metrics of the run, see summarize.
+    """
+    report = oracleResult.report_mode(args)
+    # what is printed goes to the console and to the event log, the log goes in the PDF
+    start = time.perf_counter()
+    with eventLog.capture("theme") as log, analysisManifest.capture("theme", args):
+        pdf_summary = check_theme(args, data)
+        summary = summarize(pdf_summary)
+        log.emit("verdict", scope="run", **summary)
+    timings = {"check": time.perf_counter() - start}
+
+    result = oracleResult.build_result(
+        "theme", args, summary, pdf_summary, log.events, timings
+    )
+    if oracleResult.wants_pdf(report):
+        start = time.perf_counter()
+        render_pdf(result)
+        timings["pdf"] = time.perf_counter() - start
+    if oracleResult.wants_json(report):
+        json_path = os.path.join(args["unzip_dir"], args["bugId"], "theme_detection_result.json")
+        oracleResult.write_result(json_path, result)
+        print(f"[INFO] JSON result written at: {json_path}")
+    return result["summary"]
+
+def render_pdf(result):
+    """Draw the PDF report of a run from its result (see oracleResult)"""
+    pdf_path = os.path.join(result["unzip_dir"], result["bugId"], "theme_detection_report.pdf")
+    generate_pdf_report(result["unzip_dir"], result["details"], pdf_path, result["events"])
+    print(f"\n[INFO] PDF generated at: {pdf_path}")
+
+def summarize(pdf_summary):
+    """Verdict (pass, fail or not_detected) and metrics of a run, for the batch results"""
+    delta_e = [d["delta_e"] for d in pdf_summary["delta_e_values"]]
+    visible = [t["visible_pct"] for t in pdf_summary["text_visibility"]]
+    inconsistent = sum(1 for d in pdf_summary["delta_e_values"] if not d["consistent"])
+    # report_text_visibility: more than half of the text missing
+    hidden_text = sum(1 for pct in visible if pct < 50)
+
+    if not pdf_summary["theme_detected"]:
+        verdict = "not_detected"
+    elif pdf_summary["failed_changes"] or inconsistent or hidden_text:
+        verdict = "fail"
+    else:
+        verdict = "pass"
+    return {
+        "verdict": verdict,
+        "theme_changes": pdf_summary["successful_changes"] + pdf_summary["failed_changes"],
+        "failed_changes": pdf_summary["failed_changes"],
+        "screens": len(delta_e),
+        "inconsistent_screens": inconsistent,
+        "max_delta_e": float(max(delta_e)) if delta_e else None,
+        "hidden_text_screens": hidden_text,
+        "min_visible_pct": min(visible) if visible else None,
+    }
+
+def check_theme(args, data):
+    # ----------------------- MAIN LOGIC -----------------------
     unzip_dir = args["unzip_dir"]
     bugId = args["bugId"]
     screen_count_map = {}
 
-    data = read_json(os.path.join(unzip_dir, bugId, f"Execution-{bugId}.json"))
+    trace = traceLoader.as_trace(data, unzip_dir, bugId)
     listOfTriggerWords = create_trigger_list()
+    # labels of the last run, analysisManifest knows which files are still the same
+    keyboard_visible.clear()
 
     print("ORACLE FOR THEME CHANGE")
 
@@ -309,18 +499,17 @@ def main():
         "text_visibility": [],    # each item = {"screen": X, "visible_pct": int, "missing_pct": int}
     }
 
-    # Collect steps from the JSON
-    for line in data:
-        if "steps" in line:
-            listOfSteps = data["steps"]
-            (
-                triggerList,
-                correct_affected_image_map,
-                image_xml_map,
-                themeChangeSuccess,
-            ) = find_trigger_reading_image(
-                listOfSteps, screen_count_map, listOfTriggerWords, args
-            )
+    # Collect steps from the trace
+    (
+        triggerList,
+        correct_affected_image_map,
+        image_xml_map,
+        themeChangeSuccess,
+    ) = find_trigger_reading_image(
+        trace.steps, screen_count_map, listOfTriggerWords, args
+    )
+
+    pdf_summary["triggers"] = list(triggerList)
 
     # Check if we detected a theme change
     if len(triggerList) >= 1:
@@ -329,18 +518,14 @@ def main():
     else:
         print("Theme change not detected")
         # Even if no theme, we generate the PDF with minimal info
-        sys.stdout = original_stdout
-        console_output = console_output_buffer.getvalue()
-        pdf_path = os.path.join(unzip_dir, bugId, "theme_detection_report.pdf")
-        generate_pdf_report(unzip_dir, pdf_summary, pdf_path, console_output)
-        print(f"[INFO] PDF generated at: {pdf_path}")
-        return
+        return pdf_summary
 
     # Was the theme change successful?
     print("--------------------------- Was theme changed successfully? -------------------------------")
     success_count = 0
     fail_count = 0
     for trigger in triggerList:
+        eventLog.emit("trigger", screen=trigger, changed=themeChangeSuccess[trigger])
         if themeChangeSuccess[trigger]:
             print("Theme changed successfully")
             success_count += 1
@@ -352,77 +537,103 @@ def main():
 
     # Evaluate whether new screens are consistent with the old theme
     print("---------------------------- Did theme match in all screen? -------------------------------")
+    screens = []
     for trigger in triggerList:
-        all_affected_images = correct_affected_image_map[trigger]
-        trigger_path = os.path.join(unzip_dir, bugId, trigger)
-        hasKeyboard = check_if_keyboard_visible(trigger_path)
-        lab1 = imgUtil.get_lab_val(trigger_path, hasKeyboard, None)
-
-        for affected_image in all_affected_images:
-            affected_path = os.path.join(unzip_dir, bugId, affected_image)
-            hasKeyboard2 = check_if_keyboard_visible(affected_path)
-            xmlPath = image_xml_map[affected_image]
-            bounds = getFocusedElement(xmlPath)
-
-            lab2 = imgUtil.get_lab_val(affected_path, hasKeyboard2, bounds)
-            delta_e_val, is_consistent = is_theme_matching(lab1, lab2, trigger_path, affected_path)
-            pdf_summary["delta_e_values"].append({
-                "screen": affected_image,
-                "delta_e": delta_e_val,
-                "consistent": is_consistent
-            })
+        screens.append(os.path.join(unzip_dir, bugId, trigger))
+        for affected_image in correct_affected_image_map[trigger]:
+            screens.append(os.path.join(unzip_dir, bugId, affected_image))
+    # the same screen shown several times is classified, and its colour and text
+    # computed, only once (see screenDedup)
+    groups = screenDedup.group_screens(screens)
+    classify_keyboards(screens, groups)
+
+    # The affected screens are evaluated in worker processes (--jobs), the results
+    # are printed here in the same order as when evaluated one by one. The colours
+    # and text of the screens that didn't change since the last run are taken from
+    # the manifest (see analysisManifest) and not computed again.
+    executor = screen_executor(args.get("jobs"))
+    try:
+        delta_jobs = []
+        lab_keys = {}
+        for trigger in triggerList:
+            trigger_path = os.path.join(unzip_dir, bugId, trigger)
+            hasKeyboard = check_if_keyboard_visible(trigger_path)
+            lab_screen = groups.representative(trigger_path)
+            lab1 = analysisManifest.cached(
+                "lab", [trigger_path], lambda: imgUtil.get_lab_val(lab_screen, hasKeyboard, None),
+                {"keyboard": bool(hasKeyboard)}
+            )
 
-    print("---------------------------- Did all text show in dark theme? ------------------------------")
-    # Check text coverage
-    for trigger in triggerList:
-        all_affected_images = correct_affected_image_map[trigger]
-        for affected_image in all_affected_images:
-            xmlPath = image_xml_map[affected_image]
-            visible_pct = check_text_visibility(unzip_dir, bugId, affected_image, xmlPath)
+            affected = []
+            for affected_image in correct_affected_image_map[trigger]:
+                affected_path = os.path.join(unzip_dir, bugId, affected_image)
+                xmlPath = image_xml_map[affected_image]
+                # classified above, the workers don't load the keyboard model
+                hasKeyboard2 = keyboard_visible.get(affected_path)
+                params = {"keyboard": hasKeyboard2}
+                found, lab2 = analysisManifest.lookup("focused_lab", [affected_path, xmlPath], params)
+                lab_key = None
+                if not found:
+                    lab_key = (groups.representative(affected_path), getFocusedElement(xmlPath), hasKeyboard2)
+                    lab_keys[lab_key] = None
+                affected.append((affected_image, affected_path, xmlPath, params, lab2, lab_key))
+            delta_jobs.append((trigger_path, lab1, affected))
+        # the colours not in the manifest are computed in batches, one per worker
+        lab_rows = submit_lab_batches(executor, list(lab_keys), args.get("jobs"))
+
+        text_jobs = []
+        text_futures = {}
+        ocr_params = imgUtil.ocr_params()
+        for trigger in triggerList:
+            for affected_image in correct_affected_image_map[trigger]:
+                affected_path = os.path.join(unzip_dir, bugId, affected_image)
+                found, txt_from_img = analysisManifest.lookup("ocr_text", [affected_path], ocr_params)
+                future = None
+                if not found:
+                    text_screen = os.path.basename(groups.representative(affected_path))
+                    if text_screen not in text_futures:
+                        text_futures[text_screen] = executor.submit(read_screen_text, unzip_dir, bugId, text_screen)
+                    future = text_futures[text_screen]
+                text_jobs.append((affected_image, affected_path, txt_from_img, future))
+
+        for trigger_path, lab1, affected in delta_jobs:
+            labs = []
+            for affected_image, affected_path, xmlPath, params, lab2, lab_key in affected:
+                if lab_key is not None:
+                    future, row = lab_rows[lab_key]
+                    lab2 = future.result()[row]
+                    analysisManifest.store("focused_lab", [affected_path, xmlPath], lab2, params)
+                labs.append(lab2)
+            # delta_E of all the affected screens of the trigger at once
+            records = theme_matching(lab1, labs, trigger_path, [(a[0], a[1]) for a in affected])
+            for record in records:
+                eventLog.emit("metric", name="delta_e", screen=record["screen"], value=float(record["delta_e"]))
+                eventLog.emit(
+                    "verdict", scope="screen", check="theme", screen=record["screen"], passed=record["consistent"]
+                )
+            pdf_summary["delta_e_values"] += records
+
+        print("---------------------------- Did all text show in dark theme? ------------------------------")
+        # Check text coverage
+        for affected_image, affected_path, txt_from_img, future in text_jobs:
+            if future is not None:
+                txt_from_img = future.result()
+                analysisManifest.store("ocr_text", [affected_path], txt_from_img, ocr_params)
+            bad_frac = missing_text_fraction(
+                unzip_dir, bugId, affected_image, image_xml_map[affected_image], txt_from_img
+            )
+            visible_pct = report_text_visibility(bad_frac, affected_image)
+            eventLog.emit("metric", name="visible_pct", screen=affected_image, value=visible_pct)
+            eventLog.emit("verdict", scope="screen", check="text", screen=affected_image, passed=visible_pct >= 50)
             pdf_summary["text_visibility"].append({
                 "screen": affected_image,
                 "visible_pct": visible_pct,
                 "missing_pct": 100 - visible_pct
             })
+    finally:
+        executor.shutdown()
 
-    # Now finalize by restoring stdout and building PDF
-    sys.stdout = original_stdout
-    console_output = console_output_buffer.getvalue()
-
-    pdf_path = os.path.join(unzip_dir, bugId, "theme_detection_report.pdf")
-    generate_pdf_report(unzip_dir, pdf_summary, pdf_path, console_output)
-    print(f"\n[INFO] PDF generated at: {pdf_path}")
-
-
-# ----------------------------------------------------------------
-# HELPER FUNCTION FOR WRAPPING TEXT (to avoid going off the page)
-# ----------------------------------------------------------------
-def draw_wrapped_text(canvas, text, x, y, max_width, font='Helvetica', font_size=10, line_height=12):
-    """
-    Draw the 'text' at position (x, y), wrapping automatically if the line exceeds 'max_width'.
-    Returns the new 'y' position after drawing.
-    """
-    canvas.setFont(font, font_size)
-    words = text.split()
-    current_line = ""
-    
-    for w in words:
-        candidate = (current_line + " " + w).strip() if current_line else w
-        width_of_candidate = stringWidth(candidate, font, font_size)
-        
-        if width_of_candidate <= max_width:
-            current_line = candidate
-        else:
-            # Draw current_line since adding this word would exceed max_width
-            canvas.drawString(x, y, current_line)
-            y -= line_height
-            current_line = w
-
-    if current_line:
-        canvas.drawString(x, y, current_line)
-        y -= line_height
-
-    return y
+    return pdf_summary
 
 
 def draw_table_with_page_check(canvas, table, current_x, current_y, page_width, page_height, bottom_margin=50):
@@ -446,7 +657,7 @@ def draw_table_with_page_check(canvas, table, current_x, current_y, page_width,
 # ----------------------------------------------------------------
 # PDF GENERATION FUNCTION (WRAPPED TEXT + CENTERED TABLES + IMAGES)
 # ----------------------------------------------------------------
-def generate_pdf_report(unzip_dir, summary, pdf_path, console_output):
+def generate_pdf_report(unzip_dir, summary, pdf_path, events):
     """
     1) Include the *entire console output* at the top of the PDF (wrapped).
     2) New page: summary + tables (Delta_E, text visibility) centered.
@@ -468,17 +679,12 @@ def generate_pdf_report(unzip_dir, summary, pdf_path, console_output):
     # ============ Console Logs (Wrapped) ============
     max_text_width = page_width - (2 * x_margin)
 
-    for line in console_output.split("\n"):
-        y_position = draw_wrapped_text(
-            c, line, x_margin, y_position,
-            max_width=max_text_width,
-            font='Helvetica', font_size=8,
-            line_height=10
-        )
-        if y_position < 60:  # If near bottom, new page
-            c.showPage()
-            c.setFont("Helvetica", 9)
-            y_position = page_height - y_margin
+    y_position = reportUtilities.draw_console(
+        c, eventLog.console_lines(events), x_margin, y_position,
+        max_width=max_text_width, top=page_height - y_margin,
+        font='Helvetica', font_size=8,
+        line_height=10
+    )
 
     # Go to new page for summary
     c.showPage()
@@ -598,7 +804,8 @@ def generate_pdf_report(unzip_dir, summary, pdf_path, console_output):
                 y_position -= 15
 
                 # Draw the image at 250x250
-                c.drawImage(
+                reportUtilities.draw_image(
+                    c,
                     img_path,
                     x_margin,
                     y_position - 200,
@@ -0,0 +1,315 @@
+"""
+Loads the trace of a bug report (Execution-<bugId>.json) for the oracles.
+
+The oracles used to json.load the whole file, look for "steps" by looping over
+its keys and then work on the raw steps: split textEntry again for the tap
+position, split deviceDimensions, and rebuild the XML dump of a screenshot with
+their own find_xml_from_screenshot. Here every step is read once into a Step
+(__slots__, only what the oracles use, the big "screen" part of the steps is
+dropped) with the tap position split, the screenshot paths and the XML dump
+resolved:
+
+    trace = traceLoader.load_trace(unzip_dir, bugId)
+    for step in trace.steps:
+        step.number, step.tap, step.screen_path, step.xml_path, step.component...
+
+With ijson installed the file is parsed as a stream, one step at a time, so a
+long recording never is in memory as a whole; without it json.load is used.
+
+The parsed trace is cached as a pickle (MAGNETO_TRACE_CACHE, default
+~/.cache/magneto/traces, "off" to disable) named after the bug folder, with the
+digest of the JSON file it was parsed from: loading the same trace again (the
+next oracle, the next run) only hashes the file and skips the parsing, a trace
+uploaded again to the same folder is parsed again even if its size and mtime are
+the same. The digest of a parsed file is computed while it is read. The XML dumps of the steps are looked
+up again when a trace comes from the cache, they may have been added or renamed
+since. The pickles are kept outside of the bug folder:
+the bug folders come from uploaded zips and a pickle must not come from there.
+At most TRACE_CACHE_ENTRIES traces are kept, the oldest ones are removed.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+
+try:
+    # optional, reads the steps one by one instead of loading the whole file
+    import ijson
+except ImportError:
+    ijson = None
+
+TRACE_CACHE_VERSION = 2
+TRACE_CACHE_ENTRIES = 256
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "magneto", "traces")
+
+_cache_lock = threading.Lock()
+
+
+def trace_path(unzip_dir, bugId):
+    return os.path.join(unzip_dir, bugId, f"Execution-{bugId}.json")
+
+
+def xml_candidates(screenshot, number, bugId):
+    """
+    Names of the XML dump of the screenshot of step number, in the order they are
+    tried: TracePlayer dump in the bug folder or its xmls/ folder, CrashScope dump.
+    """
+    base = screenshot.split(".User-Trace")[0]
+    parts = screenshot.split("_")
+    version = parts[1] if len(parts) > 1 else ""
+    name = f"{base}-{version}-{bugId}-User-Trace-{number}.xml"
+    return [name, os.path.join("xmls", name), screenshot.split("screen")[0] + "ui-dump.xml"]
+
+
+def resolve_xml(bug_dir, screenshot, number, bugId):
+    """Path of the XML dump of a screenshot, the TracePlayer name if none exists"""
+    candidates = xml_candidates(screenshot, number, bugId)
+    for name in candidates:
+        path = os.path.join(bug_dir, name)
+        if os.path.isfile(path):
+            return path
+    return os.path.join(bug_dir, candidates[0])
+
+
+def parse_tap(words):
+    """(x, y) of a command like "adb shell input tap 659 520", None if it has no position"""
+    try:
+        return int(words[-2]), int(words[-1])
+    except (IndexError, ValueError):
+        return None
+
+
+def parse_dimensions(dimensions):
+    """(width, height) of deviceDimensions like "1080x1920", None if missing"""
+    try:
+        width, height = dimensions.split("x")
+        return int(width), int(height)
+    except (AttributeError, ValueError):
+        return None
+
+
+class Step:
+    __slots__ = (
+        "index",  # position in the trace
+        "number",  # sequenceStep
+        "screenshot",  # screenshot name as in the trace (the "_augmented" one), None if none
+        "screen",  # screenshot without the "_augmented" marks
+        "screenshot_path",
+        "screen_path",
+        "command",  # textEntry
+        "words",  # textEntry split on " "
+        "tap",  # (x, y) of the tap, None if the command has no position
+        "component",  # dynGuiComponent, None if none
+        "xml_path",  # XML dump of the screenshot, None if no screenshot
+    )
+
+    def __init__(self, index, raw, bug_dir, bugId):
+        self.index = index
+        self.number = raw.get("sequenceStep")
+        self.command = raw.get("textEntry", "")
+        self.words = tuple(self.command.split(" "))
+        self.tap = parse_tap(self.words)
+        self.component = raw.get("dynGuiComponent")
+        self.screenshot = raw.get("screenshot")
+        if self.screenshot is None:
+            self.screen = self.screenshot_path = self.screen_path = self.xml_path = None
+        else:
+            self.screen = self.screenshot.replace("_augmented", "")
+            self.screenshot_path = os.path.join(bug_dir, self.screenshot)
+            self.screen_path = os.path.join(bug_dir, self.screen)
+            self.resolve_xml(bug_dir, bugId)
+
+    def resolve_xml(self, bug_dir, bugId):
+        """Look up the XML dump of the screenshot in the bug folder again"""
+        if self.screenshot is not None:
+            self.xml_path = resolve_xml(bug_dir, self.screenshot, self.number, bugId)
+
+    @property
+    def gui_screenshot(self):
+        """Screenshot with the tapped component marked"""
+        return self.screenshot.replace("augmented", "gui")
+
+    def __repr__(self):
+        return "Step({}, {!r})".format(self.number, self.screenshot)
+
+
+class Trace:
+    def __init__(self, bugId, bug_dir, meta, steps):
+        self.bugId = bugId
+        self.bug_dir = bug_dir
+        self.meta = meta  # everything but the steps: deviceDimensions, app...
+        self.steps = steps
+        self.dimensions = parse_dimensions(meta.get("deviceDimensions"))
+
+    @property
+    def app_name(self):
+        return (self.meta.get("app") or {}).get("name", "")
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+
+def _stream(f):
+    """(top level fields but the steps, iterator of the raw steps) of the open file, with ijson"""
+    meta = {}
+    builder = meta_builder = None
+    key = None
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if prefix == "steps.item" and event == "start_map":
+            builder = ijson.ObjectBuilder()
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == "steps.item" and event == "end_map":
+                yield meta, builder.value
+                builder = None
+            continue
+        if prefix == "" and event == "map_key":
+            key = value
+            meta_builder = None if key == "steps" else ijson.ObjectBuilder()
+        elif key is not None and key != "steps" and meta_builder is not None:
+            meta_builder.event(event, value)
+            # a scalar, or the end of an object / array, at the top level
+            if prefix == key and event not in ("start_map", "start_array", "map_key"):
+                meta[key] = meta_builder.value
+                meta_builder = None
+    yield meta, None
+
+
+class _HashingReader:
+    """File object updating a hash with everything read from it"""
+
+    def __init__(self, f, digest):
+        self._f = f
+        self._digest = digest
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._digest.update(data)
+        return data
+
+
+def _new_digest():
+    return hashlib.blake2b(digest_size=20)
+
+
+def file_digest(path):
+    """Digest of the content of a file, the same one iter_steps computes"""
+    h = _new_digest()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def iter_steps(unzip_dir, bugId, meta=None, digest=None):
+    """
+    The steps of the trace one by one, read as a stream if ijson is installed.
+    meta, if given, is filled with the other fields of the trace.
+    digest, if given, is a hash updated with the content of the file.
+    """
+    bug_dir = os.path.join(unzip_dir, bugId)
+    if meta is None:
+        meta = {}
+    with open(trace_path(unzip_dir, bugId), "rb") as f:
+        if digest is not None:
+            f = _HashingReader(f, digest)
+        if ijson is None:
+            data = json.load(f)
+            meta.update((k, v) for k, v in data.items() if k != "steps")
+            raw_steps = data.get("steps") or []
+            for index, raw in enumerate(raw_steps):
+                yield Step(index, raw, bug_dir, bugId)
+            return
+        index = 0
+        for fields, raw in _stream(f):
+            if raw is None:
+                meta.update(fields)
+            else:
+                yield Step(index, raw, bug_dir, bugId)
+                index += 1
+
+
+def read_trace(unzip_dir, bugId, digest=None):
+    """The trace parsed from the JSON file, without the cache"""
+    meta = {}
+    steps = list(iter_steps(unzip_dir, bugId, meta, digest))
+    return Trace(bugId, os.path.join(unzip_dir, bugId), meta, steps)
+
+
+def from_data(data, unzip_dir, bugId):
+    """The trace of an already loaded Execution-<bugId>.json"""
+    bug_dir = os.path.join(unzip_dir, bugId)
+    steps = [Step(index, raw, bug_dir, bugId) for index, raw in enumerate(data.get("steps") or [])]
+    return Trace(bugId, bug_dir, {k: v for k, v in data.items() if k != "steps"}, steps)
+
+
+def as_trace(data, unzip_dir, bugId):
+    """data as a Trace: loaded if None, converted if the content of the JSON file"""
+    if data is None:
+        return load_trace(unzip_dir, bugId)
+    if isinstance(data, Trace):
+        return data
+    return from_data(data, unzip_dir, bugId)
+
+
+def _cache_dir():
+    path = os.environ.get("MAGNETO_TRACE_CACHE", DEFAULT_CACHE_DIR)
+    if path.lower() in ("off", "0", "none", ""):
+        return None
+    return path
+
+
+def _cache_file(cache_dir, unzip_dir, bugId):
+    # the content is checked against the digest in the pickle, see load_trace
+    h = hashlib.blake2b(digest_size=20)
+    h.update("{}\0{}".format(TRACE_CACHE_VERSION, os.path.abspath(os.path.join(unzip_dir, bugId))).encode())
+    return os.path.join(cache_dir, h.hexdigest() + ".pickle")
+
+
+def _prune(cache_dir):
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".pickle")]
+    if len(entries) <= TRACE_CACHE_ENTRIES:
+        return
+    entries.sort(key=os.path.getmtime)
+    for path in entries[: len(entries) - TRACE_CACHE_ENTRIES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def load_trace(unzip_dir, bugId):
+    """The trace of the bug, from the cache when the same JSON file was parsed before"""
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return read_trace(unzip_dir, bugId)
+    cache_file = _cache_file(cache_dir, unzip_dir, bugId)
+    try:
+        with open(cache_file, "rb") as f:
+            digest, trace = pickle.load(f)
+        if digest == file_digest(trace_path(unzip_dir, bugId)):
+            for step in trace.steps:
+                step.resolve_xml(trace.bug_dir, bugId)
+            return trace
+    except Exception:
+        # missing, or written by another version
+        pass
+
+    digest = _new_digest()
+    trace = read_trace(unzip_dir, bugId, digest)
+    try:
+        with _cache_lock:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(cache_file, os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump((digest.hexdigest(), trace), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_file)
+            _prune(cache_dir)
+    except OSError as e:
+        print("[WARNING] trace not cached:", e)
+    return trace
@@ -0,0 +1,131 @@
+"""
+Search of the trigger words of the oracles (theme, night, done, save, language...)
+in the text of the steps.
+
+The theme oracle used to OCR the whole clicked screenshot of every step until the
+trigger was found, only to look for "theme" in it, and the other oracles looped
+over their word lists for every component. Here the words of a list go in one
+Aho-Corasick automaton (TriggerMatcher, built once per list), which finds all of
+them in one pass over a text, same as `word in text.lower()` for every word.
+
+xml_matches runs the automaton once over the XML text of all the steps of a
+trace, the OCR is left for the steps whose XML dump is missing or has no text:
+
+    found = triggerMatcher.xml_matches(trace.steps, ["theme", "night"])
+    found[step.index]  # words in the XML of the step, None if OCR is needed
+"""
+
+import threading
+from bisect import bisect_right
+from collections import deque
+
+import xmlUtilities
+
+# the texts of the steps are joined with it, no trigger word contains it
+SEPARATOR = "\n"
+
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+
+class TriggerMatcher:
+    """Aho-Corasick automaton of words, matched case insensitively anywhere in a text"""
+
+    def __init__(self, words):
+        self.words = tuple(dict.fromkeys(w.lower() for w in words if w))
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for word in self.words:
+            state = 0
+            for ch in word:
+                if ch not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                    self._goto[state][ch] = len(self._goto) - 1
+                state = self._goto[state][ch]
+            self._out[state] += (word,)
+
+        # breadth first, the fail link of a state is set before its children's
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._out[child] += self._out[self._fail[child]]
+
+    def iter_matches(self, text):
+        """(end position, word) of every occurrence of the words in text"""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for position, ch in enumerate(text.lower()):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for word in out[state]:
+                yield position, word
+
+    def find(self, text):
+        """Set of the words found in text"""
+        return {word for _, word in self.iter_matches(text)}
+
+    def contains(self, text):
+        """True if one of the words is in text"""
+        for _ in self.iter_matches(text):
+            return True
+        return False
+
+
+def get_matcher(words):
+    """The TriggerMatcher of a word list, built once per process"""
+    key = tuple(words)
+    with _matchers_lock:
+        if key not in _matchers:
+            _matchers[key] = TriggerMatcher(key)
+        return _matchers[key]
+
+
+def step_texts(step):
+    """Text of the XML dump of a step, None if it has no dump or no text"""
+    if step.xml_path is None:
+        return None
+    try:
+        texts = xmlUtilities.load_screen_dump(step.xml_path).texts
+    except Exception:
+        return None
+    texts = [t for t in texts if t]
+    return texts or None
+
+
+def xml_matches(steps, words):
+    """
+    {step.index: set of the words in the XML text of the step} for all the steps,
+    None for the steps whose XML has no text (OCR their screenshot instead).
+    The XML texts of all the steps are matched in one pass.
+    """
+    found = {}
+    starts = []
+    indexes = []
+    parts = []
+    length = 0
+    for step in steps:
+        texts = step_texts(step)
+        if texts is None:
+            found[step.index] = None
+            continue
+        found[step.index] = set()
+        # lowered here, the offsets are the ones of the text matched
+        text = (SEPARATOR.join(texts) + SEPARATOR).lower()
+        starts.append(length)
+        indexes.append(step.index)
+        parts.append(text)
+        length += len(text)
+
+    for position, word in get_matcher(words).iter_matches("".join(parts)):
+        found[indexes[bisect_right(starts, position) - 1]].add(word)
+    return found
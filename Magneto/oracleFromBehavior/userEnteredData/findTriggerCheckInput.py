@@ -2,40 +2,14 @@ import json
 import sys, os
 from pprint import pprint
 import argparse
-import io
+import time
 
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import Table, TableStyle
 from reportlab.lib import colors
 from reportlab.pdfgen import canvas
 
-# ---------- MultiLogger for Terminal + Buffer ----------
-class MultiLogger:
-    """
-    A small class to direct 'print' outputs to both the console and a StringIO buffer.
-    This way, we can see logs in the terminal AND capture them for the PDF.
-    """
-    def __init__(self, *outputs):
-        self.outputs = outputs
-
-    def write(self, message):
-        for output in self.outputs:
-            output.write(message)
-            output.flush()
-
-    def flush(self):
-        for output in self.outputs:
-            output.flush()
-
-
-# We'll capture console output in this buffer for later PDF printing
-console_output_buffer = io.StringIO()
-
-# Keep reference to the original stdout (the real console)
-original_stdout = sys.stdout
-
-# Redirect all 'print()' calls to both console and buffer
-sys.stdout = MultiLogger(original_stdout, console_output_buffer)
+# The console output of a run is kept in an eventLog.EventLog, see run()
 
 """
 This is the oracle for user-entered text. It finds screens with trigger words,
@@ -52,9 +26,13 @@ scriptLocation = os.getcwd()
 dirName = os.path.dirname(scriptLocation)
 sys.path.insert(1, dirName)
 import xmlUtilities
+import oracleResult
+import reportUtilities
+import eventLog
+import traceLoader
+import triggerMatcher
 
 detailedResult = True
-tracePlayerGenerated = True
 
 def read_json(jsonName):
     with open(jsonName) as f:
@@ -71,6 +49,8 @@ def load_arguments():
     ap.add_argument("-b", "--bugId", required=True, help="Bug ID")
     # New argument for the unzipped folder path (which should contain the bugId subfolder)
     ap.add_argument("--unzip-dir", required=True, help="Path to the unzipped folder (contains bugId subfolder)")
+    ap.add_argument("--report", choices=oracleResult.REPORT_CHOICES, default=oracleResult.DEFAULT_REPORT,
+                    help="write a PDF and/or a JSON result in the bug folder")
     args = vars(ap.parse_args())
     return args
 
@@ -86,9 +66,11 @@ def find_trigger(listOfSteps, screen_count_map, listOfTriggerWords, listOfTrigge
     for each 'trigger' event we find.
     """
     triggerList = []
+    # all the trigger words are looked for in one pass over the text (see triggerMatcher)
+    matcher = triggerMatcher.get_matcher(listOfTriggerWords)
     for step in listOfSteps:
-        if "dynGuiComponent" in step:
-            dynGuiComponentData = step["dynGuiComponent"]
+        if step.component is not None:
+            dynGuiComponentData = step.component
             if "idXml" in dynGuiComponentData:
                 buttonText = dynGuiComponentData["idXml"].lower()
             else:
@@ -96,38 +78,22 @@ def find_trigger(listOfSteps, screen_count_map, listOfTriggerWords, listOfTrigge
 
             buttonName = dynGuiComponentData["name"]
             # If matches a "trigger" widget + has the trigger word
-            if any(comp == buttonName for comp in listOfTriggerComponents) and any(
-                words in buttonText for words in listOfTriggerWords
-            ):
-                imageNumber = step["sequenceStep"]
+            if any(comp == buttonName for comp in listOfTriggerComponents) and matcher.contains(buttonText):
+                imageNumber = step.number
                 # We get the XML name from the screenshot
-                xmlFullPath, xmlName = find_xml_from_screenshot(step["screenshot"], imageNumber, args)
+                xmlFullPath, xmlName = find_xml_from_screenshot(step, args)
                 screen_count_map[xmlName] = imageNumber
                 # Also store the screenshot itself for potential PDF usage
-                triggerList.append((xmlName, step["screenshot"]))
+                triggerList.append((xmlName, step.screenshot))
     return triggerList
 
-def find_xml_from_screenshot(imagename, stepNum, args):
+def find_xml_from_screenshot(step, args):
     """
-    Construct XML file name from screenshot, based on whether it's tracePlayerGenerated or not,
-    and prepend the --unzip-dir + bugId folder.
+    XML dump of the screenshot of a step (see traceLoader.resolve_xml), as
+    (full path, name in the --unzip-dir + bugId folder for table display, etc.)
     """
-    if tracePlayerGenerated:
-        # Example: imagename = "MyApp_12345.User-Trace.png"
-        base = imagename.split(".User-Trace")[0]
-        versionName = imagename.split("_")[1]  # e.g. 12345
-        # e.g. base + "-12345-<bugId>-User-Trace-<stepNum>.xml"
-        xmlName = f"{base}-{versionName}-{args['bugId']}-User-Trace-{stepNum}.xml"
-    else:
-        # Fallback approach if not tracePlayerGenerated
-        base = imagename.split("screen")[0]
-        xmlName = base + "ui-dump.xml"
-
-    # Full path includes the unzip_dir and bugId subfolder
-    return (
-        os.path.join(args["unzip_dir"], args["bugId"], xmlName),  # full path
-        xmlName  # just the filename (for table display, etc.)
-    )
+    bug_dir = os.path.join(args["unzip_dir"], args["bugId"])
+    return step.xml_path, os.path.relpath(step.xml_path, bug_dir)
 
 def find_edit_text(listOfSteps, screen_count_map, args):
     """
@@ -135,15 +101,15 @@ def find_edit_text(listOfSteps, screen_count_map, args):
     """
     screenTextMap = {}
     for step in listOfSteps:
-        if "dynGuiComponent" in step:
-            dynGuiComponentData = step["dynGuiComponent"]
+        if step.component is not None:
+            dynGuiComponentData = step.component
             # Check if user typed something in an EditText
             if (
                 dynGuiComponentData["name"] == "android.widget.EditText"
-                and "none" in step["textEntry"]
+                and "none" in step.command
             ):
-                imageNumber = step["sequenceStep"]
-                xmlPath, _ = find_xml_from_screenshot(step["screenshot"], imageNumber, args)
+                imageNumber = step.number
+                xmlPath, _ = find_xml_from_screenshot(step, args)
                 screenTextMap[imageNumber] = dynGuiComponentData["text"]
     return screenTextMap
 
@@ -211,12 +177,70 @@ def compareText(usertext_screen_map, textInScreenMap, triggerXmlName, trigger_sc
 
 def main():
     args = load_arguments()
+    run(args)
+
+def run(args, data=None):
+    """
+    User input oracle on one bug report, writes user_input_report.pdf in the bug folder.
+    args: appName, bugId, unzip_dir, report (see oracleResult, default pdf)
+    data: the trace (see traceLoader) or the content of Execution-<bugId>.json,
+          loaded from the bug folder if not given
+    Returns the verdict and metrics of the run, see summarize.
+    """
+    report = oracleResult.report_mode(args)
+    # what is printed goes to the console and to the event log, the log goes in the PDF
+    start = time.perf_counter()
+    with eventLog.capture("input") as log:
+        results_for_pdf = check_user_input(args, data)
+        summary = summarize(results_for_pdf)
+        log.emit("verdict", scope="run", **summary)
+    timings = {"check": time.perf_counter() - start}
+
+    result = oracleResult.build_result(
+        "input", args, summary, results_for_pdf, log.events, timings
+    )
+    # Generate PDF into the bug folder under unzip_dir
+    if oracleResult.wants_pdf(report):
+        start = time.perf_counter()
+        render_pdf(result)
+        timings["pdf"] = time.perf_counter() - start
+    if oracleResult.wants_json(report):
+        json_path = os.path.join(args["unzip_dir"], args["bugId"], "user_input_result.json")
+        oracleResult.write_result(json_path, result)
+        print(f"[INFO] JSON result written at: {json_path}")
+    return result["summary"]
+
+def render_pdf(result):
+    """Draw the PDF report of a run from its result (see oracleResult)"""
+    pdf_path = os.path.join(result["unzip_dir"], result["bugId"], "user_input_report.pdf")
+    args = {"appName": result["appName"], "bugId": result["bugId"], "unzip_dir": result["unzip_dir"]}
+    generate_pdf_report(result["details"], pdf_path, result["events"], args)
+    print(f"\n[INFO] PDF generated at: {pdf_path}")
+
+def summarize(results_for_pdf):
+    """Verdict (pass, fail or not_detected) and metrics of a run, for the batch results"""
+    failed = sum(1 for r in results_for_pdf if not r["passed"])
+
+    if not results_for_pdf:
+        verdict = "not_detected"
+    elif failed:
+        verdict = "fail"
+    else:
+        verdict = "pass"
+    return {
+        "verdict": verdict,
+        "triggers": len(results_for_pdf),
+        "failed_triggers": failed,
+        "user_inputs": sum(len(r["all_results"]) for r in results_for_pdf),
+        "missing_inputs": sum(len(r["missing_inputs"]) for r in results_for_pdf),
+    }
+
+def check_user_input(args, data):
     bugId = args["bugId"]
     unzip_dir = args["unzip_dir"]
 
-    # Read JSON from: <unzip_dir>/<bugId>/Execution-<bugId>.json
-    execution_json_path = os.path.join(unzip_dir, bugId, f"Execution-{bugId}.json")
-    data = read_json(execution_json_path)
+    # Read the trace: <unzip_dir>/<bugId>/Execution-<bugId>.json
+    trace = traceLoader.as_trace(data, unzip_dir, bugId)
 
     listOfTriggerWords = create_trigger_word_list()
     listOfTriggerComponents = create_trigger_component_list()
@@ -227,33 +251,32 @@ def main():
     # We'll store results in this list so we can generate PDF at the end
     results_for_pdf = []
 
-    # The JSON presumably has a "steps" section
-    for line in data:
-        if "steps" in line:
-            listOfSteps = data["steps"]
-            print("ORACLE FOR USER INPUT MATCH")
-
-            # find_trigger will return a list of (xmlName, screenshotFile)
-            triggerScreens = find_trigger(
-                listOfSteps,
-                screen_count_map,
-                listOfTriggerWords,
-                listOfTriggerComponents,
-                args,
-            )
-
-            if triggerScreens:
-                print("User input detected")
-            else:
-                print("=== No user input detected ===")
+    # The steps of the trace
+    listOfSteps = trace.steps
+    print("ORACLE FOR USER INPUT MATCH")
+
+    # find_trigger will return a list of (xmlName, screenshotFile)
+    triggerScreens = find_trigger(
+        listOfSteps,
+        screen_count_map,
+        listOfTriggerWords,
+        listOfTriggerComponents,
+        args,
+    )
+
+    if triggerScreens:
+        print("User input detected")
+    else:
+        print("=== No user input detected ===")
 
-            usertext_screen_map = find_edit_text(listOfSteps, screen_count_map, args)
+    usertext_screen_map = find_edit_text(listOfSteps, screen_count_map, args)
 
     first_trigger_screen = 0
     print("-------------------------------------------------------------------------------------------")
 
     # Evaluate each trigger
     for count, (triggerXmlName, triggerScreenshot) in enumerate(triggerScreens):
+        eventLog.emit("trigger", index=count + 1, xml=triggerXmlName, screen=triggerScreenshot)
         print("===========================================================================================")
         print("-------------------------------------------------------------------------------------------")
         print("Result for change", str(count + 1))
@@ -280,6 +303,8 @@ def main():
         # For PDF: figure out missing vs matched
         missingText = [k for k, v in result.items() if not v]
         passed = (len(missingText) == 0)
+        eventLog.emit("metric", name="missing_inputs", index=count + 1, value=len(missingText))
+        eventLog.emit("verdict", scope="trigger", index=count + 1, passed=passed, missing=missingText)
 
         # Collect all info for PDF
         results_for_pdf.append({
@@ -291,17 +316,10 @@ def main():
             "screenshot_file": triggerScreenshot,
         })
 
-    # Restore real stdout to fetch everything from console_output_buffer
-    sys.stdout = original_stdout
-    console_output = console_output_buffer.getvalue()
-
-    # Generate PDF into the bug folder under unzip_dir
-    pdf_path = os.path.join(unzip_dir, bugId, "user_input_report.pdf")
-    generate_pdf_report(results_for_pdf, pdf_path, console_output, args)
-    print(f"\n[INFO] PDF generated at: {pdf_path}")
+    return results_for_pdf
 
 
-def generate_pdf_report(results_for_pdf, pdf_path, console_output, args):
+def generate_pdf_report(results_for_pdf, pdf_path, events, args):
     """
     1) Print the entire console output (captured) into the PDF at the top.
     2) Summaries and table of results on a new page.
@@ -322,7 +340,7 @@ def generate_pdf_report(results_for_pdf, pdf_path, console_output, args):
     # ============ Console Output ============
     c.setFont("Helvetica", 10)
     line_height = 12
-    for line in console_output.split("\n"):
+    for line in eventLog.console_lines(events):
         c.drawString(x_margin, y_position, line)
         y_position -= line_height
         if y_position < 50:
@@ -414,7 +432,8 @@ def generate_pdf_report(results_for_pdf, pdf_path, console_output, args):
                     c.setFont("Helvetica", 10)
                     y_position = height - y_margin
 
-                c.drawImage(
+                reportUtilities.draw_image(
+                    c,
                     screenshot_path,
                     x_margin,
                     y_position - img_height,
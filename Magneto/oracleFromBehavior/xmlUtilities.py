@@ -1,17 +1,122 @@
+import os
 import sys
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from collections import OrderedDict
 
+import numpy as np
 from lxml import etree  # as lxmlEt
 
+# how many parsed UI dumps are kept in memory; a long trace touches each dump a
+# handful of times in a row, so a few hundred entries covers a whole bug report
+SCREEN_DUMP_CACHE_SIZE = 512
+
+_screen_dump_cache = OrderedDict()
+
 
 def main():
-    root = ET.parse("18.xml").getroot()
+    for t_value in readTextInXml("18.xml"):
+        print(t_value)
+
+
+def parse_bounds(b):
+    """'[42,306][874,498]' -> (42, 306, 874, 498), (-1, -1, -1, -1) if malformed"""
+    try:
+        start, end = b.split("][")
+        startX, startY = start.replace("[", "").split(",")
+        endX, endY = end.replace("]", "").split(",")
+        return int(startX), int(startY), int(endX), int(endY)
+    except (AttributeError, ValueError):
+        return -1, -1, -1, -1
+
+
+class ScreenDump:
+    """
+    All <node> elements of one uiautomator dump, flattened in document order.
+
+    The file is parsed once with lxml and every attribute the oracles look at is
+    kept as a column: node i has its text at texts[i], its bounds at boxes[i]
+    (startX, startY, endX, endY) and so on. parents[i] is the index of the parent
+    node (-1 when the parent is the <hierarchy> root) and subtree_ends[i] is one
+    past the last descendant, so the descendants of i are range(i + 1, subtree_ends[i]).
+    """
+
+    __slots__ = (
+        "path",
+        "texts",
+        "bounds",
+        "boxes",
+        "classes",
+        "resource_ids",
+        "content_descs",
+        "parents",
+        "subtree_ends",
+    )
+
+    def __init__(self, xmlName):
+        self.path = xmlName
+        with open(xmlName, "rb") as f:
+            root = etree.parse(f).getroot()
+
+        nodes = list(root.iter("node"))
+        index_of = {node: i for i, node in enumerate(nodes)}
+
+        self.texts = [node.get("text") for node in nodes]
+        self.bounds = [node.get("bounds") for node in nodes]
+        self.classes = [node.get("class") for node in nodes]
+        self.resource_ids = [node.get("resource-id") for node in nodes]
+        self.content_descs = [node.get("content-desc") for node in nodes]
+
+        self.boxes = np.array(
+            [parse_bounds(b) for b in self.bounds], dtype=np.int32
+        ).reshape(-1, 4)
+        self.parents = np.array(
+            [index_of.get(node.getparent(), -1) for node in nodes], dtype=np.int32
+        )
+
+        # children always come after their parent, so walking backwards finishes
+        # every subtree before its parent is visited
+        ends = np.arange(1, len(nodes) + 1, dtype=np.int32)
+        for i in range(len(nodes) - 1, -1, -1):
+            p = self.parents[i]
+            if p >= 0 and ends[i] > ends[p]:
+                ends[p] = ends[i]
+        self.subtree_ends = ends
 
-    for tag in root.iter("node"):
-        t_value = tag.get("text")
-        if t_value:  # is not None or "": #to filter empty text fields
-            print(t_value)
+    def __len__(self):
+        return len(self.texts)
+
+    def descendants(self, i):
+        return range(i + 1, int(self.subtree_ends[i]))
+
+    def text_nodes(self):
+        """indices of nodes with a non empty text attribute"""
+        return [i for i, t in enumerate(self.texts) if t]
+
+
+def load_screen_dump(xmlName):
+    """
+    Returns the ScreenDump of xmlName, parsing the file only the first time it is
+    asked for (or after it changed on disk). Raises FileNotFoundError like open().
+    """
+    key = os.path.abspath(xmlName)
+    st = os.stat(key)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    cached = _screen_dump_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        _screen_dump_cache.move_to_end(key)
+        return cached[1]
+
+    dump = ScreenDump(xmlName)
+    _screen_dump_cache[key] = (stamp, dump)
+    _screen_dump_cache.move_to_end(key)
+    while len(_screen_dump_cache) > SCREEN_DUMP_CACHE_SIZE:
+        _screen_dump_cache.popitem(last=False)
+    return dump
+
+
+def clear_screen_dump_cache():
+    _screen_dump_cache.clear()
 
 
 def readXML(xmlFile):
@@ -26,20 +131,11 @@ def readXML(xmlFile):
 
 def readBoundOfFocusedElement(xmlFile):
     try:
-        tree = ET.parse(xmlFile)
-        # get root element
-        root = tree.getroot()
-        for tag in root.iter("node"):
-            b = tag.get("bounds")
-            start = b.split("][")[0].replace("[", "")
-            end = b.split("][")[1].replace("]", "")
-            startX = start.split(",")[0]
-            startY = start.split(",")[1]
-            endX = end.split(",")[0]
-            endY = end.split(",")[1]
-            # return
-            break
-        return ','.join((startX,startY, endX,endY))
+        dump = load_screen_dump(xmlFile)
+        if not len(dump):
+            return
+        # bounds of the first (outermost) node
+        return ",".join(str(v) for v in dump.boxes[0])
     except FileNotFoundError as f:
         # print(xmlFile,"File not found!")
         return
@@ -47,14 +143,8 @@ def readBoundOfFocusedElement(xmlFile):
 def readTextInXml(xmlName):
     """Reads all text field in xml and returns a list all text"""
     try:
-        root = ET.parse(xmlName).getroot()
-        textList = []
-        for tag in root.iter("node"):
-            t_value = tag.get("text")
-            if t_value:  # is not None or "": #to filter empty text fields
-                # print(t_value)
-                textList.append(t_value)
-        return textList
+        dump = load_screen_dump(xmlName)
+        return [t for t in dump.texts if t]  # to filter empty text fields
     except:
         print("No xml", xmlName)
 
@@ -62,21 +152,17 @@ def readTextInXml(xmlName):
 def return_resource_id_of_image(xmlName):
     """Reads all imageView in xml and returns a list of their resource-ids"""
     try:
-        root = ET.parse(xmlName).getroot()
+        dump = load_screen_dump(xmlName)
         image_resources = []
         counter = 0
-        for tag in root.iter("node"):
-            className = tag.get("class")
-            id = tag.get("resource-id")
+        for i in range(len(dump)):
+            id = dump.resource_ids[i]
             if not id:  # for valid nodes with no id
-                id = tag.get("content-desc")
+                id = dump.content_descs[i]
             if not id:
                 id = str(counter)
                 counter += 1
-            if (
-                className == "android.widget.ImageView"
-            ):  # is not None or "": #to filter empty text fields
-                # print(t_value)
+            if dump.classes[i] == "android.widget.ImageView":
                 image_resources.append(id)
         return image_resources
     except:
@@ -86,17 +172,14 @@ def return_resource_id_of_image(xmlName):
 def return_resource_id_with_text(xmlName):
     """Reads all text field in xml and returns a map of resource-id and text"""
     try:
-        root = ET.parse(xmlName).getroot()
+        dump = load_screen_dump(xmlName)
         text_resource_map = {}
         counter = 0
-        for tag in root.iter("node"):
-            t_value = tag.get("text")
-            id = tag.get("resource-id")
+        for t_value, id in zip(dump.texts, dump.resource_ids):
             if not id:
                 id = str(counter)
                 counter += 1
             if t_value:  # is not None or "": #to filter empty text fields
-                # print(t_value)
                 text_resource_map[id] = t_value
         return text_resource_map
     except:
@@ -106,20 +189,18 @@ def return_resource_id_with_text(xmlName):
 def readUserFieldTextInXml(xmlName):
     """Reads only user entered text field and returns a map of resource-id and text"""
     try:
-        root = ET.parse(xmlName).getroot()
+        dump = load_screen_dump(xmlName)
         text_resource_map = {}
         counter = 0
-        for tag in root.iter("node"):
-            if tag.attrib["class"] == "android.widget.EditText":
-                t_value = tag.get("text")
-                id = tag.get("resource-id")
+        for i in range(len(dump)):
+            if dump.classes[i] == "android.widget.EditText":
+                t_value = dump.texts[i]
+                id = dump.resource_ids[i]
                 if not id:
                     id = str(counter)
                     counter += 1
                 if not t_value:
                     t_value = ""
-                # if t_value: # is not None or "": #to filter empty text fields
-                # print(t_value)
                 text_resource_map[id] = t_value
         return text_resource_map
     except Exception as e:
@@ -129,102 +210,46 @@ def readUserFieldTextInXml(xmlName):
 
 def findParentBoundOfMatchingNode(xmlName, listOfTriggerWords):
     """Reads only text field and returns their parent node"""
-    # try:
-    root = etree.parse(xmlName).getroot()
-    for tag in root.iter("node"):
-        t_value = tag.get("text")
-        # if ["theme", "night"] in t_value.lower():
+    dump = load_screen_dump(xmlName)
+    for i, t_value in enumerate(dump.texts):
         if any(words in t_value.lower() for words in listOfTriggerWords):
-            p = tag.getparent()
+            p = dump.parents[i]
             # [42,306][874,498]
-            allBounds = p.get("bounds")
-            if allBounds:
-                start = allBounds.split("][")[0].replace("[", "")
-                end = allBounds.split("][")[1].replace("]", "")
-                startX = start.split(",")[0]
-                startY = start.split(",")[1]
-                endX = end.split(",")[0]
-                endY = end.split(",")[1]
-                return startY, endY
+            if p >= 0 and dump.bounds[p]:
+                startX, startY, endX, endY = dump.boxes[p]
+                return str(startY), str(endY)
             else:
                 return "-1", "-1"
     return "-1", "-1"
 
-    # except Exception as e:
-    #     # print(e.__cause__)
-    #     print("No xml", xmlName)
-    #     return -1, -1
-
-    # root = ET.parse(xmlName).getroot()
-    # text_resource_map = {}
-    # counter = 0
-    # # t = root.findall("node")
-    # # print(len(t))
-    # # for x in t:
-    # #     # print(x.get("bounds"), "THIS?")
-    # #     if "theme" in x.get("text").lower():
-    # # bounds="[42,306][874,498]"><
-    # for tag in root.iter("node"):
-    #     t_value = tag.get("text")
-    #     # print("TEXT", t_value)
-    #     if "theme" in t_value.lower():
-    #         # find parent
-    #         print("FOUND=========", tag, t_value)
-    #         p = tag.getparent()
-    #         print(p, "-----BOOM-----")
-
-    #     return True
-    # except Exception as e:
-    #     print(e)
-    #     print("No xml", xmlName)
-
 
 def find_recycler_class(xmlName, list_of_recycle_classes, list_of_container_classes):
     """Finds rows by looking for container in recycler class and checks if row start height is lower than container or not
     This solves issues like that of bug 121"""
-    tree = minidom.parse(xmlName)
-    all_nodes = tree.getElementsByTagName("node")
+    dump = load_screen_dump(xmlName)
+    start_heights = dump.boxes[:, 1]
     result = []
-    for parent_nodes in all_nodes:
-        if parent_nodes.getAttribute("class") in list_of_recycle_classes:
-            children = parent_nodes.getElementsByTagName("node")
-            for child in children:
-                # print(type(child))
-                if child.getAttribute("class") in list_of_container_classes:
+    for parent_node in range(len(dump)):
+        if dump.classes[parent_node] in list_of_recycle_classes:
+            for child in dump.descendants(parent_node):
+                if dump.classes[child] in list_of_container_classes:
                     # found the container
-                    container_bound = child.getAttribute("bounds")
-                    container_start_height = int(
-                        container_bound.split("][")[0].split(",")[1]
-                    )
-                    list_row = child.getElementsByTagName("node")
-                    for i in list_row:
-                        row_bound = i.getAttribute("bounds")
-                        row_start_height = int(row_bound.split("][")[0].split(",")[1])
-
-                        if container_start_height >= row_start_height:
-                            # print(container_start_height, row_start_height)
-                            # print(i.getAttribute("text"), "bad")
+                    container_start_height = start_heights[child]
+                    for row in dump.descendants(child):
+                        if container_start_height >= start_heights[row]:
                             result.append(xmlName)
-                        # else:
-                        #     print(i.getAttribute("text"), "ok")
-            # sys.exit()
             print(set(result))
             return result
 
 
 def find_recycler_class_only(xmlName, list_of_recycle_classes):
-    """Finds if there are rows by looking for nodes that have recycler class"""
-    tree = minidom.parse(xmlName)
-    all_nodes = tree.getElementsByTagName("node")
+    """Finds if there are rows by looking for nodes that have recycler class
+    Returns, for every recycler node, the indices of its descendants in the ScreenDump"""
+    dump = load_screen_dump(xmlName)
     result = []
-    for parent_nodes in all_nodes:
-        if parent_nodes.getAttribute("class") in list_of_recycle_classes:
-            children = parent_nodes.getElementsByTagName("node")
-            result.append(children)
-
-            # else:
-            #     print(i.getAttribute("text"), "ok")
-            # sys.exit()
+    for parent_node in range(len(dump)):
+        if dump.classes[parent_node] in list_of_recycle_classes:
+            result.append(list(dump.descendants(parent_node)))
     return result
 
 
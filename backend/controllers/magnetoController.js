@@ -4,10 +4,88 @@ import { spawn } from 'child_process';
 import { updateTestAfterRun } from '../services/testService.js';
 import { storePdfInGridFS } from '../services/fileService.js';
 
+// Oracle worker service (Magneto/oracleFromBehavior/oracleWorker.py), e.g. http://127.0.0.1:8765,
+// set by docker-compose.yml (oracle-worker service) and the Dockerfile (started with the backend).
+// When set, oracles run in its warm worker processes; a new `poetry run python` is only
+// started when the worker can't be reached.
+const WORKER_URL = process.env.MAGNETO_WORKER_URL;
+
+// What the oracles computed for every step of a test (see Magneto/oracleFromBehavior/analysisManifest.py).
+// Kept outside of the unzipped folder, which is deleted after a run, so a re-run only redoes the changed steps.
+const manifestDir = (testId) => path.join('/app/temp/manifests', testId);
+
+/**
+ * The JSON result the oracle wrote next to its PDF (verdict, metrics...), null if missing
+ */
+const readOracleResult = (unzipDir, argB, pdfName) => {
+  const resultPath = path.join(unzipDir, argB, pdfName.replace('_report.pdf', '_result.json'));
+  try {
+    return JSON.parse(fs.readFileSync(resultPath, 'utf8'));
+  } catch (error) {
+    console.error(`[BACKEND] No JSON result at ${resultPath}:`, error.message);
+    return null;
+  }
+};
+
+/**
+ * Store the PDF of a successful run, clean up and answer the request
+ */
+const finishRun = async (testId, unzipDir, argB, pdfName, output, res) => {
+  console.log('[BACKEND] Python script output:', output);
+  // read before the unzipped folder is deleted
+  const report = readOracleResult(unzipDir, argB, pdfName);
+
+  // ✅ Fix the PDF path to include `argB`
+  const pdfPath = path.join(unzipDir, argB, pdfName);
+
+  if (!fs.existsSync(pdfPath)) {
+    console.error(`[BACKEND] PDF not found at: ${pdfPath}`);
+    return res.status(500).json({ success: false, error: `PDF file missing` });
+  } else {
+    console.log(`[BACKEND] PDF file exists: ${pdfPath}`);
+  }
+
+  try {
+    console.log('[BACKEND] Storing PDF in GridFS...');
+    const pdfFileId = await storePdfInGridFS(testId, path.basename(pdfPath), argB);
+    console.log(`[BACKEND] PDF saved in GridFS with ID: ${pdfFileId}`);
+
+    // If everything is successful, delete the unzipped directory
+    console.log(`[BACKEND] Deleting unzipped folder: ${unzipDir}`);
+    fs.rmSync(unzipDir, { recursive: true, force: true });
+    console.log(`[BACKEND] Successfully deleted: ${unzipDir}`);
+  } catch (error) {
+    console.error('[BACKEND] Error storing PDF:', error.message);
+  }
+
+  await updateTestAfterRun(testId, { result: output, report, status: 'completed' });
+  res.status(200).json({ success: true, output, summary: report ? report.summary : null });
+};
+
+/**
+ * Run the oracle in the worker service.
+ * Returns { status, body } or null if the service can't be reached.
+ */
+const runInWorker = async (oracle, argA, argB, unzipDir, testId) => {
+  try {
+    const response = await fetch(`${WORKER_URL}/run`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        oracle, appName: argA, bugId: argB, unzipDir, report: 'both', manifestDir: manifestDir(testId),
+      }),
+    });
+    return { status: response.status, body: await response.json() };
+  } catch (error) {
+    console.error(`[BACKEND] Oracle worker not reachable at ${WORKER_URL}:`, error.message);
+    return null;
+  }
+};
+
 /**
  * Utility function to execute Python scripts, save PDFs, and clean up temp files
  */
-const executePythonScript = async (scriptDir, scriptName, pdfName, dependencies, req, res) => {
+const executePythonScript = async (oracle, scriptDir, scriptName, pdfName, dependencies, req, res) => {
   const { argA, argB, testId } = req.body;
   const unzipDir = path.join('/app/temp/unzipped', testId);
   console.log(`[BACKEND] Running Python script on unzipped directory: ${unzipDir}`);
@@ -16,6 +94,22 @@ const executePythonScript = async (scriptDir, scriptName, pdfName, dependencies,
     return res.status(500).json({ success: false, error: `Unzipped directory not found: ${unzipDir}` });
   }
 
+  if (WORKER_URL) {
+    const result = await runInWorker(oracle, argA, argB, unzipDir, testId);
+    if (result && result.status === 200) {
+      return finishRun(testId, unzipDir, argB, pdfName, result.body.output, res);
+    }
+    if (result && result.status === 503) {
+      // all the workers are busy and the queue is full
+      return res.status(503).json({ success: false, error: result.body.error });
+    }
+    if (result) {
+      console.error('[BACKEND] Python script error:', result.body.error);
+      return res.status(500).json({ success: false, error: result.body.error });
+    }
+    // worker unreachable, run the script the usual way
+  }
+
   // ✅ Ensure dependencies are copied before running the script
   const magnetoDir = '/app/magneto';
   for (const dep of dependencies) {
@@ -28,11 +122,11 @@ const executePythonScript = async (scriptDir, scriptName, pdfName, dependencies,
   console.log(`[BACKEND] Dependencies copied to: ${unzipDir}`);
 
   const scriptPath = path.join(unzipDir, scriptName);
-  const scriptArgs = ['-a', argA, '-b', argB, '--unzip-dir', unzipDir];
+  const scriptArgs = ['-a', argA, '-b', argB, '--unzip-dir', unzipDir, '--report', 'both'];
 
   const pythonProcess = spawn('/root/.local/bin/poetry', ['run', 'python', scriptPath, ...scriptArgs], {
     cwd: scriptDir,
-    env: { ...process.env, PYTHONPATH: unzipDir },
+    env: { ...process.env, PYTHONPATH: unzipDir, MAGNETO_MANIFEST_DIR: manifestDir(testId) },
   });
 
   let output = '';
@@ -43,33 +137,7 @@ const executePythonScript = async (scriptDir, scriptName, pdfName, dependencies,
 
   pythonProcess.on('close', async (code) => {
     if (code === 0) {
-      console.log('[BACKEND] Python script output:', output);
-
-      // ✅ Fix the PDF path to include `argB`
-      const pdfPath = path.join(unzipDir, argB, pdfName);
-
-      if (!fs.existsSync(pdfPath)) {
-        console.error(`[BACKEND] PDF not found at: ${pdfPath}`);
-        return res.status(500).json({ success: false, error: `PDF file missing` });
-      } else {
-        console.log(`[BACKEND] PDF file exists: ${pdfPath}`);
-      }
-
-      try {
-        console.log('[BACKEND] Storing PDF in GridFS...');
-        const pdfFileId = await storePdfInGridFS(testId, path.basename(pdfPath), argB);
-        console.log(`[BACKEND] PDF saved in GridFS with ID: ${pdfFileId}`);
-
-        // If everything is successful, delete the unzipped directory
-        console.log(`[BACKEND] Deleting unzipped folder: ${unzipDir}`);
-        fs.rmSync(unzipDir, { recursive: true, force: true });
-        console.log(`[BACKEND] Successfully deleted: ${unzipDir}`);
-      } catch (error) {
-        console.error('[BACKEND] Error storing PDF:', error.message);
-      }
-
-      await updateTestAfterRun(testId, { result: output, status: 'completed' });
-      res.status(200).json({ success: true, output });
+      await finishRun(testId, unzipDir, argB, pdfName, output, res);
     } else {
       console.error('[BACKEND] Python script error:', errorOutput);
       res.status(500).json({ success: false, error: errorOutput });
@@ -82,6 +150,7 @@ const executePythonScript = async (scriptDir, scriptName, pdfName, dependencies,
  */
 export const runThemeCheck = (req, res) => {
   executePythonScript(
+    'theme',
     '/app/magneto/themeChange',
     'themeCheck.py',
     'theme_detection_report.pdf',
@@ -91,6 +160,17 @@ export const runThemeCheck = (req, res) => {
       'themeChange/labelPredictor.py',
       'themeChange/model_cifar.pt',
       'imageUtilities.py',
+      'ocrCache.py',
+      'ocrEngine.py',
+      'oracleResult.py',
+      'reportUtilities.py',
+      'eventLog.py',
+      'analysisManifest.py',
+      'traceLoader.py',
+      'screenDedup.py',
+      'triggerMatcher.py',
+      'screenSimilarity.py',
+      'screenStore.py',
       'xmlUtilities.py',
       'poetry.lock',
       'readTextInImage.py',
@@ -106,6 +186,7 @@ export const runThemeCheck = (req, res) => {
  */
 export const runBackButton = (req, res) => {
   executePythonScript(
+    'back',
     '/app/magneto/backButton',
     'SSIM-withoutReport.py',
     'back_button_report.pdf',
@@ -113,7 +194,19 @@ export const runBackButton = (req, res) => {
       'backButton/SSIM-withoutReport.py',
       'backButton/binaryClassifier.py',
       'backButton/labelPredictor.py',
+      'backButton/ssimEngine.py',
       'imageUtilities.py',
+      'ocrCache.py',
+      'ocrEngine.py',
+      'oracleResult.py',
+      'reportUtilities.py',
+      'eventLog.py',
+      'analysisManifest.py',
+      'traceLoader.py',
+      'screenDedup.py',
+      'triggerMatcher.py',
+      'screenSimilarity.py',
+      'screenStore.py',
       'xmlUtilities.py',
       'poetry.lock',
       'readTextInImage.py',
@@ -129,14 +222,27 @@ export const runBackButton = (req, res) => {
  */
 export const runLanguageDetection = (req, res) => {
   executePythonScript(
+    'lang',
     '/app/magneto/languageDetection',
     'detectLanguageAll.py',
     'language_detection_report.pdf',
     [
       'languageDetection/detectLanguageAll.py',
       'languageDetection/detectLanguageNext.py',
+      'languageDetection/languageId.py',
       'languageDetection/language_code.json',
       'imageUtilities.py',
+      'ocrCache.py',
+      'ocrEngine.py',
+      'oracleResult.py',
+      'reportUtilities.py',
+      'eventLog.py',
+      'analysisManifest.py',
+      'traceLoader.py',
+      'screenDedup.py',
+      'triggerMatcher.py',
+      'screenSimilarity.py',
+      'screenStore.py',
       'xmlUtilities.py',
       'poetry.lock',
       'pyproject.toml',
@@ -151,12 +257,24 @@ export const runLanguageDetection = (req, res) => {
  */
 export const runUserEnteredData = (req, res) => {
   executePythonScript(
+    'input',
     '/app/magneto/userEnteredData',
     'findTriggerCheckInput.py',
     'user_input_report.pdf',
     [
       'userEnteredData/findTriggerCheckInput.py',
       'imageUtilities.py',
+      'ocrCache.py',
+      'ocrEngine.py',
+      'oracleResult.py',
+      'reportUtilities.py',
+      'eventLog.py',
+      'analysisManifest.py',
+      'traceLoader.py',
+      'screenDedup.py',
+      'triggerMatcher.py',
+      'screenSimilarity.py',
+      'screenStore.py',
       'xmlUtilities.py',
       'poetry.lock',
       'readTextInImage.py',
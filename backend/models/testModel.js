@@ -12,6 +12,7 @@ const testSchema = new mongoose.Schema({
     default: 'pending' 
   }, // Status of the tests
   result: { type: String, default: '' }, // Result of the test
+  report: { type: mongoose.Schema.Types.Mixed, default: null }, // JSON result of the oracle (verdict, metrics)
   notes: { type: String, default: '' }, // Notes for the test
   createdAt: { type: Date, default: Date.now }, // Date when the test was created
 });
@@ -20,6 +20,36 @@ conn.once('open', () => {
   resultsBucket = new GridFSBucket(conn.db, { bucketName: 'results' });
 });
 
+/**
+ * Extract the zip into dir like zip.extractAllTo(dir, true), but leave the files already
+ * there with the same content untouched. On a re-run they keep their mtime, so the oracles
+ * (Magneto/oracleFromBehavior/analysisManifest.py) don't hash them again.
+ * Returns the number of files written.
+ */
+export const extractChanged = (zipPath, dir) => {
+  const zip = new AdmZip(zipPath);
+  const root = path.resolve(dir);
+  let written = 0;
+  for (const entry of zip.getEntries()) {
+    const target = path.resolve(root, entry.entryName);
+    if (entry.isDirectory) {
+      if (target.startsWith(root + path.sep)) {
+        fs.mkdirSync(target, { recursive: true });
+      }
+      continue;
+    }
+    if (target.startsWith(root + path.sep) && fs.existsSync(target)) {
+      const stat = fs.statSync(target);
+      if (stat.isFile() && stat.size === entry.header.size && fs.readFileSync(target).equals(entry.getData())) {
+        continue;
+      }
+    }
+    zip.extractEntryTo(entry, dir, true, true);
+    written += 1;
+  }
+  return written;
+};
+
 /**
  * Save uploaded file and unzip it
  */
@@ -33,10 +63,9 @@ export const saveFileInfo = async (file, testId) => {
     fs.mkdirSync(unzipDir, { recursive: true });
   }
 
-  // Unzip the file
-  const zip = new AdmZip(filePath);
-  zip.extractAllTo(unzipDir, true);
-  console.log(`File unzipped to: ${unzipDir}`);
+  // Unzip the file, only the files that changed if it was already unzipped
+  const written = extractChanged(filePath, unzipDir);
+  console.log(`File unzipped to: ${unzipDir} (${written} file(s) written)`);
 
   // Stream file into GridFS
   const readStream = fs.createReadStream(filePath);
@@ -3,7 +3,7 @@ import mongoose from 'mongoose';
 import fs from 'fs';
 import path from 'path';
 import { spawn } from 'child_process';
-import AdmZip from 'adm-zip';
+import { extractChanged } from './fileService.js';
 
 
 
@@ -109,9 +109,8 @@ export const prepareFileFromGridFS = async (fileId) => {
       fs.mkdirSync(unzipDir, { recursive: true });
     }
 
-    // 3. Extract the archive
-    const zip = new AdmZip(tempZipPath);
-    zip.extractAllTo(unzipDir, /* overwrite */ true);
+    // 3. Extract the archive, only the files that changed if it was already extracted
+    extractChanged(tempZipPath, unzipDir);
 
     // 4. Clean up hidden/macOS artifacts
     removeMacArtifacts(unzipDir);
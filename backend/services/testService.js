@@ -161,7 +161,7 @@ export const getTestsByAppService = async (appId) => {
     }
   };
 
-  export const updateTestAfterRun = async (testId, { result, status }) => {
+  export const updateTestAfterRun = async (testId, { result, report = null, status }) => {
     try {
       // Validate testId
       const testObjectId = new mongoose.Types.ObjectId(testId);
@@ -172,6 +172,7 @@ export const getTestsByAppService = async (appId) => {
         {
           $set: {
             result, // Update the result field
+            report, // JSON result of the oracle
             status, // Update the status field
           },
         },